@@ -1,17 +1,36 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from enum import Enum
-import glob
+from functools import partial
 import os
+import threading
 from typing import List
+import uuid
 
 from astropy.io import fits
+import numpy as np
 
+from . import catalog
+from . import env
+from . import fitsheader
 from . import log
 
 CURRENT_DATE_TIME = datetime.datetime.now().strftime("%y-%m-%dT%H:%M:%S")
 
+FITS_EXTENSIONS = (".fits", ".fts")
+VALUE_KEYWORDS = ("XBINNING", "CCD-TEMP", "DATE-OBS", "EXPTIME", "FILTER",
+                  "BITPIX", "NAXIS1", "NAXIS2")
+SCALE_KEYWORDS = ("BSCALE", "BZERO", "BLANK")
+# Big endian type of the values stored for each BITPIX
+BITPIX_DTYPES = {8: ">u1", 16: ">i2", 32: ">i4", 64: ">i8", -32: ">f4", -64: ">f8"}
+SCAN_THREADS_DEFAULT = 16 # Headers read at once when finding images
+
 logger = log.get_logger()
 
+# File operations on images, see count_io()
+_io_lock = threading.Lock()
+_io_stats = {"files_opened": 0, "bytes_written": 0}
+
 #
 # ARImage
 # This class provides an easy way to interact with astronomy fits images
@@ -24,6 +43,7 @@ class ARImage:
     # File info
     file_dir = "."
     file_name = "null"
+    shared_path = None # Data file shared with other processes, see shareData()
 
     # Image parameters
     binning = 0
@@ -32,6 +52,11 @@ class ARImage:
     exp_time = 0
     filter = "NA"
 
+    # Data layout, from the header. 0 if unknown, see getNumPixels()
+    bitpix = 0
+    naxis1 = 0
+    naxis2 = 0
+
     # Astronomy info
     object_name = "earth"
 
@@ -39,21 +64,50 @@ class ARImage:
         """ Get the full path of the fits image """
         return os.path.join(self.file_dir, self.file_name)
 
-    def loadData(self):
-        """ Load image data """
+    def loadData(self, memmap=None):
+        """ Load image data, mapped from the file instead of read if memmap is set """
         if self.fits_data is None:
             # Only load the data if it has not already been loaded
             # If you want to reload the data, use .unloadData() first
-            self.fits_data = fits.getdata(self.getFullPath())
+            # The header is read from the same open file
+            with self.openSection(memmap) as section:
+                self.fits_data = section.readData()
+                if self.fits_header is None:
+                    self.fits_header = section.header
         return self.fits_data
 
+    def openSection(self, memmap=None):
+        """ Open the image data for reading parts of it, see ImageSection """
+        return ImageSection(self, memmap)
+
+    def loadSection(self, key, memmap=None):
+        """ Read part of the image data, e.g. img.loadSection(np.s_[10:20, 40:80]) """
+        with self.openSection(memmap) as section:
+            return section[key]
+
+    def loadRows(self, start: int, stop: int, memmap=None):
+        """ Read the rows [start, stop) of the image data """
+        return self.loadSection(slice(start, stop), memmap)
+
     def unloadData(self):
         """ Unload the image data from memory """
         self.fits_data = None
+        self.shared_path = None
+
+    def shareData(self, share_dir: str):
+        """ Publish the image data to a file that other processes map read-only """
+        if self.shared_path is None:
+            path = os.path.join(share_dir, uuid.uuid4().hex + ".npy")
+            np.save(path, self.loadData())
+            # Swap the loaded data for a view of the shared file
+            self.fits_data = np.load(path, mmap_mode="r")
+            self.shared_path = path
+        return self.shared_path
 
     def loadHeader(self):
         """ Load the fits header """
         if self.fits_header is None:
+            count_io(files_opened=1)
             self.fits_header = fits.getheader(self.getFullPath())
         return self.fits_header
 
@@ -63,6 +117,21 @@ class ARImage:
 
     def loadValues(self):
         """ Load the important values from the fits header """
+        if self.fits_header is None:
+            # Only the cards that are needed, without parsing the whole header
+            count_io(files_opened=1)
+            values = fitsheader.read_cards(self.getFullPath(), VALUE_KEYWORDS)
+            if values is not None:
+                self.binning  = values["XBINNING"]
+                self.ccd_temp = values["CCD-TEMP"]
+                self.date_obs = values["DATE-OBS"]
+                self.exp_time = values["EXPTIME"]
+                self.filter   = values["FILTER"]
+                self.bitpix   = values["BITPIX"] or 0
+                self.naxis1   = values["NAXIS1"] or 0
+                self.naxis2   = values["NAXIS2"] or 0
+                return
+
         unload_after = False
         if self.fits_header is None:
             unload_after = True
@@ -72,9 +141,42 @@ class ARImage:
         self.date_obs = self.fits_header.get("DATE-OBS")
         self.exp_time = self.fits_header.get("EXPTIME")
         self.filter   = self.fits_header.get("FILTER")
+        self.bitpix   = self.fits_header.get("BITPIX", 0)
+        self.naxis1   = self.fits_header.get("NAXIS1", 0)
+        self.naxis2   = self.fits_header.get("NAXIS2", 0)
         if unload_after:
             self.unloadHeader()
 
+    def getValues(self) -> dict:
+        """ Get the important header values as a dictionary """
+        return {
+            "binning": self.binning,
+            "ccd_temp": self.ccd_temp,
+            "date_obs": self.date_obs,
+            "exp_time": self.exp_time,
+            "filter": self.filter,
+            "object_name": self.object_name,
+            "bitpix": self.bitpix,
+            "naxis1": self.naxis1,
+            "naxis2": self.naxis2,
+        }
+
+    def setValues(self, values: dict):
+        """ Set the important header values from a dictionary """
+        self.binning = values["binning"]
+        self.ccd_temp = values["ccd_temp"]
+        self.date_obs = values["date_obs"]
+        self.exp_time = values["exp_time"]
+        self.filter = values["filter"]
+        self.object_name = values["object_name"]
+        self.bitpix = values["bitpix"]
+        self.naxis1 = values["naxis1"]
+        self.naxis2 = values["naxis2"]
+
+    def getNumPixels(self) -> int:
+        """ Number of pixels in the image data as the header describes it, 0 if unknown """
+        return self.naxis1 * self.naxis2
+
     def copyValues(self, astro_img):
         """ Copy the important header values from another AstroImage """
         self.binning = astro_img.binning
@@ -97,11 +199,34 @@ class ARImage:
         if unload_after:
             self.unloadHeader()
 
-    def saveToDisk(self):
-        """ Save the fits header and image data to the disk """
+    def saveToDisk(self, dtype=None):
+        """ Save the fits header and image data to the disk, as dtype if given """
         self.writeValues()
-        fits.writeto(self.getFullPath(), data=self.fits_data,
-                     header=self.fits_header, overwrite=True)
+        data = self.fits_data
+        scale_dtype = None
+        if dtype is not None and data is not None:
+            dtype = np.dtype(dtype)
+            if dtype.kind in "iu":
+                # Scaled integers, the full range of the data is kept with BSCALE/BZERO
+                scale_dtype = dtype
+            else:
+                data = data.astype(dtype, copy=False)
+        hdu = fits.PrimaryHDU(data=data, header=self.fits_header)
+        if scale_dtype is not None:
+            hdu.scale(scale_dtype.name, "minmax")
+
+        # Written next to the image and renamed over it, so readers never
+        # see a partly written file. Hidden, so scans skip it meanwhile.
+        temp_path = os.path.join(self.file_dir,
+                                 "." + self.file_name + "." + uuid.uuid4().hex + ".tmp")
+        try:
+            hdu.writeto(temp_path)
+            count_io(bytes_written=os.path.getsize(temp_path))
+            os.replace(temp_path, self.getFullPath())
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
 
     def setFilePath(self, path):
         """ Set the full path of the file """
@@ -110,41 +235,269 @@ class ARImage:
             self.file_dir = "."
         self.file_name = os.path.basename(path)
 
-    def __init__(self, path=None, new_file=False):
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.shared_path is not None:
+            # Shared data is mapped again when unpickled instead of being copied
+            state.pop("fits_data", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.shared_path is not None:
+            self.fits_data = np.load(self.shared_path, mmap_mode="r")
+
+    def __init__(self, path=None, new_file=False, load_values=True):
         if path == None:
             logger.warning("Cannot load AstroImage from unspecified path")
             return
         self.setFilePath(path)
-        if new_file and path != None: # Create a new fits file
+        if new_file and path != None: # Create a new fits image, written by saveToDisk()
             hdu = fits.PrimaryHDU()
-            hdulist = fits.HDUList([hdu])
-            self.fits_header = hdulist[0].header
-            self.fits_data = hdulist[0].data
-            self.saveToDisk()
-        self.loadValues() # Read in important header values
+            self.fits_header = hdu.header
+            self.fits_data = hdu.data
+            self.writeValues()
+        if load_values:
+            self.loadValues() # Read in important header values
 
-def find_arimgs_in_dir(directory: str, recursive: bool=True) -> List[ARImage]:
-    """ Find and create ARImage objects for fits images in a "directory" """
-    arimgs = []
+#
+# ImageSection
+# Reads parts of an image's data without loading all of it. Unscaled data
+# is mapped from the file in memmap mode so slices come straight from the
+# page cache, otherwise only the pixels that are asked for are read.
+#
+class ImageSection:
+    header = None
+    shape = None
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    @property
+    def dtype(self):
+        """ Type of the data read, after any scaling """
+        if self._dtype is None:
+            self._dtype = self[:1].dtype
+        return self._dtype
+
+    def readInto(self, start: int, stop: int, out):
+        """ Read the rows [start, stop) into the array out, converting them to its type """
+        if not self._readRawInto(start, stop, out):
+            # Mapped or loaded data is copied from a view, other sections read
+            # the rows into a new array first
+            np.copyto(out, self[start:stop], casting="unsafe")
+
+    def _readRawInto(self, start: int, stop: int, out) -> bool:
+        """ Read the rows from the file straight into out if it has their type """
+        if self._raw_dtype is None or isinstance(self._data, np.ndarray):
+            return False
+        read_dtype = self._unsigned_dtype
+        if read_dtype is None:
+            read_dtype = self._raw_dtype.newbyteorder("=")
+        if out.dtype != read_dtype:
+            return False
+        if out.shape != (stop - start,) + self.shape[1:] or not out.flags.c_contiguous:
+            return False
+
+        row_bytes = self._raw_dtype.itemsize * int(np.prod(self.shape[1:]))
+        self._raw_file.seek(self._data_offset + start * row_bytes)
+        buffer = memoryview(out.view(np.uint8).reshape(-1))
+        read = 0
+        while read < len(buffer):
+            count = self._raw_file.readinto(buffer[read:])
+            if not count:
+                raise EOFError("Image data ends before row " + str(stop))
+            read += count
+
+        # The file is big endian, swap to the type of out in place on other hosts
+        if not self._raw_dtype.isnative:
+            out.byteswap(inplace=True)
+        if self._unsigned_dtype is not None:
+            # The same as astropy, the signed values were stored offset by BZERO
+            np.bitwise_xor(out, 1 << (out.dtype.itemsize * 8 - 1), out=out)
+        return True
+
+    def readData(self):
+        """ Read all of the image data, mapped if the section is """
+        if self._hdu is None:
+            return self._data
+        return self._hdu.data
 
-    if recursive:
-        dir_prefix = os.path.join(directory, "**")
+    def close(self):
+        """ Close the image file, slices that were read stay valid """
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+        self._data = None
+        self._raw_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __init__(self, img: ARImage, memmap=None):
+        self._hdul = None
+        self._hdu = None
+        self._dtype = None
+        self._raw_dtype = None # Type the rows are stored as, if they can be read directly
+        self._unsigned_dtype = None # Type of BZERO offset unsigned rows
+        self._raw_file = None
+        self._data_offset = None
+        if img.fits_data is not None:
+            # Already in memory, slice it directly
+            self._data = img.fits_data
+            self.header = img.fits_header
+            self.shape = self._data.shape
+            return
+
+        if memmap is None:
+            memmap = get_memmap()
+        hdu = self._openHDU(img.getFullPath(), memmap)
+        self.header = self._hdul[0].header # The same header fits.getheader() reads
+        scaled = any(card in hdu.header for card in SCALE_KEYWORDS)
+        if memmap and scaled:
+            # Scaled data can't be mapped, each slice is read and scaled on its own
+            self._hdul.close()
+            hdu = self._openHDU(img.getFullPath(), False)
+        self._hdu = hdu
+        self.shape = hdu.shape
+        if memmap and not scaled:
+            self._data = hdu.data
+        else:
+            self._data = hdu.section
+            self._setRawDtype(hdu)
+
+    def _setRawDtype(self, hdu):
+        """ Find whether rows can be read from the file without scaling them """
+        # This needs the open file and the data offset astropy keeps, if they
+        # are missing the rows are read through the section
+        header = hdu.header
+        fits_file = getattr(self._hdul, "_file", None)
+        raw_file = getattr(fits_file, "_file", None)
+        data_offset = getattr(hdu, "_data_offset", None)
+        if (not hasattr(raw_file, "readinto") or not hasattr(raw_file, "seek")
+                or not isinstance(data_offset, int)):
+            return
+        if (getattr(fits_file, "compression", None) is not None
+                or isinstance(hdu, fits.CompImageHDU) or "BLANK" in header):
+            return
+        raw_dtype = BITPIX_DTYPES.get(header.get("BITPIX"))
+        if raw_dtype is None:
+            return
+        raw_dtype = np.dtype(raw_dtype)
+        bscale = header.get("BSCALE", 1)
+        bzero = header.get("BZERO", 0)
+        if bscale == 1 and bzero == 0:
+            self._raw_dtype = raw_dtype
+            self._raw_file = raw_file
+            self._data_offset = data_offset
+        elif (bscale == 1 and raw_dtype.kind == "i" and raw_dtype.itemsize > 1
+              and bzero == 1 << (raw_dtype.itemsize * 8 - 1)):
+            # Unsigned values stored as signed ones, e.g. uint16 with BZERO 32768
+            self._raw_dtype = raw_dtype
+            self._unsigned_dtype = np.dtype("u" + str(raw_dtype.itemsize))
+            self._raw_file = raw_file
+            self._data_offset = data_offset
+
+    def _openHDU(self, path: str, memmap):
+        """ Open the file and get the same HDU fits.getdata() uses """
+        count_io(files_opened=1)
+        self._hdul = fits.open(path, memmap=memmap)
+        hdu = self._hdul[0]
+        if hdu.header.get("NAXIS", 0) == 0 and len(self._hdul) > 1:
+            hdu = self._hdul[1]
+        return hdu
+
+def count_io(files_opened: int=0, bytes_written: int=0):
+    """ Add to the image file operation counters of this process """
+    with _io_lock:
+        _io_stats["files_opened"] += files_opened
+        _io_stats["bytes_written"] += bytes_written
+
+def get_io_stats() -> dict:
+    """ Get the image file operation counters of this process """
+    with _io_lock:
+        return dict(_io_stats)
+
+def reset_io_stats():
+    """ Set the image file operation counters back to zero """
+    with _io_lock:
+        for name in _io_stats:
+            _io_stats[name] = 0
+
+def get_memmap():
+    """ Whether image data is mapped from the files, None leaves it up to astropy """
+    memmap = env.get("MEMMAP")
+    if memmap in ("True", "False"):
+        return memmap == "True"
+    return None
+
+def find_fits_paths(directory: str, recursive: bool) -> List[str]:
+    """ Walk "directory" once and list the fits images in it, sorted by path """
+    img_paths = []
+    dirs = [directory]
+    while dirs:
+        current_dir = dirs.pop()
+        try:
+            with os.scandir(current_dir) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue # Hidden, the same as glob
+                    if entry.is_dir():
+                        if recursive:
+                            dirs.append(entry.path)
+                    elif entry.name.endswith(FITS_EXTENSIONS):
+                        img_paths.append(entry.path)
+        except OSError:
+            if current_dir == directory:
+                raise
+            logger.warning("Failed to open directory: " + current_dir)
+    img_paths.sort()
+    return img_paths
+
+
+def _load_arimg(img_path: str, header_catalog) -> ARImage:
+    """ Create an ARImage, taking its header values from the catalog if it has them """
+    if header_catalog is None:
+        return ARImage(img_path)
+    stat = os.stat(img_path)
+    values = header_catalog.lookup(img_path, stat)
+    if values is None:
+        img = ARImage(img_path)
+        header_catalog.store(img_path, stat, img.getValues())
     else:
-        dir_prefix = directory
+        img = ARImage(img_path, load_values=False)
+        img.setValues(values)
+    return img
+
 
+def find_arimgs_in_dir(directory: str, recursive: bool=True) -> List[ARImage]:
+    """ Find and create ARImage objects for fits images in a "directory" """
     try:
         # Get a list of all files ending in ".fits" and ".fts" in "directory"
-        img_paths = glob.glob(os.path.join(dir_prefix, "*.fits"), recursive=recursive)
-        img_paths.extend(glob.glob(os.path.join(dir_prefix, "*.fts"), recursive=recursive))
+        img_paths = find_fits_paths(directory, recursive)
     except OSError as err:
         logger.error("Failed to open directory: " + directory)
         return None
 
-    for img_path in img_paths:
-        # Load each found fits image as an ARImage and append it to the arimgs list
-        img = ARImage(img_path)
+    # Header values of unchanged images are taken from the catalog, if one is set
+    header_catalog = catalog.get_catalog()
+
+    # Reading headers is mostly waiting on the disk, so read them in parallel.
+    # The images are returned in the same order as img_paths.
+    scan_threads = max(1, env.get_int("SCAN_THREADS", SCAN_THREADS_DEFAULT))
+    with ThreadPoolExecutor(max_workers=min(scan_threads, max(1, len(img_paths)))) as executor:
+        arimgs = list(executor.map(partial(_load_arimg, header_catalog=header_catalog),
+                                   img_paths))
+
+    for img in arimgs:
         logger.info("Found fits image: " + img.getFullPath())
-        arimgs.append(img)
+
+    if header_catalog is not None:
+        header_catalog.commit()
+    logger.info("Found " + str(len(arimgs)) + " fits images in " + directory)
 
     return arimgs
 
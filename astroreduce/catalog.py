@@ -0,0 +1,125 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import os
+import sqlite3
+from threading import Lock
+from typing import Dict
+
+from . import env
+from . import log
+
+logger = log.get_logger()
+
+# Header values kept in the catalog, as named by ARImage.getValues()
+VALUE_NAMES = ("binning", "ccd_temp", "date_obs", "exp_time", "filter", "object_name",
+               "bitpix", "naxis1", "naxis2")
+
+_SCHEMA_VERSION = 2
+_TABLE_NAME = "headers_v" + str(_SCHEMA_VERSION)
+
+_catalogs = {}       # Open catalogs by path
+_catalogs_lock = Lock()
+
+
+class HeaderCatalog:
+    path = None  # Path of the SQLite database
+    _conn = None
+    _lock = None
+
+    def lookup(self, img_path: str, stat: os.stat_result) -> Dict:
+        """ Get the header values of an image, None if it is new or has changed """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, " + ", ".join(VALUE_NAMES)
+                + " FROM " + _TABLE_NAME + " WHERE path = ?",
+                (os.path.abspath(img_path),)).fetchone()
+        if row is None or row[0] != stat.st_size or row[1] != stat.st_mtime_ns:
+            return None
+        return dict(zip(VALUE_NAMES, row[2:]))
+
+    def store(self, img_path: str, stat: os.stat_result, values: Dict):
+        """ Store the header values of an image, keyed by its size and mtime """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO " + _TABLE_NAME + " (path, size, mtime_ns, "
+                + ", ".join(VALUE_NAMES) + ") VALUES (?, ?, ?"
+                + ", ?" * len(VALUE_NAMES) + ")",
+                (os.path.abspath(img_path), stat.st_size, stat.st_mtime_ns)
+                + tuple(values[name] for name in VALUE_NAMES))
+
+    def commit(self):
+        """ Write the stored values to the disk """
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = Lock()
+        # Other processes and hosts may use the same catalog, wait for their locks
+        self._conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        # The value columns have no type so ints, floats and strings are kept as is
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS " + _TABLE_NAME + " ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+            + ", ".join(VALUE_NAMES) + ")")
+        self._conn.commit()
+
+
+def get_catalog() -> HeaderCatalog:
+    """ Get the catalog set by the "HEADER_CATALOG" variable, None if not set """
+    path = env.get("HEADER_CATALOG")
+    if not path:
+        return None
+
+    with _catalogs_lock:
+        catalog = _catalogs.get(path)
+        if catalog is None:
+            try:
+                catalog = HeaderCatalog(path)
+            except sqlite3.Error as err:
+                logger.error("Failed to open header catalog " + path + ": " + str(err))
+                return None
+            logger.info("Using header catalog: " + path)
+            _catalogs[path] = catalog
+    return catalog
+
+
+def close_catalogs():
+    """ Close all open catalogs """
+    with _catalogs_lock:
+        for catalog in _catalogs.values():
+            catalog.close()
+        _catalogs.clear()
@@ -81,6 +81,17 @@ def get(key: str) -> str:
     return value
 
 
+def get_int(key: str, default: int=0) -> int:
+    """ Get the environmental variable with the name "key" as an integer """
+    value = get(key)
+    if value is _VAR_DEFAULT_VAL:
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
 def print_env():
     """ Print all environmental variables, values, and hooks """
     for key, value in _vars.items():
@@ -0,0 +1,117 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+from typing import Dict, Iterable
+
+BLOCK_SIZE = 2880 # FITS files are made of 2880 byte blocks
+CARD_SIZE = 80    # Each header card is 80 bytes
+MAX_HEADER_BLOCKS = 1000
+
+_INT_RE = re.compile(r"^[+-]?\d+$")
+_FLOAT_RE = re.compile(r"^[+-]?(\d+\.?\d*|\.\d+)([EeDd][+-]?\d+)?$")
+
+
+class _Unusual(Exception):
+    """ A card the simple parser doesn't handle, astropy should read the header """
+
+
+def _parse_string(text: str) -> str:
+    """ Parse a quoted string value, with '' for each quote inside it """
+    i = 1
+    while True:
+        end = text.find("'", i)
+        if end < 0:
+            raise _Unusual()
+        if text[end + 1:end + 2] == "'":
+            i = end + 2 # Escaped quote
+            continue
+        value = text[1:end].replace("''", "'")
+        rest = text[end + 1:].strip()
+        if rest and not rest.startswith("/"):
+            raise _Unusual()
+        if value.endswith("&"):
+            raise _Unusual() # Continued on CONTINUE cards
+        return value.rstrip()
+
+
+def _parse_value(text: str):
+    """ Parse the value of a card the same way astropy would """
+    text = text.strip()
+    if text.startswith("'"):
+        return _parse_string(text)
+    value = text.split("/", 1)[0].strip()
+    if value == "T":
+        return True
+    if value == "F":
+        return False
+    if _INT_RE.match(value):
+        return int(value)
+    if _FLOAT_RE.match(value):
+        return float(value.replace("D", "E").replace("d", "e"))
+    # Undefined, complex and anything else
+    raise _Unusual()
+
+
+def read_cards(path: str, keywords: Iterable[str]) -> Dict:
+    """ Read only the given keywords from the primary header of a fits file """
+    # The header is read block by block up to its END card and only the wanted
+    # cards are parsed. Keywords that aren't in the header are None, like
+    # Header.get(). Anything unusual returns None to fall back to astropy.
+    wanted = set(keyword.upper() for keyword in keywords)
+    values = dict((keyword, None) for keyword in wanted)
+    found = set()
+
+    try:
+        with open(path, "rb") as f:
+            for block_num in range(MAX_HEADER_BLOCKS):
+                block = f.read(BLOCK_SIZE)
+                if len(block) < BLOCK_SIZE:
+                    return None # No END card
+                try:
+                    block = block.decode("ascii")
+                except UnicodeDecodeError:
+                    return None # Compressed or not a fits file
+                if block_num == 0 and not block.startswith("SIMPLE  ="):
+                    return None
+                for i in range(0, BLOCK_SIZE, CARD_SIZE):
+                    card = block[i:i + CARD_SIZE]
+                    keyword = card[:8].rstrip()
+                    if keyword == "END":
+                        return values
+                    if keyword not in wanted or keyword in found:
+                        continue
+                    if card[8:10] != "= ":
+                        return None
+                    values[keyword] = _parse_value(card[10:])
+                    found.add(keyword)
+    except (OSError, _Unusual):
+        return None
+    return None
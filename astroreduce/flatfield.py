@@ -29,26 +29,51 @@
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+import copy
 import datetime
 from enum import Enum
+from functools import partial
 import getopt
 import glob
+import json
 import logging
-from typing import Any, Dict, List
+import multiprocessing
+from typing import Any, Callable, Dict, List
 import numpy as np
 import os
+import shutil
 import sys
-from time import sleep
+import tempfile
+import uuid
 
 from . import arimage
 from . import env
+from . import framecache
 from . import jobs
 from . import log
+from . import mastercache
+from . import pipeline
+from . import progress
 
 logger = log.get_logger()
 
 CURRENT_DATE_TIME = datetime.datetime.now().strftime("%y-%m-%dT%H:%M:%S")
 
+COMBINE_MEM_LIMIT_DEFAULT = 512 # MiB used per median combine
+LIGHT_BATCH_SIZE_DEFAULT = 8     # Lights corrected per job
+PIPELINE_DEPTH_DEFAULT = 2       # Lights waiting between the read, correct and write stages
+LIGHT_DEPS_CARD = "ARDEPS"       # Header card holding the inputs a light was corrected from
+CORRECT_VERSION = 2              # Bump when a change to the correction changes its output
+CORRECT_BAND_SIZE = 1 << 16      # Pixels corrected at once, small enough to stay in the cache
+PRECISIONS = ("float32", "float64")   # Float types masters and lights can be computed in
+INT_OUTPUTS = ("int16", "int32")      # Scaled integer types corrected lights can be written as
+LIGHT_CURRENT = "current"       # Status of a light whose output was already up to date
+LIGHT_CORRECTED = "corrected"   # Status of a light that was corrected
+LIGHT_FAILED = "failed"         # Status of a light that couldn't be corrected
+LIGHT_SKIPPED = "skipped"       # Status of a light without matching masters
+
 
 class ImageKind(Enum):
     UNKNOWN = -1
@@ -60,46 +85,176 @@ class ImageKind(Enum):
 
 def update_progress_on_threads(threads):
     """ Update the progress bar based on the number of threads completed """
-    i = 0
-    prog = 0
     end = len(threads)
-    handled = {}
-    update_progress(0)
+    progress.update(0)
 
     logger.debug(str(end) + " threads created")
-    while True: # Check thread status and update the progress bar
-        sleep(0.001)
-        if not threads[i].is_alive() and not bool(handled.get(i)):
-            logger.debug("Thread[" + str(i) + "] finished")
-            handled[i] = True
-            prog += 1
-            update_progress(prog / end)
-            if prog == end:
-                break
-        i += 1
-        if i >= end:
-            i = 0
-
-
-def med_combine(imgs, output_img):
-    """ Median combine fits images """
-    data_in = []
-    for img in imgs:
-        data_in.append(img.loadData())
-    data_out = np.median(data_in, axis=0)
+    # Block on each thread in turn instead of polling them, the bar moves
+    # as soon as the thread being waited on finishes
+    for i, thread in enumerate(threads):
+        thread.join()
+        logger.debug("Thread[" + str(i) + "] finished")
+        progress.update((i + 1) / end)
+    if end == 0:
+        progress.update(1)
+
+
+def _open_frame(img: arimage.ARImage, stack: ExitStack):
+    """ Open an image for reading ranges of its rows """
+    return stack.enter_context(img.openSection())
+
+
+def _frame_reader(section, dark_section=None):
+    """ Get the type of a frame's rows and a function that reads them into a buffer """
+    if dark_section is None:
+        return section.dtype, section.readInto
+
+    # Subtract in the type "frame - dark" has, then store it in the buffer's type
+    frame_dtype = np.result_type(section.dtype, dark_section.dtype)
+    def read_dark_corrected(start, stop, out):
+        if out.dtype == frame_dtype and section.dtype.newbyteorder("=") == frame_dtype:
+            # Read the frame into the buffer and subtract the dark there
+            section.readInto(start, stop, out)
+            np.subtract(out, dark_section[start:stop], out=out, casting="unsafe")
+        else:
+            np.subtract(section[start:stop], dark_section[start:stop], out=out,
+                        dtype=frame_dtype, casting="unsafe")
+    return frame_dtype, read_dark_corrected
+
+
+def _combine_band_rows(shape, num_imgs: int, mem_limit: int, itemsize: int=8,
+                       out_itemsize: int=8) -> int:
+    """ Number of rows to median combine at once while staying under mem_limit """
+    row_size = int(np.prod(shape[1:]))
+    # The band stack, which np.median partitions in place, and the output band
+    row_bytes = row_size * (itemsize * num_imgs + out_itemsize)
+    return max(1, mem_limit // row_bytes)
+
+
+def _open_combine_readers(imgs, darks, stack: ExitStack, dtype=None):
+    """ Open row readers for the images being combined, subtracting darks if given """
+    sections = [_open_frame(img, stack) for img in imgs]
+    shape = sections[0].shape
+    for img, section in zip(imgs, sections):
+        if section.shape != shape:
+            raise ValueError("Cannot median combine images with different shapes: "
+                             + img.getFullPath())
+
+    if darks is None:
+        frame_readers = [_frame_reader(section) for section in sections]
+    else:
+        # darks[i] is the dark for imgs[i], subtract it from each band read
+        dark_sections = {}
+        for dark in darks:
+            if id(dark) not in dark_sections:
+                dark_sections[id(dark)] = _open_frame(dark, stack)
+        frame_readers = [_frame_reader(section, dark_sections[id(dark)])
+                         for section, dark in zip(sections, darks)]
+
+    # The band stack has the type numpy would give a stack of the frames read
+    # on their own, so the combined values are the same
+    if dtype is None:
+        dtype = np.result_type(*[frame_dtype for frame_dtype, read in frame_readers])
+    dtype = np.dtype(dtype).newbyteorder("=")
+    return shape, dtype, [read for frame_dtype, read in frame_readers]
+
+
+def _median_dtype(dtype):
+    """ The type np.median gives for a stack of dtype """
+    dtype = np.dtype(dtype)
+    return dtype if dtype.kind in "fc" else np.dtype(np.float64)
+
+
+def _med_combine_rows(readers, data_out, start: int, stop: int, band_rows: int, dtype):
+    """ Median combine rows start to stop into data_out, one band at a time """
+    # One buffer for the band of every image, each frame is read straight into it
+    band = np.empty((len(readers), min(band_rows, stop - start)) + data_out.shape[1:],
+                    dtype=dtype)
+    for band_start in range(start, stop, band_rows):
+        band_stop = min(band_start + band_rows, stop)
+        band_stack = band[:, :band_stop - band_start]
+        for read, frame_band in zip(readers, band_stack):
+            read(band_start, band_stop, frame_band)
+        np.median(band_stack, axis=0, out=data_out[band_start:band_stop],
+                  overwrite_input=True)
+
+
+def _med_combine_rows_worker(imgs, darks, data_out, start: int, stop: int, band_rows: int,
+                             dtype):
+    """ Median combine rows start to stop in a worker thread with its own files """
+    # Open files can't be shared between threads, each worker opens its own
+    with ExitStack() as stack:
+        readers = _open_combine_readers(imgs, darks, stack, dtype)[2]
+        _med_combine_rows(readers, data_out, start, stop, band_rows, dtype)
+
+
+def get_precision():
+    """ Get the float type set by "PRECISION", None keeps numpy's usual types """
+    precision = env.get("PRECISION")
+    if precision in PRECISIONS:
+        return np.dtype(precision)
+    if precision:
+        logger.warning("Unknown precision \"" + str(precision) + "\", using the default")
+    return None
+
+
+def get_int_output():
+    """ Get the scaled integer type set by "INT_OUTPUT" for corrected lights, or None """
+    int_output = env.get("INT_OUTPUT")
+    if int_output in INT_OUTPUTS:
+        return np.dtype(int_output)
+    if int_output:
+        logger.warning("Unknown integer output \"" + str(int_output) + "\", writing floats")
+    return None
+
+
+def med_combine(imgs, output_img, darks=None, mem_limit: int=0, threads: int=0, dtype=None):
+    """ Median combine fits images one band of rows at a time """
+    if mem_limit <= 0:
+        mem_limit = env.get_int("COMBINE_MEM_LIMIT", COMBINE_MEM_LIMIT_DEFAULT) * 1024 * 1024
+    if threads <= 0:
+        threads = env.get_int("COMBINE_THREADS", multiprocessing.cpu_count())
+
+    with ExitStack() as stack:
+        shape, dtype, readers = _open_combine_readers(imgs, darks, stack, dtype)
+        out_dtype = _median_dtype(dtype)
+        data_out = np.empty(shape, dtype=out_dtype)
+
+        # Only the rows in the current band of every image are held in memory,
+        # each thread works on its own band so the limit is split between them
+        band_rows = _combine_band_rows(shape, len(readers), max(1, mem_limit // threads),
+                                       dtype.itemsize, out_dtype.itemsize)
+
+        # Split the rows between the threads, numpy releases the GIL while
+        # sorting so the bands are combined in parallel
+        num_chunks = max(1, min(threads, -(-shape[0] // band_rows)))
+        chunk_rows = -(-shape[0] // num_chunks)
+        chunks = [(start, min(start + chunk_rows, shape[0]))
+                  for start in range(0, shape[0], chunk_rows)]
+
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=len(chunks) - 1) as executor:
+                futures = [executor.submit(_med_combine_rows_worker, imgs, darks,
+                                           data_out, start, stop, band_rows, dtype)
+                           for start, stop in chunks[1:]]
+                # This thread keeps its files open and combines the first chunk
+                _med_combine_rows(readers, data_out, chunks[0][0], chunks[0][1], band_rows,
+                                  dtype)
+                for future in futures:
+                    future.result()
+        else:
+            _med_combine_rows(readers, data_out, 0, shape[0], band_rows, dtype)
+
     output_img.fits_data = data_out
-    logger.info("Median combined " + str(len(data_in)) + " images to: "
+    logger.info("Median combined " + str(len(readers)) + " images to: "
                 + output_img.getFullPath())
     return output_img
 
 
-def med_combine_new_file(imgs, output_path):
+def med_combine_new_file(imgs, output_path, darks=None, threads: int=0, dtype=None):
     """ Median combine fits images into a new file """
     output_img = arimage.ARImage(output_path, new_file=True)
-    imgs[0].loadHeader()
-    imgs[0].fits_header.tofile(output_path, overwrite=True)
-    imgs[0].unloadHeader()
-    output_img = med_combine(imgs, output_img)
+    output_img = med_combine(imgs, output_img, darks, threads=threads, dtype=dtype)
     return output_img
 
 
@@ -246,117 +401,323 @@ def flat_correct_arimgs(
     return imgs
 
 
-def create_master_dark(darks, output_dir):
-    """ Median combine darks into one file in output_dir """
+def combine_threads_per_group(num_groups: int) -> int:
+    """ Split the cores between the groups that are median combined at once """
+    threads = env.get_int("COMBINE_THREADS", 0)
+    if threads <= 0:
+        threads = max(1, multiprocessing.cpu_count() // max(1, num_groups))
+    return threads
+
+
+def _float_itemsize() -> int:
+    """ Bytes per pixel of the floats masters and corrected lights are computed in """
+    dtype = get_precision()
+    return 8 if dtype is None else dtype.itemsize
+
+
+def combine_mem_estimate(imgs) -> int:
+    """ Estimated bytes a median combine of imgs uses, for the job memory budget """
+    pixels = max(img.getNumPixels() for img in imgs)
+    itemsize = _float_itemsize()
+    # The bands are kept under the combine memory limit, plus the output frame
+    mem_limit = env.get_int("COMBINE_MEM_LIMIT", COMBINE_MEM_LIMIT_DEFAULT) * 1024 * 1024
+    return min(len(imgs) * pixels * itemsize, mem_limit) + pixels * itemsize
+
+
+def lights_mem_estimate(imgs) -> int:
+    """ Estimated bytes correcting a batch of lights uses, for the job memory budget """
+    # Raw lights and output buffers of the lights in flight in the pipeline
+    depth = max(0, env.get_int("PIPELINE_DEPTH", PIPELINE_DEPTH_DEFAULT))
+    in_flight = min(len(imgs), depth + 2)
+    return sum(img.getNumPixels() * (abs(img.bitpix) // 8 + _float_itemsize())
+               for img in imgs[:in_flight])
+
+
+def frames_cost(imgs) -> int:
+    """ Estimated work of a job over imgs, for ordering the jobs """
+    return sum(img.getNumPixels() for img in imgs)
+
+
+def _precision_params(dtype) -> Dict:
+    """ Combine parameters for the master cache key, empty for the default precision """
+    if dtype is None:
+        return {}
+    return {"precision": dtype.name}
+
+
+def reuse_master(path: str, key: str) -> bool:
+    """ True if the master at "path" is up to date or was copied from the cache """
+    if mastercache.is_current(path, key):
+        logger.info("Master is already up to date: " + path)
+        return True
+    return mastercache.fetch(key, path)
+
+
+def master_fingerprint(master) -> str:
+    """ Identify a master, by the key in its header if it is still in memory """
+    if master.fits_header is not None and master.fits_header.get(mastercache.KEY_CARD):
+        return master.fits_header[mastercache.KEY_CARD]
+    return mastercache.master_fingerprint(master.getFullPath())
+
+
+def keep_master(master, share_dir: str=None) -> arimage.ARImage:
+    """ Keep a just built master in memory, read-only, for the steps that use it """
+    # Read-only also stops saveToDisk() from byte swapping it in place
+    # while other jobs read it
+    master.fits_data.flags.writeable = False
+    if share_dir is not None:
+        # Worker processes map it from share_dir without copying
+        master.shareData(share_dir)
+    return master
+
+
+def write_master(master, key: str=None) -> arimage.ARImage:
+    """ Write a master built in memory to disk and the master cache """
+    # Masters that were reused are already on disk and aren't loaded
+    if master is None or master.fits_data is None:
+        return master
+    if key is None:
+        key = master.fits_header[mastercache.KEY_CARD]
+    master.saveToDisk()
+    mastercache.store(key, master.getFullPath())
+    logger.info("Wrote master: " + master.getFullPath())
+    return master
+
+
+def push_write_master_job(master_job, write_jobs: List=None) -> jobs.Job:
+    """ Push a job writing a master once it is built, nothing waits for it but the run """
+    job = jobs.Job(target=write_master, args=(master_job,))
+    jobs.push_job(job)
+    if write_jobs is not None:
+        write_jobs.append(job)
+    return job
+
+
+def release_built_master(master_job, write_job, job=None):
+    """ Free a master built in memory and drop it from the jobs that returned it """
+    # Called in this process, the master may have been built in a worker
+    if master_job.return_val is not None:
+        master_job.return_val.unloadData()
+    master_job.return_val = None
+    write_job.return_val = None
+
+
+def masters_released():
+    """ Target of the jobs freeing the masters, their callback frees them here """
+
+
+def push_release_master_jobs(write_jobs: List, users: List) -> List:
+    """ Push a job for each master being built that frees it once nothing uses it """
+    # Each waits for the master to be written and for every job using it.
+    # The callback runs even if one of them failed, so the master is always freed.
+    release_jobs = []
+    for write_job in write_jobs:
+        master_job = write_job.args[0]
+        job = jobs.Job(target=masters_released,
+                       deps=[write_job] + [user for user in users if master_job in user.deps],
+                       callback=partial(release_built_master, master_job, write_job))
+        jobs.push_job(job)
+        release_jobs.append(job)
+    return release_jobs
+
+
+def master_dark_path(exp_time, output_dir) -> str:
+    """ Get the path of the master dark for darks of exp_time """
+    return os.path.join(output_dir, "MDark-Exp" + str(exp_time).replace(".", "s") + ".fts")
+
+
+def master_flat_path(flat_filter: str, output_dir) -> str:
+    """ Get the path of the master flat for flats in flat_filter """
+    return os.path.join(output_dir, "MFlat-" + flat_filter + ".fts")
+
+
+def create_master_dark(darks, output_dir, threads: int=0, share_dir: str=None,
+                       write: bool=True) -> arimage.ARImage:
+    """ Median combine darks into one file in output_dir, returns the master dark """
     if not bool(darks):
         logger.error("No darks available to create master dark")
-        return
+        return None
+
+    path = master_dark_path(darks[0].exp_time, output_dir)
 
-    # Create the file name
-    path = os.path.join(output_dir, "MDark-Exp"
-                        + str(darks[0].exp_time).replace(".", "s") + ".fts")
+    # Skip the combine if the same darks were already combined
+    dtype = get_precision()
+    key = mastercache.master_key("dark", [dark.getFullPath() for dark in darks],
+                                 _precision_params(dtype))
+    if reuse_master(path, key):
+        return arimage.ARImage(path)
 
     # Median combine
-    mdark = med_combine_new_file(darks, path)
+    mdark = med_combine_new_file(darks, path, threads=threads, dtype=dtype)
     arimage.unload_data_arimgs(darks)
 
-    # Save
+    # Keep it in memory for the flats and lights, the file is only written
+    # for the next run unless "write" is False and a job does it later
     mdark.copyValues(darks[0])
-    mdark.saveToDisk()
-    mdark.unloadData()
+    mdark.fits_header[mastercache.KEY_CARD] = key
+    keep_master(mdark, share_dir)
+    if write:
+        write_master(mdark, key)
     logger.info("Created master dark with exp_time=" + str(darks[0].exp_time)
                 + ": " + path)
+    return mdark
 
 
-def create_master_darks(darks_sorted: Dict, output_dir: str):
-    """ Create the master dark images from sorted darks """
+def push_master_dark_jobs(darks_sorted: Dict, output_dir: str,
+                          share_dir: str=None, write_jobs: List=None) -> Dict[int, List]:
+    """ Push a job for each master dark, returns the jobs sorted like the darks """
+    mdark_jobs = {}
     if not bool(darks_sorted):
         logger.warning("No darks are available to median combine")
-        return
-
-    for darks in darks_sorted.values():
-        # Create a job thread for each group of darks
-        job = jobs.Job(target=create_master_dark, args=(darks, output_dir))
+        return mdark_jobs
+
+    threads = combine_threads_per_group(len(darks_sorted))
+    for et, darks in darks_sorted.items():
+        # Create a job for each group of darks, the next steps get the
+        # master from it in memory while another job writes it to disk
+        job = jobs.Job(target=create_master_dark,
+                       args=(darks, output_dir, threads, share_dir, False),
+                       mem=combine_mem_estimate(darks), cost=frames_cost(darks),
+                       frames=len(darks))
         jobs.push_job(job)
+        push_write_master_job(job, write_jobs)
+        mdark_jobs[et] = [job]
+    return mdark_jobs
+
+
+def create_master_darks(darks_sorted: Dict, output_dir: str):
+    """ Create the master dark images from sorted darks """
+    if not bool(push_master_dark_jobs(darks_sorted, output_dir)):
+        return
 
     # Start processing the job queue and wait
     jobs.start_jobs()
     jobs.wait_done()
 
 
-def dark_correct_flats(flats, mdarks_dic):
-    """ Dark correct the flat images """
-    if not bool(flats):
-        logger.warning("No flats are available to dark correct")
-        return
-    if not bool(mdarks_dic):
-        logger.warning("No master darks available to dark correct flats for filter="
-                       + flats[0].filter)
-        return
+def match_flats_to_darks(flats, mdarks_dic):
+    """ Find the master dark for each flat, dropping flats without one """
+    matched_flats = []
+    matched_darks = []
     for flat in flats:
         et = int(round(flat.exp_time))
         mdark = mdarks_dic.get(et)
-        if mdark == None:
+        if mdark == None or mdark[0] is None:
             # No dark found with required exposure time, ignore this flat
             logger.warning("Dropping flat without matching dark (exp_time="
                            + str(et) + "): " + flat.getFullPath())
-            flat.unloadData()
-            flats.remove(flat)
             continue
-        dark_correct_arimg(flat, mdark[0])
-    return flats
+        matched_flats.append(flat)
+        matched_darks.append(mdark[0])
+    return matched_flats, matched_darks
 
 
-def create_master_flat(flats, mdarks_dic, output_dir):
-    """ Dark correct and median combine flats into one file in output_dir """
+def create_master_flat(flats, mdarks_dic, output_dir, threads: int=0, share_dir: str=None,
+                       write: bool=True) -> arimage.ARImage:
+    """ Dark correct and median combine flats into one file, returns the master flat """
     if not bool(flats):
         logger.error("No flats available to create master flat")
-        return
+        return None
 
-    # Create the file name
-    path = os.path.join(output_dir, "MFlat-" + flats[0].filter + ".fts")
+    path = master_flat_path(flats[0].filter, output_dir)
+
+    # Match each flat to a master dark, they are dark corrected as they are combined
+    darks = None
+    if not bool(mdarks_dic):
+        logger.warning("No master darks available to dark correct flats for filter="
+                       + flats[0].filter)
+    else:
+        flats, darks = match_flats_to_darks(flats, mdarks_dic)
+        if not bool(flats):
+            logger.error("No flats with matching master darks to create master flat")
+            return None
+
+    # Skip the combine if the same flats were already combined with the same darks
+    mdark_keys = sorted(set(master_fingerprint(dark) for dark in darks or []))
+    dtype = get_precision()
+    params = _precision_params(dtype)
+    params["darks"] = mdark_keys
+    key = mastercache.master_key("flat", [flat.getFullPath() for flat in flats], params)
+    if reuse_master(path, key):
+        return arimage.ARImage(path)
 
-    # Dark correct the flats
-    dark_correct_flats(flats, mdarks_dic)
     # Median combine to a new fits image
-    mflat = med_combine_new_file(flats, path)
+    mflat = med_combine_new_file(flats, path, darks, threads, dtype)
     # Free up memory
     arimage.unload_data_arimgs(flats)
 
-    # Normalize
+    # Normalize, in place so the combine's type is kept
     data = mflat.fits_data
-    mflat.fits_data = data / np.median(data)
+    data /= np.median(data)
 
     # Copy important header values
     mflat.copyValues(flats[0])
     mflat.img_type = ImageKind.FLAT
 
-    # Save new master flat to disk and free up memory
-    mflat.saveToDisk()
-    mflat.unloadData()
+    # Keep it in memory for the lights, see create_master_dark()
+    mflat.fits_header[mastercache.KEY_CARD] = key
+    keep_master(mflat, share_dir)
+    if write:
+        write_master(mflat, key)
     logger.info("Created master flat for filter=" + flats[0].filter + ": "
                 + path)
+    return mflat
 
 
-def create_master_flats(flats_dic, mdarks_dic, output_dir):
-    """ Create the master flat images """
+def push_master_flat_jobs(flats_dic, mdarks_dic, output_dir,
+                          share_dir: str=None, write_jobs: List=None) -> Dict[str, List]:
+    """ Push a job for each master flat, returns the jobs sorted like the flats """
+    mflat_jobs = {}
     if not bool(flats_dic):
         logger.warning("No flats are available to median combine")
-        return
-
-    for flats in flats_dic.values():
-        # Create a job thread for each group of flats
+        return mflat_jobs
+
+    threads = combine_threads_per_group(len(flats_dic))
+    for fl, flats in flats_dic.items():
+        # Only the master darks these flats need, so the job waits for just
+        # those if they are still being built
+        group_mdarks = mdarks_dic
+        if bool(mdarks_dic):
+            group_mdarks = {}
+            for flat in flats:
+                et = int(round(flat.exp_time))
+                if et in mdarks_dic:
+                    group_mdarks[et] = mdarks_dic[et]
+            if not bool(group_mdarks):
+                logger.error("No flats with matching master darks to create master flat"
+                             + " for filter=" + fl)
+                continue
+
+        # Create a job for each group of flats, written like the master darks
         job = jobs.Job(target=create_master_flat,
-                       args=(flats, mdarks_dic, output_dir))
+                       args=(flats, group_mdarks, output_dir, threads, share_dir, False),
+                       mem=combine_mem_estimate(flats), cost=frames_cost(flats),
+                       frames=len(flats))
         jobs.push_job(job)
+        push_write_master_job(job, write_jobs)
+        mflat_jobs[fl] = [job]
+    return mflat_jobs
+
+
+def create_master_flats(flats_dic, mdarks_dic, output_dir):
+    """ Create the master flat images """
+    if not bool(push_master_flat_jobs(flats_dic, mdarks_dic, output_dir)):
+        return
 
     # Start processing the job queue and wait
     jobs.start_jobs()
     jobs.wait_done()
 
 
-def create_corrected_img(key, imgs, mdarks_dic, mflats_dic, output_dir, stack=False):
-    on = key[0] # Object name
+def overlay_masters(masters_dic, built_dic) -> Dict:
+    """ Masters already on disk, replaced by the ones being built with the same key """
+    masters = dict(masters_dic or {})
+    masters.update(built_dic or {})
+    return masters
+
+
+def find_light_masters(key, imgs, mdarks_dic, mflats_dic):
+    """ Find the master dark and flat for a group of lights, None if skipped """
     et = key[1] # Exposure time
     fl = key[2] # Filter
     mdark = None
@@ -368,7 +729,7 @@ def create_corrected_img(key, imgs, mdarks_dic, mflats_dic, output_dir, stack=Fa
         if mdark == None: # No dark was found with the correct exposure time
             logger.warning("Skipping image with no matching master dark (exp_time="
                            + str(et) + "): " + imgs[0].getFullPath())
-            return
+            return None
         else:
             mdark = mdark[0] # Get the first master dark in list
 
@@ -378,50 +739,311 @@ def create_corrected_img(key, imgs, mdarks_dic, mflats_dic, output_dir, stack=Fa
         if mflat == None: # No flat was found with the correct filter
             logger.warning("Skipping image with no matching master flat(filter="
                            + fl + "): " + imgs[0].getFullPath())
-            return
+            return None
         else:
             mflat = mflat[0]
 
-    i = 0
-    for img in imgs: # Copy the raw light to a new file, then (dark correct and flat correct
-        file_path = os.path.join(output_dir, on
-            + "-" + img.date_obs.replace("-", "").replace("T", "at").replace(":", "")
-            + "-Temp" + str(int(round(img.ccd_temp))).replace("-", "m")
-            + "-Bin" + str(img.binning)
-            + "-Exp" + str(et).replace(".", "s")
-            + "-" + fl
-            + ".fts")
-        cimg = arimage.ARImage(file_path, new_file=True)
-        cimg.fits_header = img.fits_header
-        cimg.loadValues()
-        if mdark is not None:
-            dark_correct_arimg(img, mdark)
+    return mdark, mflat
+
+
+def light_masters_key(mdark, mflat) -> str:
+    """ Identify the masters a group of lights is corrected with """
+    precision = get_precision()
+    int_output = get_int_output()
+    return json.dumps([
+        CORRECT_VERSION,
+        None if precision is None else precision.name,
+        None if int_output is None else int_output.name,
+        None if mdark is None else master_fingerprint(mdark),
+        None if mflat is None else master_fingerprint(mflat),
+    ])
+
+
+def is_light_current(img, file_path: str, deps_key: str) -> bool:
+    """ True if the corrected light at "file_path" doesn't need to be rebuilt """
+    if env.get("FORCE") == "True":
+        return False
+    try:
+        output_mtime = os.stat(file_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+    # Rebuild if the light is newer than the output, like make. The masters
+    # are compared by their keys below, their files can still be being
+    # written after the lights
+    if os.stat(img.getFullPath()).st_mtime_ns > output_mtime:
+        return False
+
+    # or if any input is different from the ones it was built from
+    return mastercache.read_key(file_path, LIGHT_DEPS_CARD) == deps_key
+
+
+class LightTask:
+    img = None          # Raw light
+    key = None          # (object name, exposure time, filter) of the light's group
+    mdark = None        # Master dark to correct with, or None
+    mflat = None        # Master flat to correct with, or None
+    dark = None         # Data of mdark, shared read-only
+    inv_flat = None     # 1 / flat of mflat, shared read-only, see read_inverse_flat()
+    file_path = None    # Corrected light output path
+    deps_key = None     # Key of the inputs the output is built from
+    data = None         # Corrected data, a buffer from "pool"
+    pool = None         # Buffers for the corrected data
+
+    def __init__(self, img, key, mdark, mflat):
+        self.img = img
+        self.key = key
+        self.mdark = mdark
+        self.mflat = mflat
+
+
+def light_output_path(img, key, output_dir) -> str:
+    """ Get the path a light of the group "key" is corrected to """
+    on = key[0] # Object name
+    et = key[1] # Exposure time
+    fl = key[2] # Filter
+    return os.path.join(output_dir, on
+        + "-" + img.date_obs.replace("-", "").replace("T", "at").replace(":", "")
+        + "-Temp" + str(int(round(img.ccd_temp))).replace("-", "m")
+        + "-Bin" + str(img.binning)
+        + "-Exp" + str(et).replace(".", "s")
+        + "-" + fl
+        + ".fts")
+
+
+def plan_light(img, key, mdark, mflat, output_dir, masters_key: str=None) -> LightTask:
+    """ Get the task to correct one light, None if the output is already up to date """
+    task = LightTask(img, key, mdark, mflat)
+    task.file_path = light_output_path(img, key, output_dir)
+
+    # Skip lights that were already corrected with the same masters
+    if masters_key is None:
+        masters_key = light_masters_key(mdark, mflat)
+    task.deps_key = mastercache.master_key(
+        "light", [img.getFullPath()], {"masters": masters_key})
+    if is_light_current(img, task.file_path, task.deps_key):
+        logger.info("Corrected image is already up to date: " + task.file_path)
+        return None
+    return task
+
+
+def read_light(task: LightTask) -> LightTask:
+    """ Load the raw light's data """
+    task.img.loadData()
+    return task
+
+
+def correct_data(raw, dark, inv_flat, out):
+    """ Compute (raw - dark) * inv_flat into "out" without any temporary arrays """
+    # Work through the frame a band of rows at a time so both steps happen
+    # while the band is still in the cache
+    row_size = max(1, int(np.prod(raw.shape[1:])))
+    band_rows = max(1, CORRECT_BAND_SIZE // row_size)
+    for start in range(0, raw.shape[0], band_rows):
+        stop = start + band_rows
+        band_out = out[start:stop]
+        if dark is not None:
+            np.subtract(raw[start:stop], dark[start:stop], out=band_out)
         else:
-            logger.warning("No dark image found for light: " + cimg.getFullPath())
-        if mflat is not None:
-            flat_correct_arimg(img, mflat)
+            np.copyto(band_out, raw[start:stop])
+        if inv_flat is not None:
+            np.multiply(band_out, inv_flat[start:stop], out=band_out)
+    return out
+
+
+def inverse_flat(mflat, dtype=None):
+    """ Get a copy of a master flat holding 1 / flat, so lights are multiplied by it """
+    unload_after = mflat.fits_data is None
+    iflat = copy.copy(mflat)
+    iflat.shared_path = None
+    iflat.fits_data = np.divide(1.0, mflat.loadData(), dtype=dtype)
+    iflat.fits_data.flags.writeable = False
+    if unload_after:
+        mflat.unloadData()
+    return iflat
+
+
+def read_master(master) -> np.ndarray:
+    """ Get a master's data as a read-only array for the light jobs to share """
+    data = master.fits_data
+    if data is None:
+        # Read into a new image so the master itself is left as it is
+        data = arimage.ARImage(master.getFullPath(), load_values=False).loadData()
+    data = data.view()
+    data.flags.writeable = False
+    return data
+
+
+def read_inverse_flat(mflat) -> np.ndarray:
+    """ Get 1 / flat of a master flat as a read-only array, lights are multiplied by it """
+    data = np.divide(1.0, read_master(mflat), dtype=get_precision())
+    data.flags.writeable = False
+    return data
+
+
+def _light_masters_data(mdark, mflat, iflat=None, frame_keys=None):
+    """ Get the dark and 1 / flat data to correct lights with, see correct_lights() """
+    dark_key, iflat_key = frame_keys or (None, None)
+    cache = framecache.get_cache()
+    dark = None
+    inv_flat = None
+    if mdark is not None:
+        if dark_key is not None:
+            dark = cache.get(dark_key, partial(read_master, mdark))
         else:
-            logger.warning("No flat image found for light: " + cimg.getFullPath())
-        cimg.fits_data = img.fits_data
-        cimg.saveToDisk()
-        cimg.unloadData()
-        img.unloadData()
-        logger.info("Corrected image with exp_time=" + str(et)
-                    + " and filter=" + fl + ": " + img.getFullPath())
-        i += 1
+            # Mapped if the master was shared with this worker process
+            dark = mdark.loadData()
+    if mflat is not None:
+        if iflat_key is not None:
+            inv_flat = cache.get(iflat_key, partial(read_inverse_flat, mflat))
+        elif iflat is not None:
+            inv_flat = iflat.fits_data
+        else:
+            inv_flat = read_inverse_flat(mflat)
+    return dark, inv_flat
+
+
+def correct_light_data(task: LightTask) -> LightTask:
+    """ Dark and flat correct the loaded raw light into a buffer from the pool """
+    raw = task.img.fits_data
+    dark = task.dark
+    inv_flat = task.inv_flat
+    if task.mdark is None:
+        logger.warning("No dark image found for light: " + task.file_path)
+    if task.mflat is None:
+        logger.warning("No flat image found for light: " + task.file_path)
+
+    dtype = get_precision()
+    if dtype is None:
+        dtype = np.result_type(*[array.dtype for array in (raw, dark, inv_flat)
+                                 if array is not None])
+    task.data = correct_data(raw, dark, inv_flat, task.pool.get(raw.shape, dtype))
+    task.img.unloadData()
+    return task
+
+
+def write_light(task: LightTask) -> LightTask:
+    """ Write the corrected light to its new file """
+    img = task.img
+    cimg = arimage.ARImage(task.file_path, new_file=True)
+    if img.fits_header is not None:
+        # Read along with the data, the corrected light keeps the raw header
+        cimg.fits_header = img.fits_header.copy()
+        cimg.loadValues()
+    else:
+        cimg.copyValues(img)
+    # The raw header was only kept for this copy
+    img.unloadHeader()
+    cimg.fits_data = task.data
+    cimg.fits_header[LIGHT_DEPS_CARD] = task.deps_key
+    cimg.saveToDisk(get_int_output())
+    cimg.unloadData()
+
+    # The buffer can be reused for the next light
+    task.pool.put(task.data)
+    task.data = None
+    logger.info("Corrected image with exp_time=" + str(task.key[1])
+                + " and filter=" + task.key[2] + ": " + img.getFullPath())
+    return task
+
+
+def light_frames(imgs, planned, done, key, output_dir) -> List:
+    """ Get the (raw path, output path, status) of each light in a batch """
+    frames = []
+    for img, task in zip(imgs, planned):
+        if task is None:
+            frames.append((img.getFullPath(), light_output_path(img, key, output_dir),
+                           LIGHT_CURRENT))
+        elif task in done:
+            frames.append((img.getFullPath(), task.file_path, LIGHT_CORRECTED))
+        else:
+            frames.append((img.getFullPath(), task.file_path, LIGHT_FAILED))
+    return frames
+
+
+def correct_lights(imgs, key, mdark, mflat, output_dir, masters_key: str=None, iflat=None,
+                   frame_keys=None):
+    """ Correct a batch of lights from the same group, returns (reused, recomputed, frames) """
+    # frame_keys are the frame cache keys of the dark and 1 / flat, which
+    # this batch reserved and releases once it is done. frames holds the
+    # (raw path, output path, status) of each light, see LIGHT_CORRECTED.
+    try:
+        if masters_key is None:
+            masters_key = light_masters_key(mdark, mflat)
+        planned = [plan_light(img, key, mdark, mflat, output_dir, masters_key)
+                   for img in imgs]
+        tasks = [task for task in planned if task is not None]
+        if not bool(tasks):
+            return len(imgs), 0, light_frames(imgs, planned, [], key, output_dir)
+
+        # The next lights are read and the last ones written while one is corrected
+        depth = env.get_int("PIPELINE_DEPTH", PIPELINE_DEPTH_DEFAULT)
+        if len(tasks) < 2:
+            depth = 0
+        # Enough output buffers for every light between the correct and write stages
+        pool = pipeline.BufferPool(max(0, depth) + 2)
+        dark, inv_flat = _light_masters_data(mdark, mflat, iflat, frame_keys)
+        for task in tasks:
+            task.dark = dark
+            task.inv_flat = inv_flat
+            task.pool = pool
+        done = pipeline.run_pipeline(tasks, [read_light, correct_light_data, write_light],
+                                     depth)
+        return (len(imgs) - len(done), len(done),
+                light_frames(imgs, planned, done, key, output_dir))
+    finally:
+        for frame_key in frame_keys or ():
+            if frame_key is not None:
+                framecache.get_cache().release(frame_key)
+
+
+def load_master(master, share_dir: str=None) -> arimage.ARImage:
+    """ Load a master for the light jobs to share read-only, through share_dir if given """
+    if share_dir is not None:
+        # Worker processes map it from share_dir without copying
+        master.shareData(share_dir)
+    else:
+        master.loadData().flags.writeable = False
+    return master
 
 
-def create_corrected_images(
+def load_inverse_flat(mflat, share_dir: str=None) -> arimage.ARImage:
+    """ Get 1 / flat of a master flat for the light jobs to share, see load_master() """
+    iflat = inverse_flat(mflat, get_precision())
+    if share_dir is not None:
+        iflat.shareData(share_dir)
+    return iflat
+
+
+def _push_master_job(master_jobs: Dict, target: Callable, master, share_dir: str,
+                     pixels: int):
+    """ Push a job running target on a master, once for each master """
+    key = (target, id(master))
+    if key not in master_jobs:
+        master_jobs[key] = jobs.Job(target=target, args=(master, share_dir),
+                                    mem=pixels * _float_itemsize(), cost=pixels)
+        jobs.push_job(master_jobs[key])
+    return master_jobs[key]
+
+
+def push_corrected_image_jobs(
         imgs_dic,
         mdarks_dic,
         mflats_dic,
         output_dir,
-        stack=False):
-    """ Dark and flat corrects light images, stacking is not implemented yet """
-    # TODO: Place all images into a dictionary with key=object_name and return the dictionary for stacking
+        stack=False,
+        share_dir=None,
+        callback=None):
+    """ Push the jobs that correct light images, returns (light jobs, master jobs, frame keys) """
+    # callback is called with each light job once it has finished, see Job
+    # The masters can be jobs that are still building them, each group of
+    # lights waits for just its own master dark and flat
+    light_jobs = []
+    master_jobs = {}
+    frame_keys = {}
     if not bool(imgs_dic):
         logger.error("No images available to correct")
-        return
+        return light_jobs, [], []
     no_run = 0
     if not bool(mdarks_dic):
         logger.warning("No master darks available")
@@ -431,53 +1053,204 @@ def create_corrected_images(
         no_run += 1
     if no_run > 1:
         logger.warning("No corrections possible, skipping all light images")
-        return
+        return light_jobs, [], []
 
+    # Load each master once. The job threads share them read-only through
+    # the frame cache, which drops them when the last batch using them is
+    # done. Worker processes map them from share_dir without copying, if
+    # there is no share_dir each job loads its own copy. The lights only
+    # need 1 / flat, so that is what is kept of the master flat.
+    backend = jobs.get_backend()
+    cache = framecache.get_cache()
+
+    batch_size = max(1, env.get_int("LIGHT_BATCH_SIZE", LIGHT_BATCH_SIZE_DEFAULT))
     for key, imgs in imgs_dic.items():
-        # Create a job thread for each group of lights
-        job = jobs.Job(target=create_corrected_img, args=(key, imgs, mdarks_dic, mflats_dic, output_dir))
-        jobs.push_job(job)
+        masters = find_light_masters(key, imgs, mdarks_dic, mflats_dic)
+        if masters is None:
+            continue
 
-    # Start processing the job queue and wait
-    jobs.start_jobs()
-    jobs.wait_done()
+        mdark, mflat = masters
+        iflat = None
+        group_keys = None
+        if backend == jobs.BACKEND_THREAD:
+            group_keys = (_frame_key(frame_keys, "dark", mdark),
+                          _frame_key(frame_keys, "iflat", mflat))
+        elif share_dir is not None:
+            if mdark is not None and (isinstance(mdark, jobs.Job) or mdark.fits_data is None):
+                mdark = _push_master_job(master_jobs, load_master, mdark, share_dir,
+                                         imgs[0].getNumPixels())
+            if mflat is not None:
+                iflat = _push_master_job(master_jobs, load_inverse_flat, mflat, share_dir,
+                                         imgs[0].getNumPixels())
+
+        for i in range(0, len(imgs), batch_size):
+            # Create a job for each small batch of lights so one long
+            # sequence of a single object is spread over every thread
+            batch = imgs[i:i + batch_size]
+            for frame_key in group_keys or ():
+                if frame_key is not None:
+                    cache.reserve(frame_key)
+            job = jobs.Job(target=correct_lights,
+                           args=(batch, key, mdark, mflat, output_dir, None, iflat,
+                                 group_keys),
+                           mem=lights_mem_estimate(batch), cost=frames_cost(batch),
+                           frames=len(batch), callback=callback)
+            jobs.push_job(job)
+            light_jobs.append(job)
+
+    return light_jobs, list(master_jobs.values()), list(frame_keys.values())
+
+
+def _frame_key(frame_keys: Dict, kind: str, master) -> str:
+    """ Get the frame cache key of a master, the same one for each group using it """
+    if master is None:
+        return None
+    if id(master) not in frame_keys:
+        frame_keys[id(master)] = kind + "-" + uuid.uuid4().hex
+    return frame_keys[id(master)]
+
+
+def finish_corrected_images(light_jobs, master_jobs, frame_keys=()):
+    """ Free the shared masters and count the corrected lights, returns (reused, recomputed) """
+    arimage.unload_data_arimgs([job.return_val for job in master_jobs
+                                if job.return_val is not None])
+    # Skipped batches never released their frames
+    cache = framecache.get_cache()
+    for frame_key in frame_keys:
+        cache.drop(frame_key)
+    cache_stats = cache.getStats()
+    logger.info("Master frame cache: " + str(cache_stats["hits"]) + " hits, "
+                + str(cache_stats["misses"]) + " misses")
+
+    reused = 0
+    recomputed = 0
+    for job in light_jobs:
+        if job.return_val is not None:
+            reused += job.return_val[0]
+            recomputed += job.return_val[1]
+    print ("Reused " + str(reused) + " up to date light images, recomputed "
+           + str(recomputed))
+    logger.info("Reused " + str(reused) + " up to date light images, recomputed "
+                + str(recomputed))
+    return reused, recomputed
 
 
-def reduce(
-        darks_dir="./darks",
-        mdarks_dir="./mdarks",
-        flats_dir="./flats",
-        mflats_dir="./mflats",
-        raw_dir="./lights",
-        output_dir="./output",
+def create_corrected_images(
+        imgs_dic,
+        mdarks_dic,
+        mflats_dic,
+        output_dir,
         stack=False,
-        level=0):
+        share_dir=None):
+    """ Dark and flat corrects light images, stacking is not implemented yet """
+    # TODO: Place all images into a dictionary with key=object_name and return the dictionary for stacking
+    light_jobs, master_jobs, frame_keys = push_corrected_image_jobs(
+        imgs_dic, mdarks_dic, mflats_dic, output_dir, stack, share_dir)
+    if not bool(light_jobs) and not bool(master_jobs):
+        return
+
+    # Start processing the job queue and wait
+    jobs.start_jobs()
+    jobs.wait_done()
+    return finish_corrected_images(light_jobs, master_jobs, frame_keys)
+
+
+def create_share_dir() -> str:
+    """ Create a directory for sharing image data between processes """
+    # Prefer memory backed storage, the "SHARE_DIR" variable overrides it
+    parent_dir = env.get("SHARE_DIR")
+    if not parent_dir:
+        parent_dir = None
+        if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            parent_dir = "/dev/shm"
+    return tempfile.mkdtemp(prefix="astroreduce-", dir=parent_dir)
+
+
+def push_master_jobs(
+        darks_dir,
+        mdarks_dir,
+        flats_dir,
+        mflats_dir,
+        level=0,
+        share_dir=None,
+        write_jobs: List=None):
+    """ Push the jobs building the masters, returns (master darks, master flats) """
+    # The jobs writing the masters are added to write_jobs if it is given
+    # Masters already on disk are used for anything that isn't being built
+    mdarks = arimage.find_arimgs_in_dir(mdarks_dir)
+    mdarks_sorted = sort_arimgs_as_kind(mdarks, ImageKind.DARK)
     if level < 1:
         # Create master darks
         print ("Creating master darks in " + mdarks_dir + " from " + darks_dir)
         darks = arimage.find_arimgs_in_dir(darks_dir)
         darks_sorted = sort_arimgs_as_kind(darks, ImageKind.DARK)
-        create_master_darks(darks_sorted, mdarks_dir)
-
-    # Find master darks and sort
-    mdarks = arimage.find_arimgs_in_dir(mdarks_dir)
-    mdarks_sorted = sort_arimgs_as_kind(mdarks, ImageKind.DARK)
+        mdarks_sorted = overlay_masters(mdarks_sorted,
+                                        push_master_dark_jobs(darks_sorted, mdarks_dir,
+                                                              share_dir, write_jobs))
 
+    mflats = arimage.find_arimgs_in_dir(mflats_dir)
+    mflats_sorted = sort_arimgs_as_kind(mflats, ImageKind.FLAT)
     if level < 2:
         # Create master flats
         print ("Creating master flats in " + mflats_dir + " from " + flats_dir)
         flats = arimage.find_arimgs_in_dir(flats_dir)
         flats_sorted = sort_arimgs_as_kind(flats, ImageKind.FLAT)
-        create_master_flats(flats_sorted, mdarks_sorted, mflats_dir)
+        mflats_sorted = overlay_masters(mflats_sorted,
+                                        push_master_flat_jobs(flats_sorted, mdarks_sorted,
+                                                              mflats_dir, share_dir,
+                                                              write_jobs))
+    return mdarks_sorted, mflats_sorted
 
-    mflats = arimage.find_arimgs_in_dir(mflats_dir)
-    mflats_sorted = sort_arimgs_as_kind(mflats, ImageKind.FLAT)
 
-    # Find and correct the light images
-    raw_lights = arimage.find_arimgs_in_dir(raw_dir)
-    raw_sorted = sort_arimgs_as_kind(raw_lights, ImageKind.LIGHT)
-    print ("Correcting light images from " + raw_dir)
-    print ("             with darks from " + mdarks_dir)
-    print ("              and flats from " + mflats_dir)
-    create_corrected_images(raw_sorted, mdarks_sorted, mflats_sorted,
-                            output_dir, stack)
+def reduce(
+        darks_dir="./darks",
+        mdarks_dir="./mdarks",
+        flats_dir="./flats",
+        mflats_dir="./mflats",
+        raw_dir="./lights",
+        output_dir="./output",
+        stack=False,
+        level=0):
+    arimage.reset_io_stats()
+
+    # Everything is pushed as one graph of jobs: each master flat waits for
+    # the master darks it needs and each group of lights for its master dark
+    # and flat, so nothing waits for a whole step to finish. Just built
+    # masters are handed on in memory and written to disk by their own jobs.
+    # Worker processes share the masters through files in share_dir.
+    share_dir = None
+    if jobs.get_backend() == jobs.BACKEND_PROCESS:
+        share_dir = create_share_dir()
+
+    try:
+        write_jobs = []
+        mdarks_sorted, mflats_sorted = push_master_jobs(
+            darks_dir, mdarks_dir, flats_dir, mflats_dir, level, share_dir, write_jobs)
+
+        # Find and correct the light images
+        raw_lights = arimage.find_arimgs_in_dir(raw_dir)
+        raw_sorted = sort_arimgs_as_kind(raw_lights, ImageKind.LIGHT)
+        print ("Correcting light images from " + raw_dir)
+        print ("             with darks from " + mdarks_dir)
+        print ("              and flats from " + mflats_dir)
+        light_jobs, master_jobs, frame_keys = push_corrected_image_jobs(
+            raw_sorted, mdarks_sorted, mflats_sorted, output_dir, stack, share_dir)
+
+        # Free each master built here once the last job using it is done
+        flat_jobs = [job for masters in mflats_sorted.values() for job in masters
+                     if isinstance(job, jobs.Job)]
+        push_release_master_jobs(write_jobs, flat_jobs + master_jobs + light_jobs)
+
+        # Start processing the job graph and wait
+        jobs.start_jobs()
+        jobs.wait_done()
+        if bool(light_jobs) or bool(master_jobs):
+            finish_corrected_images(light_jobs, master_jobs, frame_keys)
+    finally:
+        if share_dir is not None:
+            shutil.rmtree(share_dir, ignore_errors=True)
+
+    # Work done by worker processes isn't counted here
+    io_stats = arimage.get_io_stats()
+    logger.info("Opened " + str(io_stats["files_opened"]) + " image files and wrote "
+                + str(io_stats["bytes_written"]) + " bytes")
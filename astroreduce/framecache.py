@@ -0,0 +1,129 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Master frames shared by the light jobs of this process. Each frame is
+# loaded once, by whichever job asks for it first, while the others wait on
+# its own lock. A frame is kept for as long as jobs that reserved it are
+# left, and dropped when the last of them releases it.
+#
+
+from threading import Lock
+from typing import Any, Callable, Dict
+
+from . import log
+
+logger = log.get_logger()
+
+
+class _Entry:
+    lock = None  # Held while the frame is loaded
+    refs = 0     # Jobs that reserved the frame and haven't released it yet
+    value = None # The loaded frame, None until it is first asked for
+
+    def __init__(self):
+        self.lock = Lock()
+
+
+class FrameCache:
+    _lock = None    # Guards the entries and the stats, not the loading
+    _entries = None
+    _hits = 0
+    _misses = 0
+
+    def reserve(self, key: str, count: int = 1):
+        """ Keep the frame for "key" until release() is called "count" more times """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = _Entry()
+                self._entries[key] = entry
+            entry.refs += count
+
+    def get(self, key: str, loader: Callable[[], Any]) -> Any:
+        """ Get the frame for "key", calling loader() to load it if no job has yet """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                # Not reserved, it is only kept until the next release()
+                entry = _Entry()
+                self._entries[key] = entry
+        with entry.lock:
+            hit = entry.value is not None
+            if not hit:
+                entry.value = loader()
+            value = entry.value
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return value
+
+    def release(self, key: str):
+        """ Release one reservation of the frame, it is dropped after the last one """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.refs -= 1
+            if entry.refs <= 0:
+                del self._entries[key]
+
+    def drop(self, key: str):
+        """ Drop the frame no matter how many reservations are left """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def getStats(self) -> Dict[str, int]:
+        """ Get the hits and misses so far, and the number of frames kept """
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "frames": sum(1 for entry in self._entries.values()
+                              if entry.value is not None),
+            }
+
+    def resetStats(self):
+        with self._lock:
+            self._hits = 0
+            self._misses = 0
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+
+
+_cache = FrameCache()
+
+def get_cache() -> FrameCache:
+    """ Get the frame cache of this process """
+    return _cache
@@ -28,71 +28,391 @@
 # OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
 # OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import multiprocessing
-from queue import Queue
-from threading import Thread
-from time import sleep
-from typing import Callable, Tuple
+import os
+from threading import Condition, Lock, Thread
+from typing import Any, Callable, Iterable, Tuple
 
 from . import env
+from . import log
 from . import progress
 
-_job_queue = Queue()                     # FIFO job queue
+logger = log.get_logger()
+
+BACKEND_THREAD = "thread"   # Run jobs in threads of this process (default)
+BACKEND_PROCESS = "process" # Run jobs in a pool of worker processes
+BACKENDS = (BACKEND_THREAD, BACKEND_PROCESS)
+
+_ready_jobs = []                         # Jobs that are ready to run, in FIFO order
 _cpu_count = multiprocessing.cpu_count() # Max threads = _cpu_count
+_count_lock = Lock()                     # Guards the counters, the job dependencies,
+                                         # and the ready jobs
+_jobs_changed = Condition(_count_lock)   # Notified when jobs are ready or finish
+_mem_limit = 0                           # Memory budget of the running jobs in bytes
+_mem_in_use = 0                          # Estimated memory of the running jobs
+_stopping = False                        # True while shutdown() stops the workers
+_jobs_pushed = 0                         # Jobs pushed since the queue was last empty
+_jobs_done = 0                           # Jobs finished since the queue was last empty
+_frames_pushed = 0                       # Frames of the pushed jobs, for progress
+_frames_done = 0                         # Frames of the finished jobs
+_process_pool = None                     # Worker processes, kept for the next jobs
+_started_backend = None                  # Backend the running workers belong to
+_worker_threads = []                     # Threads taking jobs from the job queue
+
+
+def _reset_after_fork():
+    """ Start a forked child with no jobs or workers, the parent's threads aren't copied """
+    global _count_lock
+    global _jobs_changed
+    global _mem_in_use
+    global _stopping
+    global _jobs_pushed
+    global _jobs_done
+    global _frames_pushed
+    global _frames_done
+    global _process_pool
+    global _started_backend
+    _count_lock = Lock()
+    _jobs_changed = Condition(_count_lock)
+    del _ready_jobs[:]
+    del _worker_threads[:]
+    _mem_in_use = 0
+    _stopping = False
+    _jobs_pushed = 0
+    _jobs_done = 0
+    _frames_pushed = 0
+    _frames_done = 0
+    _process_pool = None
+    _started_backend = None
+
+os.register_at_fork(after_in_child=_reset_after_fork)
 
 class Job:
     target = None     # Function to call when running in thread
-    args = None       # Arguments to pass to function
+    args = None       # Arguments to pass to function, jobs in them are replaced
+                      # by their return values
+    deps = None       # Jobs that have to finish before this one runs
     return_val = None # Return value of the target
     has_run = False   # True if the job has been run
+    failed = False    # True if the job, or a job it depends on, raised an exception
+    mem = 0           # Estimated memory the job uses while it runs, in bytes
+    cost = 0          # Estimated work of the job, only compared to other jobs' costs
+    frames = 0        # Frames the job processes, for the progress reports
+    priority = 0      # Cost of the job plus the longest chain of jobs waiting on it
+    callback = None   # Called with the job in this process once it has run or failed
 
     def run(self):
-        self.return_val = self.target(*self.args)
+        self.return_val = self.target(*_resolve_jobs(self.args))
         self.has_run = True
         return self.return_val
 
-    def __init__(self, target: Callable, args: Tuple = ()):
+    def isFinished(self) -> bool:
+        """ True once the job has run or failed """
+        return self.has_run or self.failed
+
+    def __init__(self, target: Callable, args: Tuple = (), deps: Iterable = (),
+                 mem: int = 0, cost: int = 0, frames: int = 0, callback: Callable = None):
         self.target=target
         self.args=args
+        self.mem = max(0, int(mem))
+        self.cost = max(0, cost)
+        self.priority = self.cost
+        self.frames = frames
+        self.callback = callback
+        # Jobs passed as arguments are dependencies too
+        self.deps = []
+        for dep in list(deps) + list(_find_jobs(args)):
+            if dep not in self.deps:
+                self.deps.append(dep)
+        self._dependents = [] # Jobs waiting for this one
+        self._waiting_on = 0  # Dependencies that haven't finished yet
+        self._mem_held = 0    # Memory counted in _mem_in_use while it runs
+
+
+def _find_jobs(value) -> Iterable[Job]:
+    """ Find the jobs in a job argument, looking into lists, tuples, and dictionaries """
+    if isinstance(value, Job):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _find_jobs(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _find_jobs(item)
+
+
+def _resolve_jobs(value) -> Any:
+    """ Replace the jobs in a job argument with their return values """
+    if isinstance(value, Job):
+        return value.return_val
+    if isinstance(value, list):
+        return [_resolve_jobs(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_resolve_jobs(item) for item in value)
+    if isinstance(value, dict):
+        return {key: _resolve_jobs(item) for key, item in value.items()}
+    return value
+
+
+def get_backend() -> str:
+    """ Get the backend jobs are run with, set by the "JOBS_BACKEND" variable """
+    backend = env.get("JOBS_BACKEND")
+    if backend in BACKENDS:
+        return backend
+    if backend:
+        logger.warning("Unknown jobs backend \"" + str(backend) + "\", using threads")
+    return BACKEND_THREAD
+
+
+def get_mem_limit() -> int:
+    """ Get the memory budget of the running jobs in bytes, set in MiB by "JOBS_MEM_LIMIT" """
+    return max(0, env.get_int("JOBS_MEM_LIMIT", 0)) * 1024 * 1024
+
+
+def _job_ready(job: Job):
+    """ Queue a job whose dependencies have all finished, or skip it if one failed """
+    if any(dep.failed for dep in job.deps):
+        job.failed = True
+        logger.warning("Skipping job, a job it depends on failed: " + job.target.__name__)
+        _job_finished(job)
+        return
+    with _jobs_changed:
+        _ready_jobs.append(job)
+        _jobs_changed.notify_all()
+
+
+def _admit_job() -> Job:
+    """ Get the ready job to run next, None if none fit in the memory budget """
+    # The job with the most work behind it goes first so no long job is left
+    # to finish on its own at the end, then the first one ready
+    admitted = None
+    for job in _ready_jobs:
+        # A job larger than the whole budget still runs, just on its own
+        if (_mem_limit <= 0 or _mem_in_use == 0
+                or _mem_in_use + job.mem <= _mem_limit):
+            if admitted is None or job.priority > admitted.priority:
+                admitted = job
+    return admitted
+
+
+def _raise_priority(job: Job, dependent_priority):
+    """ Make sure a job goes before the chain of jobs waiting on it """
+    if job.isFinished() or job.priority >= job.cost + dependent_priority:
+        return
+    job.priority = job.cost + dependent_priority
+    for dep in job.deps:
+        _raise_priority(dep, job.priority)
+
+
+def _take_job() -> Job:
+    """ Wait for a ready job that can run now, None once the workers are stopped """
+    global _mem_in_use
+    with _jobs_changed:
+        while not _stopping:
+            job = _admit_job()
+            if job is not None:
+                _ready_jobs.remove(job)
+                job._mem_held = job.mem
+                _mem_in_use += job.mem
+                return job
+            _jobs_changed.wait()
+    return None
+
+
+def _job_finished(job: Job):
+    """ Count a finished job and queue the jobs that were only waiting for it """
+    global _jobs_done
+    global _frames_done
+    global _mem_in_use
+    # Before the job is counted, so wait_done() doesn't return ahead of it
+    if job.callback is not None:
+        try:
+            job.callback(job)
+        except Exception:
+            logger.exception("Job callback failed: " + job.target.__name__)
+    ready = []
+    with _jobs_changed:
+        _jobs_done += 1
+        _frames_done += job.frames
+        _mem_in_use -= job._mem_held
+        job._mem_held = 0
+        _jobs_changed.notify_all()
+        for dependent in job._dependents:
+            dependent._waiting_on -= 1
+            if dependent._waiting_on == 0:
+                ready.append(dependent)
+        job._dependents = []
+    for dependent in ready:
+        _job_ready(dependent)
 
 
 def _job_worker():
-    while not _job_queue.empty():
-        job = _job_queue.get()
-        job.run()
-        _job_queue.task_done()
+    while True:
+        job = _take_job()
+        if job is None: # Stopped by shutdown()
+            break
+        try:
+            job.run()
+        except Exception:
+            job.failed = True
+            logger.exception("Job failed: " + job.target.__name__)
+        finally:
+            _job_finished(job)
+
+
+def _init_process_worker(env_vars):
+    """ Give a new worker process the same environment as the parent """
+    for key, value in env_vars.items():
+        env.set(key, value)
+
+
+def _process_job_done(job: Job, future):
+    """ Collect the result of a job that ran in a worker process """
+    try:
+        job.return_val = future.result()
+        job.has_run = True
+    except Exception:
+        job.failed = True
+        logger.exception("Job failed: " + job.target.__name__)
+    finally:
+        _job_finished(job)
+
+
+def _process_job_submitter():
+    """ Send the jobs in the job queue to the worker processes as they become ready """
+    while True:
+        job = _take_job()
+        if job is None: # Stopped by shutdown()
+            break
+        # The target and arguments are pickled, so the target has to be a
+        # module level function. The return value is pickled back.
+        try:
+            future = _process_pool.submit(job.target, *_resolve_jobs(job.args))
+        except Exception:
+            job.failed = True
+            logger.exception("Job failed: " + job.target.__name__)
+            _job_finished(job)
+        else:
+            future.add_done_callback(partial(_process_job_done, job))
+
+
+def _start_process_jobs(max_workers: int):
+    """ Start the worker processes and the thread that feeds them """
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_process_worker,
+            initargs=(dict(env._vars),))
+    if not _worker_threads:
+        _start_worker_thread(_process_job_submitter)
+
+
+def _start_worker_thread(target: Callable):
+    t = Thread(target=target)
+    t.daemon = True
+    t.start()
+    _worker_threads.append(t)
 
 
 def push_job(new_job: Job):
-    """ Push a new job into the FIFO queue """
-    _job_queue.put(new_job)
+    """ Push a new job, it is queued once the jobs it depends on have finished """
+    global _jobs_pushed
+    global _frames_pushed
+    with _count_lock:
+        _jobs_pushed += 1
+        _frames_pushed += new_job.frames
+        for dep in new_job.deps:
+            if not dep.isFinished():
+                dep._dependents.append(new_job)
+                new_job._waiting_on += 1
+                _raise_priority(dep, new_job.priority)
+        ready = new_job._waiting_on == 0
+    if ready:
+        _job_ready(new_job)
 
 
-def start_jobs(max_threads: int = 0):
-    """ Start running the jobs in the job queue """
-    global _cpu_count
+def get_workers(max_threads: int = 0) -> int:
+    """ Get the number of job workers, set by the "JOBS_WORKERS" variable """
+    if max_threads <= 0:
+        max_threads = env.get_int("JOBS_WORKERS", _cpu_count)
     if max_threads <= 0:
         max_threads = _cpu_count
+    return max_threads
 
-    for i in range(max_threads):
-        t = Thread(target=_job_worker)
-        t.daemon = True
-        t.start()
+
+def start_jobs(max_threads: int = 0):
+    """ Start running the jobs in the job queue, jobs pushed later run as they are ready """
+    global _started_backend
+    global _mem_limit
+    max_threads = get_workers(max_threads)
+
+    backend = get_backend()
+    if _started_backend != backend:
+        # The workers of the other backend would take jobs from the queue too
+        shutdown()
+    _started_backend = backend
+
+    # Jobs are only started while their estimated memory fits in the budget
+    with _jobs_changed:
+        _mem_limit = get_mem_limit()
+        _jobs_changed.notify_all()
+
+    if backend == BACKEND_PROCESS:
+        _start_process_jobs(max_threads)
+        return
+
+    # The workers wait for more jobs until shutdown(), start any that are missing
+    for i in range(len(_worker_threads), max_threads):
+        _start_worker_thread(_job_worker)
+
+
+def _progress_counts() -> Tuple[int, int, int, int]:
+    return _jobs_done, _jobs_pushed, _frames_done, _frames_pushed
 
 
 def wait_done(show_progress=True):
     """ Wait until all jobs have finished running """
-    complete_prog_bar = False # If true, set progress to 100% when done
-    if show_progress and not env.get("VERBOSE"):
-        complete_prog_bar = True
-        qsize_init = _job_queue.qsize()
-        progress.update(0)
-        while not _job_queue.empty():
-            prog = (qsize_init - _job_queue.qsize()) / qsize_init
-            progress.update(prog)
-            sleep(0.001)
-
-    _job_queue.join()
-
-    if complete_prog_bar:
-        progress.update(1)
+    global _jobs_pushed
+    global _jobs_done
+    global _frames_pushed
+    global _frames_done
+    reporter = progress.Reporter(show_bar=show_progress and not env.get("VERBOSE"))
+    # Woken as each job finishes, and otherwise only as often as the
+    # progress is shown
+    interval = reporter.interval()
+    while True:
+        with _jobs_changed:
+            if _jobs_done >= _jobs_pushed:
+                counts = _progress_counts()
+                _jobs_pushed = 0
+                _jobs_done = 0
+                _frames_pushed = 0
+                _frames_done = 0
+                break
+            _jobs_changed.wait(interval)
+            counts = _progress_counts()
+        reporter.update(*counts)
+
+    reporter.finish(*counts)
+
+
+def shutdown():
+    """ Stop the worker threads and processes, if any were started """
+    global _process_pool
+    global _started_backend
+    global _stopping
+    with _jobs_changed:
+        _stopping = True
+        _jobs_changed.notify_all()
+    for t in _worker_threads:
+        t.join()
+    del _worker_threads[:]
+    with _jobs_changed:
+        _stopping = False
+    if _process_pool is not None:
+        _process_pool.shutdown()
+        _process_pool = None
+    _started_backend = None
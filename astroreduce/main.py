@@ -5,10 +5,15 @@ import logging
 import os
 import sys
 
+from . import catalog
 from . import env
 from . import flatfield as ff
+from . import jobs
 from . import log
+from . import server
 from . import version
+from . import watch
+from . import workqueue
 
 PROGRAM_NAME = "AstroReduce"
 
@@ -33,6 +38,27 @@ def usage():
     print ("    -D mdark_dir    Master dark images output directory")
     print ("    -f flat_dir     Raw flat images directory")
     print ("    -F mflat_dir    Master flat images output directory")
+    print ("    -m mem_limit    Memory (MiB) used by each median combine, default "
+           + str(ff.COMBINE_MEM_LIMIT_DEFAULT))
+    print ("    -T threads      Threads used by each median combine, default splits the cores")
+    print ("    -b batch_size   Lights corrected per job, default "
+           + str(ff.LIGHT_BATCH_SIZE_DEFAULT))
+    print ("    -q depth        Lights queued between the read, correct and write stages, default "
+           + str(ff.PIPELINE_DEPTH_DEFAULT))
+    print ("    -p precision    Compute and store masters and lights as \"float32\" or \"float64\"")
+    print ("        --int-output=type   Store corrected lights as scaled \"int16\" or \"int32\"")
+    print ("    -j backend      Run jobs with \"thread\" (default) or \"process\" workers")
+    print ("    -t workers      Number of job workers, default is the number of cores")
+    print ("    -M mem_limit    MiB of memory the running jobs may use together, default no limit")
+    print ("        --progress-json=path    Append progress as JSON lines with frames/s and ETA")
+    print ("    -c catalog      SQLite file to cache fits header values in between runs")
+    print ("    -C cache_dir    Directory to keep built master darks and flats in for reuse")
+    print ("        --force     Rebuild corrected lights even if they are up to date")
+    print ("        --memmap    Map image data from the files instead of reading it in")
+    print ("    -w, --watch     Keep running and correct new lights in light_dir as they arrive")
+    print ("        --watch-poll    Scan light_dir for new lights instead of using inotify")
+    print ("        --serve=socket  Keep running and take reduction requests on a Unix socket")
+    print ("        --queue=dir     Share the reduction with the workers given the same shared directory")
     print ("    -L run_level    0 -> Process darks, flats, and lights")
     print ("                    1 -> Process flats and lights using only existing master darks")
     print ("                    2 -> Process lights using only existing darks and flats")
@@ -46,8 +72,11 @@ def main():
     mflat_dir = "./mflats"
     output_dir = "./output"
     level = 0
+    watch_lights = False
+    socket_path = None
+    queue_dir = None
 
-    OPTIONS = "vhiVl:d:D:f:F:o:L:k"
+    OPTIONS = "vhiVl:d:D:f:F:o:L:km:T:b:j:t:c:C:q:p:M:w"
     LONG_OPTIONS = [
         "version",
         "help",
@@ -57,7 +86,25 @@ def main():
         "mdark-dir",
         "flat-dir",
         "mflat-dir",
-        "output-dir"
+        "output-dir",
+        "mem-limit=",
+        "combine-threads=",
+        "light-batch=",
+        "jobs-backend=",
+        "jobs=",
+        "catalog=",
+        "master-cache=",
+        "force",
+        "queue-depth=",
+        "precision=",
+        "int-output=",
+        "jobs-mem=",
+        "progress-json=",
+        "memmap",
+        "watch",
+        "watch-poll",
+        "serve=",
+        "queue="
     ]
 
     try:
@@ -86,6 +133,42 @@ def main():
             mflat_dir = a
         elif o in ("-o", "--output-dir"):
             output_dir = a
+        elif o in ("-m", "--mem-limit"):
+            env.set("COMBINE_MEM_LIMIT", a)
+        elif o in ("-T", "--combine-threads"):
+            env.set("COMBINE_THREADS", a)
+        elif o in ("-b", "--light-batch"):
+            env.set("LIGHT_BATCH_SIZE", a)
+        elif o in ("-j", "--jobs-backend"):
+            env.set("JOBS_BACKEND", a)
+        elif o in ("-t", "--jobs"):
+            env.set("JOBS_WORKERS", a)
+        elif o in ("-c", "--catalog"):
+            env.set("HEADER_CATALOG", a)
+        elif o in ("-C", "--master-cache"):
+            env.set("MASTER_CACHE_DIR", a)
+        elif o == "--progress-json":
+            env.set("PROGRESS_JSON", a)
+        elif o in ("-M", "--jobs-mem"):
+            env.set("JOBS_MEM_LIMIT", a)
+        elif o in ("-q", "--queue-depth"):
+            env.set("PIPELINE_DEPTH", a)
+        elif o in ("-p", "--precision"):
+            env.set("PRECISION", a)
+        elif o == "--int-output":
+            env.set("INT_OUTPUT", a)
+        elif o == "--force":
+            env.set("FORCE", "True")
+        elif o == "--memmap":
+            env.set("MEMMAP", "True")
+        elif o in ("-w", "--watch"):
+            watch_lights = True
+        elif o == "--watch-poll":
+            env.set("WATCH_BACKEND", watch.BACKEND_POLL)
+        elif o == "--serve":
+            socket_path = a
+        elif o == "--queue":
+            queue_dir = a
         elif o in ("-v", "--version"):
             print_version()
             sys.exit(0)
@@ -97,16 +180,48 @@ def main():
 
     env.import_sys_env()
 
-    ff.reduce(
-        darks_dir=dark_dir,
-        mdarks_dir=mdark_dir,
-        flats_dir=flat_dir,
-        mflats_dir=mflat_dir,
-        raw_dir=light_dir,
-        output_dir=output_dir,
-        stack=False,
-        level=level
-    )
+    if queue_dir is not None:
+        workqueue.reduce(
+            queue_dir,
+            darks_dir=dark_dir,
+            mdarks_dir=mdark_dir,
+            flats_dir=flat_dir,
+            mflats_dir=mflat_dir,
+            raw_dir=light_dir,
+            output_dir=output_dir,
+            level=level
+        )
+    elif socket_path is not None:
+        try:
+            server.serve(socket_path)
+        except KeyboardInterrupt:
+            print ("Stopped serving on " + socket_path)
+    elif watch_lights:
+        try:
+            watch.watch(
+                darks_dir=dark_dir,
+                mdarks_dir=mdark_dir,
+                flats_dir=flat_dir,
+                mflats_dir=mflat_dir,
+                raw_dir=light_dir,
+                output_dir=output_dir,
+                level=level
+            )
+        except KeyboardInterrupt:
+            print ("Stopped watching " + light_dir)
+    else:
+        ff.reduce(
+            darks_dir=dark_dir,
+            mdarks_dir=mdark_dir,
+            flats_dir=flat_dir,
+            mflats_dir=mflat_dir,
+            raw_dir=light_dir,
+            output_dir=output_dir,
+            stack=False,
+            level=level
+        )
+    jobs.shutdown()
+    catalog.close_catalogs()
 
     return
 
@@ -0,0 +1,167 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from typing import Dict, List
+
+from astropy.io import fits
+
+from . import env
+from . import fitsheader
+from . import log
+
+logger = log.get_logger()
+
+KEY_CARD = "ARINPUTS"       # Header card holding the key a master was built from
+CACHE_SIZE_DEFAULT = 4096   # MiB kept in the cache directory
+COMBINE_VERSION = 1         # Bump when a change to the combine changes its output
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def file_fingerprint(path: str) -> str:
+    """ Identify the contents of a file, by hash or by its size and mtime """
+    if env.get("MASTER_CACHE_HASH") == "content":
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+    stat = os.stat(path)
+    return str(stat.st_size) + ":" + str(stat.st_mtime_ns)
+
+
+def read_key(path: str, card: str=KEY_CARD) -> str:
+    """ Get the key a file was built from, None if it doesn't have one """
+    if not os.path.exists(path):
+        return None
+    values = fitsheader.read_cards(path, [card])
+    if values is None:
+        values = {card: fits.getheader(path).get(card)}
+    return values[card]
+
+
+def master_fingerprint(path: str) -> str:
+    """ Identify a master, by the key it was built from if it has one """
+    key = read_key(path)
+    if key is None:
+        key = file_fingerprint(path)
+    return key
+
+
+def master_key(kind: str, input_paths: List[str], params: Dict=None) -> str:
+    """ Hash the set of input frames and the combine parameters """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({
+        "kind": kind,
+        "version": COMBINE_VERSION,
+        "params": params or {},
+    }, sort_keys=True).encode())
+    for path in sorted(os.path.abspath(path) for path in input_paths):
+        digest.update(path.encode())
+        digest.update(file_fingerprint(path).encode())
+    return digest.hexdigest()
+
+
+def is_current(path: str, key: str) -> bool:
+    """ True if the master at "path" was already built from "key" """
+    try:
+        return read_key(path) == key
+    except OSError:
+        return False
+
+
+def get_cache_dir() -> str:
+    """ Get the cache directory set by "MASTER_CACHE_DIR", None if not set """
+    cache_dir = env.get("MASTER_CACHE_DIR")
+    if not cache_dir:
+        return None
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _copy_atomic(src: str, dst: str):
+    """ Copy a file so that readers never see a partly written "dst" """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)),
+                                    prefix=".tmp-", suffix=".fts")
+    os.close(fd)
+    try:
+        shutil.copyfile(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+
+
+def fetch(key: str, path: str) -> bool:
+    """ Copy a cached master with "key" to "path", False if it isn't cached """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return False
+    cached_path = os.path.join(cache_dir, key + ".fts")
+    try:
+        _copy_atomic(cached_path, path)
+        os.utime(cached_path) # Most recently used
+    except FileNotFoundError:
+        return False
+    logger.info("Reused cached master " + cached_path + ": " + path)
+    return True
+
+
+def store(key: str, path: str):
+    """ Add the master at "path" to the cache and evict the least recently used """
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        return
+    _copy_atomic(path, os.path.join(cache_dir, key + ".fts"))
+    evict(cache_dir, env.get_int("MASTER_CACHE_SIZE", CACHE_SIZE_DEFAULT) * 1024 * 1024)
+
+
+def evict(cache_dir: str, max_size: int):
+    """ Remove the least recently used masters until the cache fits in max_size """
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".fts") and not entry.name.startswith("."):
+            stat = entry.stat()
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    entries.sort()
+    total_size = sum(entry[1] for entry in entries)
+    for mtime_ns, size, path in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+            logger.info("Evicted cached master: " + path)
+        except FileNotFoundError:
+            pass # Another process evicted it first
+        total_size -= size
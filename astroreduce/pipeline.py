@@ -0,0 +1,122 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+from queue import Queue
+from threading import Lock, Thread
+from typing import Callable, Iterable, List
+
+import numpy as np
+
+_DONE = object() # Sent down the queues after the last item
+
+
+def _run_stage(stage: Callable, source: Iterable, output: Queue, results: List, errors: List):
+    """ Run one stage over every item from source, passing what it returns on """
+    for item in source:
+        if errors:
+            continue # Another stage failed, keep draining so nothing blocks
+        try:
+            item = stage(item)
+        except Exception as err:
+            errors.append(err)
+            continue
+        if item is None:
+            continue # Dropped by the stage
+        if output is None:
+            results.append(item)
+        else:
+            output.put(item)
+    if output is not None:
+        output.put(_DONE)
+
+
+def run_pipeline(items: Iterable, stages: List[Callable], depth: int=2) -> List:
+    """ Pass items through the stages, each stage running in its own thread """
+    # A stage returns the item for the next stage, or None to drop it. At most
+    # "depth" items wait between two stages, so memory use stays bounded.
+    # Returns what the last stage returned, in order.
+    results = []
+    errors = []
+    if depth <= 0 or len(stages) < 2:
+        # Run every stage on one item in this thread before the next is read
+        for item in items:
+            for stage in stages:
+                item = stage(item)
+                if item is None:
+                    break
+            else:
+                results.append(item)
+        return results
+
+    queues = [Queue(maxsize=depth) for i in range(len(stages) - 1)]
+    threads = []
+    for i in range(len(stages) - 1):
+        source = items if i == 0 else iter(queues[i - 1].get, _DONE)
+        t = Thread(target=_run_stage, args=(stages[i], source, queues[i], results, errors))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    # The last stage runs in the calling thread
+    _run_stage(stages[-1], iter(queues[-1].get, _DONE), None, results, errors)
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+class BufferPool:
+    """ A fixed number of reusable arrays, handed from one stage to a later one """
+    size = 0        # Most arrays that are ever allocated
+    allocated = 0   # Arrays allocated so far
+    _free = None
+    _lock = None
+
+    def get(self, shape, dtype) -> np.ndarray:
+        """ Get a free array, waiting for one to be put back if all are in use """
+        with self._lock:
+            if self._free.empty() and self.allocated < self.size:
+                self.allocated += 1
+                return np.empty(shape, dtype=dtype)
+        buf = self._free.get()
+        if buf.shape != tuple(shape) or buf.dtype != dtype:
+            buf = np.empty(shape, dtype=dtype)
+        return buf
+
+    def put(self, buf: np.ndarray):
+        """ Give an array back to the pool """
+        self._free.put(buf)
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._free = Queue()
+        self._lock = Lock()
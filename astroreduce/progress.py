@@ -1,6 +1,14 @@
+import json
 import sys
+import time
 
 from . import env
+from . import log
+
+REDRAW_INTERVAL = 0.1 # Seconds between progress bar redraws
+JSON_INTERVAL = 1.0   # Seconds between lines of the JSON progress stream
+
+logger = log.get_logger()
 
 def update(progress):
     """ A simple progress bar, accepts a float between 0 and 1 """
@@ -34,3 +42,71 @@ def update(progress):
                                                status)
     sys.stdout.write(text)
     sys.stdout.flush()
+
+
+class Reporter:
+    """ Reports the progress of jobs on the progress bar and the JSON progress stream """
+    show_bar = False    # Draw the progress bar
+    json_file = None    # Stream of JSON lines set by "PROGRESS_JSON", or None
+
+    def interval(self):
+        """ Seconds between updates that are worth waking up for, None if nothing is shown """
+        if self.json_file is not None:
+            return REDRAW_INTERVAL if self.show_bar else JSON_INTERVAL
+        return REDRAW_INTERVAL if self.show_bar else None
+
+    def update(self, jobs_done, jobs_total, frames_done, frames_total, force=False):
+        """ Redraw the bar and write a JSON line, if enough time has passed since the last """
+        now = time.monotonic()
+        if self.show_bar and (force or now - self._last_redraw >= REDRAW_INTERVAL):
+            self._last_redraw = now
+            update(jobs_done / jobs_total if jobs_total > 0 else 1)
+        if self.json_file is not None and (force or now - self._last_json >= JSON_INTERVAL):
+            self._last_json = now
+            elapsed = now - self._start
+            rate = frames_done / elapsed if elapsed > 0 else 0.0
+            eta = None
+            if rate > 0:
+                eta = round((frames_total - frames_done) / rate, 3)
+            self._writeLine({
+                "event": "done" if force else "progress",
+                "time": round(time.time(), 3),
+                "elapsed_s": round(elapsed, 3),
+                "jobs_done": jobs_done,
+                "jobs_total": jobs_total,
+                "frames_done": frames_done,
+                "frames_total": frames_total,
+                "frames_per_s": round(rate, 3),
+                "eta_s": eta,
+            })
+
+    def finish(self, jobs_done, jobs_total, frames_done, frames_total):
+        """ Show the final progress and close the JSON progress stream """
+        self.update(jobs_done, jobs_total, frames_done, frames_total, force=True)
+        if self.json_file is not None:
+            self.json_file.close()
+            self.json_file = None
+
+    def _writeLine(self, record):
+        try:
+            self.json_file.write(json.dumps(record) + "\n")
+            self.json_file.flush()
+        except OSError as err:
+            logger.error("Failed to write the JSON progress stream: " + str(err))
+            self.json_file = None
+
+    def __init__(self, show_bar=True):
+        self.show_bar = show_bar
+        self._start = time.monotonic()
+        self._last_redraw = self._start
+        self._last_json = self._start
+        json_path = env.get("PROGRESS_JSON")
+        if json_path:
+            try:
+                # Appended to so a reader can follow one stream over several runs
+                self.json_file = open(json_path, "a")
+            except OSError as err:
+                logger.error("Failed to open the JSON progress stream " + json_path
+                             + ": " + str(err))
+        if self.show_bar:
+            update(0)
@@ -0,0 +1,281 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Run reductions for other programs from one long running process. The
+# server listens on a Unix socket for requests, one JSON object per line,
+# and answers each with JSON lines: a "started" event, a "frame" event for
+# each light as its batch finishes or as it is skipped, then a "done" or
+# "error" event. The modules, the job workers and the masters stay loaded
+# between requests.
+#
+# A request names the same directories as reduce(), and the lights either
+# as "raw_dir" or as a list of paths in "lights":
+#
+#   {"raw_dir": "./lights", "output_dir": "./output", "mdarks_dir": "./mdarks",
+#    "mflats_dir": "./mflats", "level": 2}
+#
+
+from collections import OrderedDict
+import errno
+from functools import partial
+import json
+import os
+import shutil
+import socket
+import socketserver
+import stat
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, Iterator
+
+from . import arimage
+from . import env
+from . import flatfield as ff
+from . import jobs
+from . import log
+from . import watch
+
+REQUEST_DEFAULTS = {
+    "darks_dir": "./darks",
+    "mdarks_dir": "./mdarks",
+    "flats_dir": "./flats",
+    "mflats_dir": "./mflats",
+    "raw_dir": "./lights",
+    "output_dir": "./output",
+    "level": 0,
+}
+
+SERVER_MASTERS_MEM_DEFAULT = 1024 # MiB of masters kept loaded between requests
+
+logger = log.get_logger()
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        send_lock = Lock()
+        closed = []
+        def send(event: Dict):
+            # Called from the job workers too
+            with send_lock:
+                if closed:
+                    return
+                try:
+                    self.wfile.write((json.dumps(event) + "\n").encode())
+                    self.wfile.flush()
+                except OSError:
+                    closed.append(True) # The client went away, finish quietly
+
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode())
+                if not isinstance(request, dict):
+                    raise ValueError("A request has to be a JSON object")
+            except ValueError as err:
+                send({"event": "error", "message": "Bad request: " + str(err)})
+                continue
+            self.server.runRequest(request, send)
+
+
+class ReduceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ Reduction server listening on the Unix socket at "socket_path" """
+    daemon_threads = True
+    _socket_path = None
+    _run_lock = None    # Held while a request runs, the job queue runs one at a time
+    _resident = None    # Masters loaded by earlier requests by path, least recently used first
+    _share_dir = None   # Shares the masters with worker processes
+
+    def __init__(self, socket_path: str):
+        remove_stale_socket(socket_path)
+        self._socket_path = socket_path
+        self._run_lock = Lock()
+        self._resident = OrderedDict()
+        socketserver.UnixStreamServer.__init__(self, socket_path, _RequestHandler)
+        if jobs.get_backend() == jobs.BACKEND_PROCESS:
+            self._share_dir = ff.create_share_dir()
+
+    def server_bind(self):
+        # Only this user may send requests, they read and write any path
+        # the server's user can
+        umask = os.umask(0o177)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+        os.chmod(self._socket_path, 0o600)
+
+    def warmUp(self):
+        """ Start the job workers now instead of on the first request """
+        for i in range(jobs.get_workers()):
+            jobs.push_job(jobs.Job(target=os.getpid))
+        jobs.start_jobs()
+        jobs.wait_done(show_progress=False)
+
+    def runRequest(self, request: Dict, send: Callable):
+        """ Run one reduction request, sending its events with send() """
+        start_time = monotonic()
+        args = dict(REQUEST_DEFAULTS)
+        args.update({key: request[key] for key in REQUEST_DEFAULTS if key in request})
+        with self._run_lock:
+            try:
+                reused, recomputed = self._reduce(args, request.get("lights"), send)
+            except Exception as err:
+                logger.exception("Request failed: " + json.dumps(request))
+                send({"event": "error", "message": str(err)})
+                return
+        send({"event": "done", "reused": reused, "recomputed": recomputed,
+              "elapsed_s": round(monotonic() - start_time, 3)})
+
+    def _reduce(self, args: Dict, light_paths, send: Callable):
+        """ Reduce like ff.reduce(), with the masters kept from earlier requests """
+        # Masters that haven't changed aren't built again or reloaded
+        mdarks_sorted, mflats_sorted = ff.push_master_jobs(
+            args["darks_dir"], args["mdarks_dir"], args["flats_dir"], args["mflats_dir"],
+            int(args["level"]), self._share_dir)
+        jobs.start_jobs()
+        jobs.wait_done(show_progress=False)
+        mdarks_sorted = watch.load_resident_masters(mdarks_sorted, self._share_dir,
+                                                    self._resident)
+        mflats_sorted = watch.load_resident_masters(mflats_sorted, self._share_dir,
+                                                    self._resident)
+        in_use = set(masters[0].getFullPath()
+                     for masters_dic in (mdarks_sorted, mflats_sorted)
+                     for masters in masters_dic.values())
+        self._evictMasters(in_use)
+
+        if light_paths is not None:
+            imgs = [arimage.ARImage(path) for path in light_paths]
+        else:
+            imgs = arimage.find_arimgs_in_dir(args["raw_dir"]) or []
+        send({"event": "started", "frames": len(imgs)})
+        sent_paths = set()
+        def send_frame(event: Dict):
+            sent_paths.add(event["path"])
+            send(event)
+        reused, recomputed = watch.correct_resident(imgs, mdarks_sorted, mflats_sorted,
+                                                    args["output_dir"],
+                                                    partial(_send_frames, send_frame))
+
+        # Lights no job was pushed for, like those without matching masters
+        for img in imgs:
+            if img.getFullPath() not in sent_paths:
+                send({"event": "frame", "path": img.getFullPath(), "output": None,
+                      "status": ff.LIGHT_SKIPPED})
+        return reused, recomputed
+
+    def _evictMasters(self, in_use):
+        """ Free the least recently used masters not in use while they are over the limit """
+        limit = max(0, env.get_int("SERVER_MASTERS_MEM", SERVER_MASTERS_MEM_DEFAULT))
+        limit *= 1024 * 1024
+        total = sum(_loaded_bytes(master) for master in self._resident.values())
+        for path in list(self._resident):
+            if total <= limit:
+                break
+            if path in in_use:
+                continue
+            master = self._resident.pop(path)
+            total -= _loaded_bytes(master)
+            watch.release_master(master)
+            logger.info("Released master: " + path)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        if self._share_dir is not None:
+            shutil.rmtree(self._share_dir, ignore_errors=True)
+
+
+def _loaded_bytes(master) -> int:
+    """ Get the memory held by a master's data """
+    if master.fits_data is None:
+        return 0
+    return master.fits_data.nbytes
+
+
+def remove_stale_socket(socket_path: str):
+    """ Remove a socket left behind by a server that didn't stop cleanly """
+    # Anything else at socket_path is left alone and raises an error
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError(errno.EEXIST, "Not a socket, leaving it alone", socket_path)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(socket_path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            logger.warning("Removing the socket of a server that stopped: " + socket_path)
+            try:
+                os.remove(socket_path)
+            except FileNotFoundError:
+                pass
+            return
+    raise OSError(errno.EADDRINUSE, "A server is already listening", socket_path)
+
+
+def _send_frames(send: Callable, job: jobs.Job):
+    """ Send the status of each light of a finished light job """
+    if job.return_val is not None:
+        for raw_path, output_path, status in job.return_val[2]:
+            send({"event": "frame", "path": raw_path, "output": output_path,
+                  "status": status})
+    else:
+        # The job failed, its first argument is the batch of lights
+        for img in job.args[0]:
+            send({"event": "frame", "path": img.getFullPath(), "output": None,
+                  "status": ff.LIGHT_FAILED})
+
+
+def serve(socket_path: str):
+    """ Serve reduction requests on the Unix socket at "socket_path" until interrupted """
+    server = ReduceServer(socket_path)
+    try:
+        server.warmUp()
+        print ("Listening for reduction requests on " + socket_path)
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def submit(socket_path: str, request: Dict) -> Iterator[Dict]:
+    """ Send a request to the server at "socket_path", yields its events until it is done """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        with sock.makefile("rb") as events:
+            for line in events:
+                event = json.loads(line.decode())
+                yield event
+                if event["event"] in ("done", "error"):
+                    return
@@ -1,9 +1,13 @@
 import unittest
 
+import gzip
 import os
+import pickle
 import shutil
 import tempfile
 
+import numpy as np
+
 from .. import arimage
 
 class TestARImage(unittest.TestCase):
@@ -49,3 +53,151 @@ class TestARImage(unittest.TestCase):
             self.assertTrue(isinstance(img, arimage.ARImage))
         for img in all_imgs:
             self.assertTrue(isinstance(img, arimage.ARImage))
+
+        # Images are always returned in the same order
+        all_paths = [img.getFullPath() for img in all_imgs]
+        self.assertEqual(all_paths, sorted(all_paths))
+
+    def test_find_arimg_in_dir_skips_hidden(self):
+        hidden_path = os.path.join(self._temp_path, ".hidden")
+        os.makedirs(hidden_path)
+        for path in (os.path.join(hidden_path, "testimg.fits"),
+                     os.path.join(self._temp_path, ".testimg.fits"),
+                     os.path.join(self._temp_path, "testimg.fits")):
+            arimage.ARImage(path, new_file=True).saveToDisk()
+
+        all_imgs = arimage.find_arimgs_in_dir(self._temp_path)
+
+        self.assertEqual(len(all_imgs), 1)
+
+    def test_share_data(self):
+        img = arimage.ARImage(os.path.join(self._temp_path, "shared.fits"), new_file=True)
+        img.fits_data = np.arange(10000, dtype=np.float64).reshape(100, 100)
+        share_dir = os.path.join(self._temp_path, "share")
+        os.makedirs(share_dir)
+
+        shared_path = img.shareData(share_dir)
+        pickled = pickle.dumps(img)
+        copy = pickle.loads(pickled)
+
+        # The data is mapped from the shared file, not copied through the pickle
+        self.assertTrue(shared_path.startswith(share_dir))
+        self.assertLess(len(pickled), img.fits_data.nbytes)
+        self.assertTrue(isinstance(copy.fits_data, np.memmap))
+        self.assertFalse(copy.fits_data.flags.writeable)
+        self.assertTrue(np.array_equal(copy.fits_data, img.fits_data))
+
+        img.unloadData()
+        self.assertIs(img.shared_path, None)
+
+    def test_load_data_memmap(self):
+        float_img = arimage.ARImage(os.path.join(self._temp_path, "float.fits"), new_file=True)
+        float_img.fits_data = np.arange(600, dtype=np.float32).reshape(20, 30)
+        float_img.saveToDisk()
+        float_img.unloadData()
+        int_img = arimage.ARImage(os.path.join(self._temp_path, "uint.fits"), new_file=True)
+        int_img.fits_data = np.arange(600, dtype=np.uint16).reshape(20, 30)
+        int_img.saveToDisk()
+        int_img.unloadData()
+
+        # Unscaled data is a view of the file, scaled data is read as usual
+        float_data = float_img.loadData(memmap=True)
+        int_data = int_img.loadData(memmap=True)
+        self.assertFalse(float_data.flags.owndata)
+        self.assertTrue(np.array_equal(float_data, np.arange(600).reshape(20, 30)))
+        self.assertEqual(int_data.dtype, np.uint16)
+        self.assertTrue(np.array_equal(int_data, np.arange(600).reshape(20, 30)))
+
+    def test_single_open_single_write(self):
+        path = os.path.join(self._temp_path, "io.fits")
+        img = arimage.ARImage(path, new_file=True)
+        img.fits_data = np.ones((10, 10), dtype=np.float32)
+        img.exp_time = 5
+
+        # Nothing touches the disk until the image is saved, and then only once
+        arimage.reset_io_stats()
+        self.assertFalse(os.path.exists(path))
+        img.saveToDisk()
+        stats = arimage.get_io_stats()
+        self.assertEqual(stats["files_opened"], 0)
+        self.assertEqual(stats["bytes_written"], os.path.getsize(path))
+        self.assertEqual(os.listdir(self._temp_path), ["io.fits"])
+
+        # The header comes from the same open as the data
+        arimage.reset_io_stats()
+        copy = arimage.ARImage(path, load_values=False)
+        copy.loadData()
+        copy.loadValues()
+        self.assertEqual(arimage.get_io_stats()["files_opened"], 1)
+        self.assertEqual(copy.exp_time, 5)
+
+    def test_load_section(self):
+        img = arimage.ARImage(os.path.join(self._temp_path, "section.fits"), new_file=True)
+        data = np.arange(600, dtype=np.int16).reshape(20, 30)
+        img.fits_data = data
+        img.saveToDisk()
+        img.unloadData()
+
+        for memmap in (False, True):
+            self.assertTrue(np.array_equal(img.loadRows(5, 9, memmap=memmap), data[5:9]))
+            self.assertTrue(np.array_equal(img.loadSection(np.s_[2:4, 10:20], memmap=memmap),
+                                           data[2:4, 10:20]))
+            with img.openSection(memmap=memmap) as section:
+                self.assertEqual(section.shape, (20, 30))
+            # Only the slices were read
+            self.assertIs(img.fits_data, None)
+
+        # Loaded data is sliced directly
+        img.loadData()
+        self.assertTrue(np.array_equal(img.loadRows(0, 3), data[0:3]))
+
+    def test_read_into(self):
+        path = os.path.join(self._temp_path, "read-into.fits")
+        for dtype in (np.int16, np.uint16, np.float64):
+            img = arimage.ARImage(path, new_file=True)
+            data = np.arange(600).reshape(20, 30).astype(dtype)
+            img.fits_data = data
+            img.saveToDisk()
+            img.unloadData()
+
+            for memmap in (False, True):
+                with img.openSection(memmap=memmap) as section:
+                    # The rows are read into the array given, in its type
+                    out = np.empty((4, 30), dtype=dtype)
+                    section.readInto(5, 9, out)
+                    self.assertTrue(np.array_equal(out, data[5:9]))
+                    wide = np.empty((4, 30), dtype=np.float64)
+                    section.readInto(16, 20, wide)
+                    self.assertTrue(np.array_equal(wide, data[16:20]))
+
+    def test_read_into_fallback(self):
+        data = np.arange(600).reshape(20, 30).astype(np.int16)
+        scaled_path = os.path.join(self._temp_path, "scaled.fits")
+        img = arimage.ARImage(scaled_path, new_file=True)
+        img.fits_data = data.astype(np.float64) / 7
+        img.saveToDisk(np.int16)
+        blank_path = os.path.join(self._temp_path, "blank.fits")
+        img = arimage.ARImage(blank_path, new_file=True)
+        img.fits_data = data
+        img.fits_header["BLANK"] = -1
+        img.saveToDisk()
+        plain_path = os.path.join(self._temp_path, "plain.fits")
+        img = arimage.ARImage(plain_path, new_file=True)
+        img.fits_data = data
+        img.saveToDisk()
+        compressed_path = os.path.join(self._temp_path, "compressed.fits.gz")
+        with open(plain_path, "rb") as fits_file:
+            with gzip.open(compressed_path, "wb") as gzip_file:
+                shutil.copyfileobj(fits_file, gzip_file)
+
+        # Files that can't be read directly are read through the section,
+        # with the same values loadData() gives
+        for path in (scaled_path, blank_path, compressed_path):
+            img = arimage.ARImage(path, load_values=False)
+            expected = img.loadData()
+            img.unloadData()
+            with img.openSection(memmap=False) as section:
+                out = np.empty((4, 30), dtype=section.dtype.newbyteorder("="))
+                self.assertFalse(section._readRawInto(5, 9, out))
+                section.readInto(5, 9, out)
+                self.assertTrue(np.array_equal(out, expected[5:9]))
@@ -0,0 +1,74 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+from .. import arimage
+from .. import catalog
+from .. import env
+
+class TestCatalog(unittest.TestCase):
+    _temp_path = None
+    _catalog_path = None
+
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self._catalog_path = os.path.join(self._temp_path, "headers.sqlite")
+        env.set("HEADER_CATALOG", self._catalog_path)
+
+    def tearDown(self):
+        env.set("HEADER_CATALOG", "")
+        catalog.close_catalogs()
+        shutil.rmtree(self._temp_path)
+        self._temp_path = None
+
+    def _create_img(self, name: str, exp_time) -> arimage.ARImage:
+        img = arimage.ARImage(os.path.join(self._temp_path, name), new_file=True)
+        img.exp_time = exp_time
+        img.filter = "Clear"
+        img.saveToDisk()
+        return img
+
+    def test_lookup_store(self):
+        img = self._create_img("img.fits", 1)
+        stat = os.stat(img.getFullPath())
+        header_catalog = catalog.get_catalog()
+
+        self.assertIs(header_catalog.lookup(img.getFullPath(), stat), None)
+        header_catalog.store(img.getFullPath(), stat, img.getValues())
+        values = header_catalog.lookup(img.getFullPath(), stat)
+
+        # Value types are kept
+        self.assertEqual(values, img.getValues())
+        self.assertIs(type(values["exp_time"]), int)
+
+    def test_find_arimgs_uses_catalog(self):
+        self._create_img("img-0.fits", 1.5)
+        changed_img = self._create_img("img-1.fits", 2.5)
+        first_scan = arimage.find_arimgs_in_dir(self._temp_path)
+
+        # Change one image, only that one has to be read again
+        changed_img.exp_time = 30.0
+        changed_img.saveToDisk()
+        os.utime(changed_img.getFullPath(), ns=(0, 0))
+
+        loaded_paths = []
+        load_values = arimage.ARImage.loadValues
+        def counting_load_values(img):
+            loaded_paths.append(img.getFullPath())
+            load_values(img)
+        arimage.ARImage.loadValues = counting_load_values
+        try:
+            second_scan = arimage.find_arimgs_in_dir(self._temp_path)
+        finally:
+            arimage.ARImage.loadValues = load_values
+
+        self.assertEqual(loaded_paths, [changed_img.getFullPath()])
+        exp_times = sorted(img.exp_time for img in second_scan)
+        self.assertEqual(exp_times, [1.5, 30.0])
+        self.assertEqual(len(first_scan), len(second_scan))
+
+
+if __name__ == "__main__":
+    unittest.main()
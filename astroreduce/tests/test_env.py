@@ -40,6 +40,14 @@ class TestEnv(unittest.TestCase):
 
         self.assertIs(ret, False)
 
+    def test_get_int(self):
+        env.set("TestIntString", "64")
+        env.set("TestBadInt", "sixty-four")
+
+        self.assertEqual(env.get_int("TestIntString"), 64)
+        self.assertEqual(env.get_int("TestBadInt", 3), 3)
+        self.assertEqual(env.get_int("NwTeAaOk", 7), 7)
+
     def test_import_sys_env(self):
         os.environ["TestString"] = "World"
         env.import_sys_env()
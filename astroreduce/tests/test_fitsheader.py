@@ -0,0 +1,69 @@
+import unittest
+
+import gzip
+import os
+import shutil
+import tempfile
+
+from astropy.io import fits
+import numpy as np
+
+from .. import fitsheader
+
+_CARDS = [
+    ("XBINNING", 2),
+    ("CCD-TEMP", -20.25),
+    ("DATE-OBS", "2017-07-21T03:12:45.120"),
+    ("EXPTIME", 1.5E-3),
+    ("FILTER", "O''Neil 'V' "),
+    ("SIMPLEOK", True),
+    ("NEGINT", -42),
+]
+
+class TestFitsHeader(unittest.TestCase):
+    _temp_path = None
+
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._temp_path)
+        self._temp_path = None
+
+    def _write_img(self, name: str, cards) -> str:
+        path = os.path.join(self._temp_path, name)
+        hdu = fits.PrimaryHDU(np.zeros((4, 4), dtype=np.int16))
+        for keyword, value in cards:
+            hdu.header[keyword] = value
+        # Push the cards past the first header block
+        for i in range(40):
+            hdu.header["HISTORY"] = "Padding card " + str(i)
+        hdu.writeto(path)
+        return path
+
+    def test_read_cards_matches_astropy(self):
+        path = self._write_img("cards.fits", _CARDS)
+        keywords = [keyword for keyword, value in _CARDS] + ["MISSING"]
+
+        values = fitsheader.read_cards(path, keywords)
+        header = fits.getheader(path)
+
+        for keyword in keywords:
+            self.assertEqual(values[keyword], header.get(keyword))
+            self.assertIs(type(values[keyword]), type(header.get(keyword)))
+
+    def test_read_cards_fallback(self):
+        long_path = self._write_img("long.fits", [("FILTER", "Very long " * 10)])
+        gzip_path = long_path + ".gz"
+        with open(long_path, "rb") as f_in, gzip.open(gzip_path, "wb") as f_out:
+            f_out.write(f_in.read())
+
+        # Continued strings and compressed files are left to astropy
+        self.assertIs(fitsheader.read_cards(long_path, ["FILTER"]), None)
+        self.assertIs(fitsheader.read_cards(gzip_path, ["FILTER"]), None)
+        self.assertIs(fitsheader.read_cards(os.path.join(self._temp_path, "none.fits"),
+                                            ["FILTER"]), None)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -8,7 +8,10 @@ from typing import List
 import numpy as np
 
 from .. import arimage
+from .. import env
 from .. import flatfield
+from .. import framecache
+from .. import jobs
 
 _DARKS_DIR = "darks"
 _MDARKS_DIR = "mdarks"
@@ -68,12 +71,15 @@ def _create_test_arimg(
         img_kind: flatfield.ImageKind,
         img_data: np.array,
         img_exp: float,
-        img_filter: str) -> arimage.ARImage:
+        img_filter: str,
+        img_date_obs: str=None) -> arimage.ARImage:
     """ Create a new ARImage for testing """
     full_path = os.path.join(path_prefix, file_name)
     img = arimage.ARImage(full_path, new_file=True)
     img.exp_time = img_exp
     img.filter = img_filter
+    if img_date_obs is not None:
+        img.date_obs = img_date_obs
     img.img_kind = img_kind
     img.writeValues()
     img.fits_data = img_data
@@ -113,7 +119,8 @@ def _create_test_arimgs(
             img_kind,
             img_data,
             img_exp,
-            img_filter)
+            img_filter,
+            "2017-07-21T03:00:0" + str(i)) # Each light gets its own output file
         imgs.append(img)
         i += 1
 
@@ -203,6 +210,71 @@ class TestDarks(unittest.TestCase):
     def test_create_master_darks(self):
         self.assertTrue(True)
 
+    def test_med_combine_tiled(self):
+        expected = np.median([img.loadData() for img in self._darks], axis=0)
+        arimage.unload_data_arimgs(self._darks)
+
+        # A tiny memory limit forces the stack to be combined one row at a time
+        output_path = os.path.join(_temp_mdarks_path, "mdark-tiled.fts")
+        output_img = arimage.ARImage(output_path, new_file=True)
+        flatfield.med_combine(self._darks, output_img, mem_limit=1)
+
+        self.assertEqual(output_img.fits_data.dtype, expected.dtype)
+        self.assertTrue(np.array_equal(output_img.fits_data, expected))
+
+    def test_med_combine_threads(self):
+        expected = np.median([img.loadData() for img in self._darks], axis=0)
+        arimage.unload_data_arimgs(self._darks)
+
+        # One row per band and more threads than rows
+        output_path = os.path.join(_temp_mdarks_path, "mdark-threads.fts")
+        output_img = arimage.ARImage(output_path, new_file=True)
+        flatfield.med_combine(self._darks, output_img, mem_limit=1, threads=8)
+
+        self.assertTrue(np.array_equal(output_img.fits_data, expected))
+
+    def test_med_combine_stored_types(self):
+        # Unscaled integers, uint16 stored with BZERO 32768, and floats
+        rng = np.random.RandomState(5)
+        for dtype in (np.int16, np.uint16, np.float32):
+            imgs = []
+            for i in range(5):
+                img = arimage.ARImage(os.path.join(_temp_darks_path, "stored-" + str(i)
+                                                   + ".fts"), new_file=True)
+                img.fits_data = rng.randint(0, 30000, (7, 5)).astype(dtype)
+                img.saveToDisk()
+                img.unloadData()
+                img.unloadHeader()
+                imgs.append(img)
+            if dtype == np.uint16:
+                self.assertEqual(imgs[0].loadHeader()["BZERO"], 32768)
+            dark = arimage.ARImage(os.path.join(_temp_mdarks_path, "stored-dark.fts"),
+                                   new_file=True)
+            dark.fits_data = rng.randint(0, 100, (7, 5)).astype(dtype)
+
+            # The whole frames stacked and combined at once
+            expected = np.median([img.loadData() for img in imgs], axis=0)
+            expected_dark = np.median([img.loadData() - dark.fits_data for img in imgs],
+                                      axis=0)
+            arimage.unload_data_arimgs(imgs)
+
+            for memmap in ("False", "True"):
+                env.set("MEMMAP", memmap)
+                try:
+                    output_img = arimage.ARImage(os.path.join(_temp_mdarks_path,
+                                                              "stored.fts"), new_file=True)
+                    flatfield.med_combine(imgs, output_img, mem_limit=1, threads=2)
+                    dark_img = arimage.ARImage(os.path.join(_temp_mdarks_path,
+                                                            "stored-dark.fts"), new_file=True)
+                    flatfield.med_combine(imgs, dark_img, [dark] * len(imgs), mem_limit=1)
+                finally:
+                    env.set("MEMMAP", "")
+
+                self.assertEqual(output_img.fits_data.dtype, expected.dtype)
+                self.assertEqual(output_img.fits_data.tobytes(), expected.tobytes())
+                self.assertEqual(dark_img.fits_data.dtype, expected_dark.dtype)
+                self.assertEqual(dark_img.fits_data.tobytes(), expected_dark.tobytes())
+
 class TestFlats(unittest.TestCase):
     _darks = None
     _flats = None
@@ -229,6 +301,35 @@ class TestFlats(unittest.TestCase):
             for img in value:
                 self.assertTrue(isinstance(img, arimage.ARImage))
 
+    def test_med_combine_with_darks(self):
+        mdark_path = os.path.join(_temp_mdarks_path, "mdark.fts")
+        mdark = flatfield.med_combine_new_file(self._darks, mdark_path)
+        mdark.saveToDisk()
+        mdark.unloadData()
+
+        expected = np.median([img.loadData() - mdark.loadData() for img in self._flats], axis=0)
+        arimage.unload_data_arimgs(self._flats)
+        mdark.unloadData()
+
+        output_path = os.path.join(_temp_mflats_path, "mflat-tiled.fts")
+        output_img = arimage.ARImage(output_path, new_file=True)
+        flatfield.med_combine(self._flats, output_img, [mdark] * len(self._flats), mem_limit=1)
+
+        self.assertTrue(np.array_equal(output_img.fits_data, expected))
+
+class TestCorrectData(unittest.TestCase):
+    def test_correct_data(self):
+        raw = np.arange(30000, dtype=np.uint16).reshape(300, 100)
+        dark = np.full((300, 100), 7.5)
+        flat = np.linspace(0.5, 1.5, 30000).reshape(300, 100)
+        out = np.empty((300, 100))
+
+        ret = flatfield.correct_data(raw, dark, 1.0 / flat, out)
+
+        # Written straight into the given buffer
+        self.assertIs(ret, out)
+        self.assertTrue(np.allclose(out, (raw - dark) / flat))
+
 class TestLights(unittest.TestCase):
     _darks = None
     _flats = None
@@ -254,3 +355,201 @@ class TestLights(unittest.TestCase):
 
             for img in value:
                 self.assertTrue(isinstance(img, arimage.ARImage))
+
+    def test_create_corrected_images(self):
+        flatfield.create_master_darks(
+            flatfield.sort_arimgs_as_kind(self._darks, flatfield.ImageKind.DARK),
+            _temp_mdarks_path)
+        mdarks = arimage.find_arimgs_in_dir(_temp_mdarks_path)
+        mdarks_sorted = flatfield.sort_arimgs_as_kind(mdarks, flatfield.ImageKind.DARK)
+        flatfield.create_master_flats(
+            flatfield.sort_arimgs_as_kind(self._flats, flatfield.ImageKind.FLAT),
+            mdarks_sorted, _temp_mflats_path)
+        mflats = arimage.find_arimgs_in_dir(_temp_mflats_path)
+        mflats_sorted = flatfield.sort_arimgs_as_kind(mflats, flatfield.ImageKind.FLAT)
+
+        # Split the group of lights into several jobs
+        env.set("LIGHT_BATCH_SIZE", "4")
+        lights_sorted = flatfield.sort_arimgs_as_kind(self._lights, flatfield.ImageKind.LIGHT)
+        cache = framecache.get_cache()
+        cache.resetStats()
+        flatfield.create_corrected_images(lights_sorted, mdarks_sorted, mflats_sorted,
+                                          _temp_output_path)
+        env.set("LIGHT_BATCH_SIZE", str(flatfield.LIGHT_BATCH_SIZE_DEFAULT))
+
+        # Each batch shares the dark and 1 / flat, which were read only once
+        # and are dropped after the last batch
+        num_batches = sum(-(-len(lights) // 4) for lights in lights_sorted.values())
+        self.assertEqual(cache.getStats(), {"hits": 2 * num_batches - 2, "misses": 2,
+                                            "frames": 0})
+
+        output_imgs = arimage.find_arimgs_in_dir(_temp_output_path)
+        self.assertEqual(len(output_imgs), len(self._lights))
+        for img in output_imgs:
+            self.assertTrue(np.allclose(img.loadData(), _light_data_base))
+            img.unloadData()
+
+        # The shared masters are freed once the lights are done
+        for mdark in mdarks:
+            self.assertIs(mdark.fits_data, None)
+
+    def _correct_lights(self):
+        flatfield.create_master_darks(
+            flatfield.sort_arimgs_as_kind(self._darks, flatfield.ImageKind.DARK),
+            _temp_mdarks_path)
+        mdarks_sorted = flatfield.sort_arimgs_as_kind(
+            arimage.find_arimgs_in_dir(_temp_mdarks_path), flatfield.ImageKind.DARK)
+        lights_sorted = flatfield.sort_arimgs_as_kind(self._lights, flatfield.ImageKind.LIGHT)
+        return flatfield.create_corrected_images(lights_sorted, mdarks_sorted, None,
+                                                 _temp_output_path)
+
+    def test_lights_are_unloaded(self):
+        flatfield.create_master_darks(
+            flatfield.sort_arimgs_as_kind(self._darks, flatfield.ImageKind.DARK),
+            _temp_mdarks_path)
+        mdarks_sorted = flatfield.sort_arimgs_as_kind(
+            arimage.find_arimgs_in_dir(_temp_mdarks_path), flatfield.ImageKind.DARK)
+        lights = arimage.find_arimgs_in_dir(_temp_lights_path)
+        lights_sorted = flatfield.sort_arimgs_as_kind(lights, flatfield.ImageKind.LIGHT)
+        self.assertEqual(flatfield.create_corrected_images(lights_sorted, mdarks_sorted, None,
+                                                           _temp_output_path), (0, 6))
+
+        # Neither the data nor the header read with it stays loaded
+        for img in lights:
+            self.assertIs(img.fits_data, None)
+            self.assertIs(img.fits_header, None)
+
+    def test_sequential_pipeline(self):
+        # Without a pipeline each light is read, corrected and written before
+        # the next, so the batch never needs more than the pool's buffers
+        env.set("PIPELINE_DEPTH", "0")
+        try:
+            self.assertEqual(self._correct_lights(), (0, 6))
+        finally:
+            env.set("PIPELINE_DEPTH", "")
+
+        output_imgs = arimage.find_arimgs_in_dir(_temp_output_path)
+        self.assertEqual(len(output_imgs), len(self._lights))
+
+    def test_incremental_lights(self):
+        self.assertEqual(self._correct_lights(), (0, 6))
+        # Nothing changed
+        self.assertEqual(self._correct_lights(), (6, 0))
+
+        # A raw light that is newer than its output is corrected again
+        changed_path = self._lights[2].getFullPath()
+        os.utime(changed_path, ns=(os.stat(changed_path).st_atime_ns, 2 ** 62))
+        self.assertEqual(self._correct_lights(), (5, 1))
+
+        env.set("FORCE", "True")
+        try:
+            self.assertEqual(self._correct_lights(), (0, 6))
+        finally:
+            env.set("FORCE", "False")
+
+    def _reduce(self):
+        flatfield.reduce(
+            darks_dir=_temp_darks_path,
+            mdarks_dir=_temp_mdarks_path,
+            flats_dir=_temp_flats_path,
+            mflats_dir=_temp_mflats_path,
+            raw_dir=_temp_lights_path,
+            output_dir=_temp_output_path)
+
+    def test_reduce_keeps_masters_in_memory(self):
+        opened_paths = []
+        open_hdu = arimage.ImageSection._openHDU
+        def recording_open_hdu(section, path, memmap):
+            opened_paths.append(path)
+            return open_hdu(section, path, memmap)
+        arimage.ImageSection._openHDU = recording_open_hdu
+        try:
+            self._reduce()
+        finally:
+            arimage.ImageSection._openHDU = open_hdu
+
+        # The masters were written but never read back
+        mdarks = arimage.find_arimgs_in_dir(_temp_mdarks_path)
+        mflats = arimage.find_arimgs_in_dir(_temp_mflats_path)
+        self.assertTrue(bool(mdarks) and bool(mflats))
+        for master in mdarks + mflats:
+            self.assertNotIn(master.getFullPath(), opened_paths)
+        output_imgs = arimage.find_arimgs_in_dir(_temp_output_path)
+        self.assertTrue(bool(output_imgs))
+        for img in output_imgs:
+            self.assertTrue(np.allclose(img.loadData(), _light_data_base))
+            img.unloadData()
+
+        # The next run finds them on disk and the lights up to date
+        mtimes = [os.stat(master.getFullPath()).st_mtime_ns for master in mdarks + mflats]
+        self._reduce()
+        self.assertEqual(mtimes, [os.stat(master.getFullPath()).st_mtime_ns
+                                  for master in mdarks + mflats])
+
+    def test_reduce_frees_masters(self):
+        built = []
+        keep_master = flatfield.keep_master
+        def recording_keep_master(master, share_dir=None):
+            built.append(master)
+            return keep_master(master, share_dir)
+        flatfield.keep_master = recording_keep_master
+        try:
+            self._reduce()
+        finally:
+            flatfield.keep_master = keep_master
+
+        # The masters built in memory are freed once the lights are done
+        self.assertTrue(bool(built))
+        for master in built:
+            self.assertIs(master.fits_data, None)
+
+    def test_reduce_process_backend(self):
+        share_parent = os.path.join(_temp_base_path, "share")
+        os.makedirs(share_parent)
+        env.set("SHARE_DIR", share_parent)
+        env.set("JOBS_BACKEND", jobs.BACKEND_PROCESS)
+        try:
+            flatfield.reduce(
+                darks_dir=_temp_darks_path,
+                mdarks_dir=_temp_mdarks_path,
+                flats_dir=_temp_flats_path,
+                mflats_dir=_temp_mflats_path,
+                raw_dir=_temp_lights_path,
+                output_dir=_temp_output_path)
+        finally:
+            jobs.shutdown()
+            env.set("JOBS_BACKEND", jobs.BACKEND_THREAD)
+            env.set("SHARE_DIR", "")
+
+        output_imgs = arimage.find_arimgs_in_dir(_temp_output_path)
+        self.assertTrue(bool(output_imgs))
+        for img in output_imgs:
+            self.assertTrue(np.allclose(img.loadData(), _light_data_base))
+            img.unloadData()
+
+        # The shared masters are removed when the reduction is done
+        self.assertEqual(os.listdir(share_parent), [])
+
+    def test_float32_precision(self):
+        env.set("PRECISION", "float32")
+        try:
+            self._correct_lights()
+        finally:
+            env.set("PRECISION", "")
+
+        mdark = arimage.find_arimgs_in_dir(_temp_mdarks_path)[0]
+        self.assertEqual(mdark.loadHeader()["BITPIX"], -32)
+        for img in arimage.find_arimgs_in_dir(_temp_output_path):
+            self.assertEqual(img.loadHeader()["BITPIX"], -32)
+
+    def test_int_output(self):
+        env.set("INT_OUTPUT", "int16")
+        try:
+            self._correct_lights()
+        finally:
+            env.set("INT_OUTPUT", "")
+
+        for img in arimage.find_arimgs_in_dir(_temp_output_path):
+            header = img.loadHeader()
+            self.assertEqual(header["BITPIX"], 16)
+            self.assertIn("BSCALE", header)
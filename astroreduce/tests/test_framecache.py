@@ -0,0 +1,47 @@
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+
+from .. import framecache
+
+class TestFrameCache(unittest.TestCase):
+    def test_loaded_once(self):
+        cache = framecache.FrameCache()
+        cache.reserve("dark", 8)
+        loads = []
+        loads_lock = Lock()
+        def load():
+            with loads_lock:
+                loads.append(1)
+            sleep(0.01)
+            return [1, 2, 3]
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            frames = list(executor.map(lambda i: cache.get("dark", load), range(8)))
+
+        # Every job got the same frame, read only by the first of them
+        self.assertEqual(len(loads), 1)
+        for frame in frames:
+            self.assertIs(frame, frames[0])
+        self.assertEqual(cache.getStats(), {"hits": 7, "misses": 1, "frames": 1})
+
+    def test_released_after_last_reservation(self):
+        cache = framecache.FrameCache()
+        cache.reserve("flat")
+        cache.reserve("flat")
+        cache.get("flat", lambda: "frame")
+
+        cache.release("flat")
+        self.assertEqual(cache.getStats()["frames"], 1)
+        cache.release("flat")
+        self.assertEqual(cache.getStats()["frames"], 0)
+
+        # Loaded again if it is asked for after being dropped
+        cache.get("flat", lambda: "frame")
+        self.assertEqual(cache.getStats()["misses"], 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,182 @@
+import unittest
+
+import json
+import os
+import shutil
+import tempfile
+from threading import Barrier, Lock
+from time import sleep
+
+from .. import env
+from .. import jobs
+
+def _square_with_pid(x):
+    return x * x, os.getpid()
+
+def _add(*values):
+    return sum(values)
+
+def _fail():
+    raise RuntimeError("Job failure for testing")
+
+class _MemConcurrency:
+    """ Counts the small and large jobs of test_mem_limit running at once """
+    def __init__(self):
+        self.lock = Lock()
+        self.running = {"small": 0, "large": 0}
+        self.max_small = 0
+        self.mixed = False # A small job ran while the large one did
+        # Small jobs wait for each other, which only works if two run at once
+        self.pair = Barrier(2, timeout=10)
+
+    def run(self, kind):
+        with self.lock:
+            self.running[kind] += 1
+            self.max_small = max(self.max_small, self.running["small"])
+            if self.running["small"] > 0 and self.running["large"] > 0:
+                self.mixed = True
+        try:
+            if kind == "small":
+                self.pair.wait()
+            else:
+                sleep(0.01)
+        finally:
+            with self.lock:
+                self.running[kind] -= 1
+
+class TestJobs(unittest.TestCase):
+    def setUp(self):
+        # Start each test with only the workers it starts itself
+        jobs.shutdown()
+
+    def tearDown(self):
+        jobs.shutdown()
+        env.set("JOBS_BACKEND", jobs.BACKEND_THREAD)
+
+    def _run_square_jobs(self):
+        square_jobs = [jobs.Job(target=_square_with_pid, args=(i,)) for i in range(10)]
+        for job in square_jobs:
+            jobs.push_job(job)
+        jobs.start_jobs(2)
+        jobs.wait_done(show_progress=False)
+        return square_jobs
+
+    def test_thread_backend(self):
+        env.set("JOBS_BACKEND", jobs.BACKEND_THREAD)
+        square_jobs = self._run_square_jobs()
+
+        for i, job in enumerate(square_jobs):
+            self.assertTrue(job.has_run)
+            self.assertEqual(job.return_val, (i * i, os.getpid()))
+
+    def test_process_backend(self):
+        env.set("JOBS_BACKEND", jobs.BACKEND_PROCESS)
+        square_jobs = self._run_square_jobs()
+
+        for i, job in enumerate(square_jobs):
+            # The result is sent back from a worker process
+            self.assertTrue(job.has_run)
+            self.assertEqual(job.return_val[0], i * i)
+            self.assertNotEqual(job.return_val[1], os.getpid())
+
+    def _run_graph_jobs(self):
+        # Pushed before the jobs they depend on have run
+        first = jobs.Job(target=_add, args=(1, 2))
+        second = jobs.Job(target=_add, args=(first, 10))
+        total = jobs.Job(target=sum, args=([first, second],))
+        failed = jobs.Job(target=_fail)
+        skipped = jobs.Job(target=_add, args=(1,), deps=[failed, first])
+        for job in (total, skipped, second, failed, first):
+            jobs.push_job(job)
+        jobs.start_jobs(2)
+        jobs.wait_done(show_progress=False)
+        return first, second, total, failed, skipped
+
+    def test_job_dependencies(self):
+        for backend in jobs.BACKENDS:
+            env.set("JOBS_BACKEND", backend)
+            first, second, total, failed, skipped = self._run_graph_jobs()
+
+            # Jobs passed as arguments are replaced by their return values
+            self.assertEqual(total.deps, [first, second])
+            self.assertEqual(second.return_val, 13)
+            self.assertEqual(total.return_val, 16)
+            # A failed dependency stops the jobs that depend on it
+            self.assertTrue(failed.failed)
+            self.assertTrue(skipped.failed)
+            self.assertFalse(skipped.has_run)
+            jobs.shutdown()
+
+    def test_mem_limit(self):
+        env.set("JOBS_BACKEND", jobs.BACKEND_THREAD)
+        env.set("JOBS_MEM_LIMIT", "100")
+        try:
+            concurrency = _MemConcurrency()
+            mib = 1024 * 1024
+            small_jobs = [jobs.Job(target=concurrency.run, args=("small",), mem=40 * mib)
+                          for i in range(4)]
+            for job in small_jobs:
+                jobs.push_job(job)
+            # Larger than the whole budget, it still runs on its own
+            large_job = jobs.Job(target=concurrency.run, args=("large",), mem=500 * mib)
+            jobs.push_job(large_job)
+            jobs.start_jobs(4)
+            jobs.wait_done(show_progress=False)
+        finally:
+            env.set("JOBS_MEM_LIMIT", "")
+
+        # The small jobs ran in pairs, two fit in the budget but not three
+        for job in small_jobs + [large_job]:
+            self.assertTrue(job.has_run)
+        self.assertEqual(concurrency.max_small, 2)
+        # No small job ran next to the large one
+        self.assertFalse(concurrency.mixed)
+
+    def test_largest_first(self):
+        env.set("JOBS_BACKEND", jobs.BACKEND_THREAD)
+        run_order = []
+        def push(name, cost, deps=()):
+            job = jobs.Job(target=run_order.append, args=(name,), deps=deps, cost=cost)
+            jobs.push_job(job)
+            return job
+
+        push("small", 1)
+        gate = push("gate", 2)
+        push("medium", 50)
+        push("large", 100, deps=[gate])
+        jobs.start_jobs(1)
+        jobs.wait_done(show_progress=False)
+
+        # The cheap job that the large one waits for goes before the medium one
+        self.assertEqual(run_order, ["gate", "large", "medium", "small"])
+
+    def test_progress_json(self):
+        env.set("JOBS_BACKEND", jobs.BACKEND_THREAD)
+        temp_path = tempfile.mkdtemp()
+        json_path = os.path.join(temp_path, "progress.jsonl")
+        env.set("PROGRESS_JSON", json_path)
+        try:
+            for i in range(5):
+                jobs.push_job(jobs.Job(target=_add, args=(i,), frames=3))
+            jobs.start_jobs(2)
+            jobs.wait_done(show_progress=False)
+            with open(json_path) as f:
+                records = [json.loads(line) for line in f]
+        finally:
+            env.set("PROGRESS_JSON", "")
+            shutil.rmtree(temp_path)
+
+        self.assertEqual(records[-1]["event"], "done")
+        self.assertEqual(records[-1]["jobs_done"], 5)
+        self.assertEqual(records[-1]["frames_done"], 15)
+        self.assertEqual(records[-1]["frames_total"], 15)
+        self.assertEqual(records[-1]["eta_s"], 0)
+
+    def test_unknown_backend(self):
+        env.set("JOBS_BACKEND", "carrier-pigeon")
+
+        self.assertEqual(jobs.get_backend(), jobs.BACKEND_THREAD)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from .. import arimage
+from .. import env
+from .. import flatfield
+from .. import mastercache
+
+class TestMasterCache(unittest.TestCase):
+    _temp_path = None
+    _cache_path = None
+    _darks = None
+
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        self._cache_path = os.path.join(self._temp_path, "cache")
+        env.set("MASTER_CACHE_DIR", self._cache_path)
+        self._darks = []
+        for i in range(3):
+            img = arimage.ARImage(os.path.join(self._temp_path, "dark-" + str(i) + ".fts"),
+                                  new_file=True)
+            img.exp_time = 1.0
+            img.fits_data = np.full((4, 4), i, dtype=np.int16)
+            img.saveToDisk()
+            img.unloadData()
+            self._darks.append(img)
+
+    def tearDown(self):
+        env.set("MASTER_CACHE_DIR", "")
+        shutil.rmtree(self._temp_path)
+        self._temp_path = None
+
+    def _mdark_path(self) -> str:
+        return os.path.join(self._temp_path, "MDark-Exp1s0.fts")
+
+    def test_unchanged_master_is_skipped(self):
+        flatfield.create_master_dark(self._darks, self._temp_path)
+        os.utime(self._mdark_path(), ns=(0, 0))
+        flatfield.create_master_dark(self._darks, self._temp_path)
+
+        # The master wasn't written again
+        self.assertEqual(os.stat(self._mdark_path()).st_mtime_ns, 0)
+
+    def test_changed_input_rebuilds_master(self):
+        flatfield.create_master_dark(self._darks, self._temp_path)
+        key = mastercache.read_key(self._mdark_path())
+
+        self._darks[0].fits_data = np.full((4, 4), 9, dtype=np.int16)
+        self._darks[0].saveToDisk()
+        self._darks[0].unloadData()
+        os.utime(self._darks[0].getFullPath(), ns=(1, 1))
+        flatfield.create_master_dark(self._darks, self._temp_path)
+
+        self.assertNotEqual(mastercache.read_key(self._mdark_path()), key)
+        self.assertEqual(len(os.listdir(self._cache_path)), 2)
+
+    def test_master_is_fetched_from_cache(self):
+        flatfield.create_master_dark(self._darks, self._temp_path)
+        expected = arimage.ARImage(self._mdark_path()).loadData()
+        os.remove(self._mdark_path())
+        flatfield.create_master_dark(self._darks, self._temp_path)
+
+        self.assertTrue(np.array_equal(arimage.ARImage(self._mdark_path()).loadData(),
+                                       expected))
+
+    def test_evict(self):
+        os.makedirs(self._cache_path)
+        for i in range(4):
+            path = os.path.join(self._cache_path, str(i) + ".fts")
+            with open(path, "wb") as f:
+                f.write(b"\0" * 100)
+            os.utime(path, ns=(i, i))
+
+        # The least recently used files go first
+        mastercache.evict(self._cache_path, 250)
+
+        self.assertEqual(sorted(os.listdir(self._cache_path)), ["2.fts", "3.fts"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+
+from threading import Lock
+
+import numpy as np
+
+from .. import pipeline
+
+class TestPipeline(unittest.TestCase):
+    def test_run_pipeline(self):
+        in_flight = [0, 0] # Current and max items between the first and last stage
+        lock = Lock()
+
+        def read(x):
+            with lock:
+                in_flight[0] += 1
+                in_flight[1] = max(in_flight)
+            return x
+
+        def drop_odd(x):
+            if x % 2:
+                with lock:
+                    in_flight[0] -= 1
+                return None
+            return x * 10
+
+        def write(x):
+            with lock:
+                in_flight[0] -= 1
+            return x + 1
+
+        results = pipeline.run_pipeline(range(100), [read, drop_odd, write], depth=2)
+
+        self.assertEqual(results, [x * 10 + 1 for x in range(0, 100, 2)])
+        # Two queues of two, plus one item in each stage
+        self.assertLessEqual(in_flight[1], 2 * 2 + 3)
+
+    def test_run_pipeline_sequential(self):
+        results = pipeline.run_pipeline([1, 2, 3], [lambda x: x * 2, lambda x: x + 1], depth=0)
+
+        self.assertEqual(results, [3, 5, 7])
+
+        # Each item goes through every stage before the next one is started,
+        # and dropped items skip the later stages
+        order = []
+        def first(x):
+            order.append(("first", x))
+            return x if x != 2 else None
+        def second(x):
+            order.append(("second", x))
+            return x
+        results = pipeline.run_pipeline([1, 2, 3], [first, second], depth=0)
+        self.assertEqual(results, [1, 3])
+        self.assertEqual(order, [("first", 1), ("second", 1), ("first", 2), ("first", 3),
+                                 ("second", 3)])
+
+    def test_run_pipeline_error(self):
+        def fail_on_three(x):
+            if x == 3:
+                raise ValueError("three")
+            return x
+
+        with self.assertRaises(ValueError):
+            pipeline.run_pipeline(range(10), [fail_on_three, lambda x: x], depth=1)
+
+    def test_buffer_pool(self):
+        pool = pipeline.BufferPool(2)
+        first = pool.get((4, 4), np.float64)
+        second = pool.get((4, 4), np.float64)
+        pool.put(first)
+
+        # Buffers that are put back are reused instead of allocating more
+        self.assertIs(pool.get((4, 4), np.float64), first)
+        self.assertEqual(pool.allocated, 2)
+        pool.put(second)
+        self.assertIsNot(pool.get((2, 2), np.float64), second)
+
+
+if __name__ == "__main__":
+    unittest.main()
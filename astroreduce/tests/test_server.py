@@ -0,0 +1,137 @@
+import unittest
+
+import os
+import shutil
+import socket
+import stat
+import tempfile
+from threading import Thread
+
+from .. import env
+from .. import flatfield
+from .. import jobs
+from .. import server
+from . import test_flatfield
+
+class TestServer(unittest.TestCase):
+    _temp_path = None
+    _server = None
+    _thread = None
+
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        for name in ("darks", "mdarks", "flats", "mflats", "lights", "output"):
+            os.makedirs(self._path(name))
+        self._server = server.ReduceServer(self._path("server.sock"))
+        self._thread = Thread(target=self._server.serve_forever)
+        self._thread.start()
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._thread.join()
+        self._server.server_close()
+        jobs.shutdown()
+        shutil.rmtree(self._temp_path)
+        self._temp_path = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._temp_path, name)
+
+    def _submit(self, request) -> list:
+        return list(server.submit(self._path("server.sock"), request))
+
+    def test_frame_status(self):
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.DARK)
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.FLAT)
+        lights = test_flatfield._create_test_arimgs(self._temp_path,
+                                                    flatfield.ImageKind.LIGHT)
+        request = {}
+        for name in ("darks", "mdarks", "flats", "mflats", "output"):
+            request[name + "_dir"] = self._path(name)
+        # No master flat matches the filter of the last light
+        red_light = test_flatfield._create_test_arimg(
+            self._path("lights"), "light-red-0.fts", flatfield.ImageKind.LIGHT,
+            test_flatfield._light_data_base, 1.0, "Red", "2017-07-21T04:00:00")
+        request["lights"] = [light.getFullPath() for light in lights + [red_light]]
+
+        events = self._submit(request)
+        self.assertEqual(events[0], {"event": "started", "frames": len(lights) + 1})
+        frames = {event["path"]: event for event in events if event["event"] == "frame"}
+        self.assertEqual(sorted(frames), sorted(request["lights"]))
+        self.assertEqual(frames.pop(red_light.getFullPath())["status"],
+                         flatfield.LIGHT_SKIPPED)
+        for frame in frames.values():
+            self.assertEqual(frame["status"], flatfield.LIGHT_CORRECTED)
+            self.assertTrue(os.path.exists(frame["output"]))
+        self.assertEqual(events[-1]["event"], "done")
+        self.assertEqual(events[-1]["recomputed"], len(lights))
+
+        # The masters are kept for the next request, which finds the lights
+        # up to date
+        resident = dict(self._server._resident)
+        events = self._submit(request)
+        for event in events[1:-2]:
+            self.assertEqual(event["status"], flatfield.LIGHT_CURRENT)
+        self.assertEqual(events[-2]["status"], flatfield.LIGHT_SKIPPED)
+        self.assertEqual(events[-1]["reused"], len(lights))
+        self.assertEqual(len(resident), 2)
+        for path, master in resident.items():
+            self.assertIs(self._server._resident[path], master)
+
+    def test_masters_are_released(self):
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.DARK)
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.FLAT)
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.LIGHT)
+        request = {}
+        for name in ("darks", "mdarks", "flats", "mflats", "lights", "output"):
+            request[name.replace("lights", "raw") + "_dir"] = self._path(name)
+        env.set("SERVER_MASTERS_MEM", "0")
+        try:
+            self.assertEqual(self._submit(request)[-1]["event"], "done")
+            first_masters = list(self._server._resident.values())
+            # The same masters from other directories, only those stay loaded
+            for name in ("mdarks", "mflats"):
+                shutil.copytree(self._path(name), self._path(name + "-copy"))
+                request[name + "_dir"] = self._path(name + "-copy")
+            request["level"] = 2
+            self.assertEqual(self._submit(request)[-1]["event"], "done")
+        finally:
+            env.set("SERVER_MASTERS_MEM", "")
+
+        self.assertEqual(len(first_masters), 2)
+        for master in first_masters:
+            self.assertIs(master.fits_data, None)
+        self.assertEqual(sorted(os.path.dirname(path) for path in self._server._resident),
+                         [self._path("mdarks-copy"), self._path("mflats-copy")])
+
+    def test_socket(self):
+        socket_path = self._path("server.sock")
+        self.assertEqual(stat.S_IMODE(os.stat(socket_path).st_mode), 0o600)
+
+        # A running server's socket and other files are left alone
+        with self.assertRaises(OSError):
+            server.ReduceServer(socket_path)
+        self.assertTrue(stat.S_ISSOCK(os.stat(socket_path).st_mode))
+        file_path = self._path("not-a-socket")
+        with open(file_path, "w") as f:
+            f.write("keep")
+        with self.assertRaises(FileExistsError):
+            server.ReduceServer(file_path)
+        with open(file_path) as f:
+            self.assertEqual(f.read(), "keep")
+
+        # The socket of a server that stopped is replaced
+        stopped_path = self._path("stopped.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(stopped_path)
+        stopped = server.ReduceServer(stopped_path)
+        stopped.server_close()
+
+    def test_bad_request(self):
+        events = self._submit(["not", "an", "object"])
+
+        self.assertEqual(events[0]["event"], "error")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+import unittest
+
+import os
+import shutil
+import tempfile
+from threading import Event, Thread
+from time import monotonic, sleep
+
+from astropy.io import fits
+import numpy as np
+
+from .. import arimage
+from .. import env
+from .. import flatfield
+from .. import jobs
+from .. import watch
+from . import test_flatfield
+
+class TestWatch(unittest.TestCase):
+    _temp_path = None
+
+    def setUp(self):
+        self._temp_path = tempfile.mkdtemp()
+        env.set("WATCH_SETTLE_MS", "50")
+        env.set("WATCH_BATCH_MS", "50")
+        env.set("WATCH_POLL_MS", "20")
+
+    def tearDown(self):
+        for key in ("WATCH_SETTLE_MS", "WATCH_BATCH_MS", "WATCH_POLL_MS", "WATCH_BACKEND"):
+            env.set(key, "")
+        jobs.shutdown()
+        shutil.rmtree(self._temp_path)
+        self._temp_path = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._temp_path, name)
+
+    def test_debouncer(self):
+        path = self._path("light.fts")
+        with open(path, "wb") as f:
+            f.write(b"\0" * 10)
+        debouncer = watch.Debouncer(1.0)
+
+        debouncer.add([path])
+        self.assertEqual(debouncer.ready(0), [])
+        self.assertEqual(debouncer.ready(0.5), [])
+        self.assertEqual(debouncer.ready(1.0), [path])
+        # Unchanged files are only passed on once
+        debouncer.add([path])
+        self.assertEqual(debouncer.ready(5.0), [])
+        self.assertIs(debouncer.nextCheck(5.0), None)
+
+        # Still being written
+        with open(path, "ab") as f:
+            f.write(b"\0" * 10)
+        debouncer.add([path])
+        self.assertEqual(debouncer.ready(10.0), [])
+        with open(path, "ab") as f:
+            f.write(b"\0" * 10)
+        self.assertEqual(debouncer.ready(10.5), [])
+        self.assertEqual(debouncer.nextCheck(10.5), 1.0)
+        self.assertEqual(debouncer.ready(11.5), [path])
+
+    def _wait_for_outputs(self, count: int) -> bool:
+        output_dir = self._path("output")
+        deadline = monotonic() + 20
+        while monotonic() < deadline:
+            if len(arimage.find_fits_paths(output_dir, True)) >= count:
+                return True
+            sleep(0.02)
+        return False
+
+    def _watch_new_lights(self, bad_light: bool=False):
+        for name in ("darks", "mdarks", "flats", "mflats", "lights", "output"):
+            os.makedirs(self._path(name))
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.DARK)
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.FLAT)
+        lights = test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.LIGHT)
+        # Half of the lights arrive while it is watching
+        held_dir = self._path("held")
+        os.makedirs(held_dir)
+        for light in lights[3:]:
+            shutil.move(light.getFullPath(), held_dir)
+        bad_path = os.path.join(held_dir, "bad-0.fts")
+        if bad_light:
+            # Arrives along with good lights, without an exposure time
+            fits.PrimaryHDU(np.zeros((3, 3), dtype=np.int16)).writeto(bad_path)
+        bad_tries = []
+        correct_new_lights = watch.correct_new_lights
+        def counting_correct_new_lights(paths, *args):
+            bad_tries.extend(path for path in paths if os.path.basename(path) == "bad-0.fts")
+            return correct_new_lights(paths, *args)
+        watch.correct_new_lights = counting_correct_new_lights
+
+        stop = Event()
+        thread = Thread(target=watch.watch, kwargs={
+            "darks_dir": self._path("darks"),
+            "mdarks_dir": self._path("mdarks"),
+            "flats_dir": self._path("flats"),
+            "mflats_dir": self._path("mflats"),
+            "raw_dir": self._path("lights"),
+            "output_dir": self._path("output"),
+            "stop": stop})
+        thread.start()
+        try:
+            self.assertTrue(self._wait_for_outputs(3))
+            for name in sorted(os.listdir(held_dir)):
+                shutil.move(os.path.join(held_dir, name), self._path("lights"))
+            self.assertTrue(self._wait_for_outputs(len(lights)))
+            # Given time to be tried again, which it shouldn't be
+            sleep(0.3)
+            self.assertTrue(thread.is_alive())
+        finally:
+            stop.set()
+            thread.join()
+            watch.correct_new_lights = correct_new_lights
+
+        if bad_light:
+            # With its batch, then once more on its own if it shared one
+            self.assertIn(len(bad_tries), (1, 2))
+
+        for img in arimage.find_arimgs_in_dir(self._path("output")):
+            self.assertTrue(np.allclose(img.loadData(), test_flatfield._light_data_base))
+            img.unloadData()
+
+    def test_watch_inotify(self):
+        env.set("WATCH_BACKEND", watch.BACKEND_INOTIFY)
+        self._watch_new_lights()
+
+    def test_watch_poll(self):
+        env.set("WATCH_BACKEND", watch.BACKEND_POLL)
+        self._watch_new_lights()
+
+    def test_watch_skips_bad_light(self):
+        # Scanning finds the bad light again each time
+        env.set("WATCH_BACKEND", watch.BACKEND_POLL)
+        self._watch_new_lights(bad_light=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+import unittest
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+from threading import Barrier
+from time import sleep
+
+import numpy as np
+
+from .. import arimage
+from .. import env
+from .. import flatfield
+from .. import jobs
+from .. import workqueue
+from . import test_flatfield
+
+class TestWorkQueue(unittest.TestCase):
+    _temp_path = None
+    _queue_path = None
+
+    def setUp(self):
+        jobs.shutdown()
+        self._temp_path = tempfile.mkdtemp()
+        self._queue_path = os.path.join(self._temp_path, "queue")
+        for name in ("darks", "mdarks", "flats", "mflats", "lights", "output"):
+            os.makedirs(self._path(name))
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.DARK)
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.FLAT)
+        test_flatfield._create_test_arimgs(self._temp_path, flatfield.ImageKind.LIGHT)
+        env.set("WORKQUEUE_POLL_MS", "10")
+        env.set("LIGHT_BATCH_SIZE", "2")
+
+    def tearDown(self):
+        jobs.shutdown()
+        env.set("JOBS_WORKERS", "")
+        env.set("WORKQUEUE_POLL_MS", "")
+        env.set("WORKQUEUE_LEASE_MS", "")
+        env.set("LIGHT_BATCH_SIZE", str(flatfield.LIGHT_BATCH_SIZE_DEFAULT))
+        shutil.rmtree(self._temp_path)
+        self._temp_path = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self._temp_path, name)
+
+    def _plan(self):
+        tasks = workqueue.plan_tasks(
+            darks_dir=self._path("darks"),
+            mdarks_dir=self._path("mdarks"),
+            flats_dir=self._path("flats"),
+            mflats_dir=self._path("mflats"),
+            raw_dir=self._path("lights"),
+            output_dir=self._path("output"))
+        self.assertTrue(workqueue.create_queue(self._queue_path, tasks))
+        # Only the first plan is used
+        self.assertFalse(workqueue.create_queue(self._queue_path, tasks))
+        return tasks
+
+    def _check_outputs(self, tasks):
+        results = workqueue.WorkQueue(self._queue_path).getResults()
+        self.assertEqual(sorted(results), sorted(task["id"] for task in tasks))
+        for result in results.values():
+            self.assertEqual(result["status"], workqueue.STATUS_DONE)
+        self.assertEqual(os.listdir(os.path.join(self._queue_path, "locks")), [])
+        output_imgs = arimage.find_arimgs_in_dir(self._path("output"))
+        self.assertEqual(len(output_imgs), len(test_flatfield._hot_data))
+        for img in output_imgs:
+            self.assertTrue(np.allclose(img.loadData(), test_flatfield._light_data_base))
+            img.unloadData()
+
+    def test_plan(self):
+        tasks = self._plan()
+
+        kinds = [task["kind"] for task in tasks]
+        self.assertEqual(kinds, [workqueue.TASK_DARK, workqueue.TASK_FLAT]
+                         + [workqueue.TASK_LIGHTS] * 3)
+        # The lights wait for both masters, the flat for the dark
+        self.assertEqual(tasks[1]["deps"], [tasks[0]["id"]])
+        for task in tasks[2:]:
+            self.assertEqual(task["deps"], [tasks[0]["id"], tasks[1]["id"]])
+
+    def test_worker_processes(self):
+        tasks = self._plan()
+        workers = [multiprocessing.Process(target=workqueue.run_worker,
+                                           args=(self._queue_path,))
+                   for i in range(3)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for worker in workers:
+            self.assertEqual(worker.exitcode, 0)
+        self._check_outputs(tasks)
+
+        # Results are only read once
+        queue = workqueue.WorkQueue(self._queue_path)
+        read_paths = []
+        read_json = workqueue._read_json
+        def counting_read_json(path):
+            read_paths.append(path)
+            return read_json(path)
+        workqueue._read_json = counting_read_json
+        try:
+            queue.getResults()
+            self.assertEqual(len(read_paths), len(tasks))
+            self.assertTrue(queue.isDone())
+            self.assertEqual(len(read_paths), len(tasks))
+        finally:
+            workqueue._read_json = read_json
+
+    def test_stale_claim_is_broken(self):
+        tasks = self._plan()
+        # Claimed by a worker that crashed long ago
+        lock_path = os.path.join(self._queue_path, "locks", tasks[0]["id"] + ".lock")
+        with open(lock_path, "w") as f:
+            f.write("crashed:1")
+        os.utime(lock_path, (0, 0))
+        env.set("WORKQUEUE_LEASE_MS", "1000")
+
+        self.assertEqual(workqueue.run_worker(self._queue_path), len(tasks))
+        self._check_outputs(tasks)
+
+    def test_stalled_worker_loses_claim(self):
+        tasks = self._plan()
+        env.set("WORKQUEUE_LEASE_MS", "200")
+        stalled = workqueue.WorkQueue(self._queue_path)
+        other = workqueue.WorkQueue(self._queue_path)
+        lock_path = os.path.join(self._queue_path, "locks", tasks[0]["id"] + ".lock")
+
+        taken_over = []
+        def stalled_run(task):
+            # The lease runs out while the worker is stalled and another
+            # worker breaks the claim and takes the task
+            os.utime(lock_path, (0, 0))
+            self.assertIs(other.nextTask(), None)
+            taken_over.append(other.nextTask())
+            sleep(0.2)
+            return ["stalled-output"]
+        stalled._run = stalled_run
+        task, token = stalled.nextTask()
+        self.assertEqual(task["id"], tasks[0]["id"])
+
+        # Its result is dropped and the new claim is left alone
+        self.assertIs(stalled.runTask(task, token), None)
+        other_task, other_token = taken_over[0]
+        self.assertEqual(other_task["id"], tasks[0]["id"])
+        self.assertTrue(other.holdsClaim(task["id"], other_token))
+        self.assertNotIn(task["id"], other.getResults())
+
+        self.assertEqual(other.runTask(other_task, other_token), workqueue.STATUS_DONE)
+        self.assertEqual(other.getResults()[task["id"]]["outputs"],
+                         [flatfield.master_dark_path(1.0, self._path("mdarks"))])
+
+    def test_worker_runs_tasks_at_once(self):
+        tasks = self._plan()
+        env.set("JOBS_WORKERS", "2")
+        # The light tasks wait for each other, which only works if two run at once
+        pair = Barrier(2, timeout=10)
+        queue_run = workqueue.WorkQueue._run
+        def paired_run(queue, task):
+            if task["kind"] == workqueue.TASK_LIGHTS and task["id"] != tasks[-1]["id"]:
+                pair.wait()
+            return queue_run(queue, task)
+        workqueue.WorkQueue._run = paired_run
+        try:
+            self.assertEqual(workqueue.run_worker(self._queue_path), len(tasks))
+        finally:
+            workqueue.WorkQueue._run = queue_run
+        self._check_outputs(tasks)
+
+    def _reduce(self) -> int:
+        return workqueue.reduce(
+            self._queue_path,
+            darks_dir=self._path("darks"),
+            mdarks_dir=self._path("mdarks"),
+            flats_dir=self._path("flats"),
+            mflats_dir=self._path("mflats"),
+            raw_dir=self._path("lights"),
+            output_dir=self._path("output"))
+
+    def test_rerun_plans_new_lights(self):
+        self.assertEqual(self._reduce(), 5)
+        # Nothing changed, the finished plan is joined
+        self.assertEqual(self._reduce(), 0)
+
+        # A light added since is planned and corrected
+        light = arimage.ARImage(os.path.join(self._path("lights"), "light-testimg-0.fts"))
+        test_flatfield._create_test_arimg(
+            self._path("lights"), "light-testimg-extra.fts", flatfield.ImageKind.LIGHT,
+            light.loadData(), 1.0, "Clear", "2017-07-21T03:00:10")
+        self.assertEqual(self._reduce(), 6)
+        output_imgs = arimage.find_arimgs_in_dir(self._path("output"))
+        self.assertEqual(len(output_imgs), len(test_flatfield._hot_data) + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,393 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Watch the lights directory during the night and correct each new light
+# as soon as it is written. The masters are built or loaded once and kept
+# in memory. New files have to stop changing before they are read, and the
+# lights that arrive together are corrected as one batch.
+#
+
+from collections import OrderedDict
+import ctypes
+import ctypes.util
+import os
+import select
+import shutil
+import struct
+from threading import Event
+from time import monotonic, sleep
+from typing import Dict, List
+
+from . import arimage
+from . import env
+from . import flatfield as ff
+from . import jobs
+from . import log
+
+WATCH_SETTLE_MS_DEFAULT = 2000  # Time a new file has to stay unchanged before it is read
+WATCH_BATCH_MS_DEFAULT = 1000   # Time the first light of a batch waits for others
+WATCH_BATCH_MAX_DEFAULT = 64    # Lights corrected at most in one batch
+WATCH_POLL_MS_DEFAULT = 1000    # Time between scans without inotify
+
+BACKEND_INOTIFY = "inotify"
+BACKEND_POLL = "poll"
+
+# See inotify(7)
+_IN_MODIFY = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+_IN_WATCH_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+_IN_EVENT = struct.Struct("iIII") # wd, mask, cookie, len, followed by the name
+
+logger = log.get_logger()
+
+
+class PollWatcher:
+    """ Finds changed files by scanning the directory, works everywhere """
+    _directory = None
+    _interval = 0
+
+    def __init__(self, directory: str, interval: float):
+        self._directory = directory
+        self._interval = interval
+
+    def wait(self, timeout: float) -> List[str]:
+        """ Get the paths of the images that may have changed, after up to "timeout" seconds """
+        sleep(max(0, min(timeout, self._interval)))
+        return arimage.find_fits_paths(self._directory, True)
+
+    def close(self):
+        """ Stop watching """
+        pass
+
+
+class InotifyWatcher:
+    """ Finds changed files through inotify(7), without scanning the directory """
+    _directory = None
+    _libc = None
+    _fd = -1
+    _dirs = None    # Watched directory of each watch descriptor
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        self._dirs = {}
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        try:
+            self._addDir(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def _addDir(self, directory: str):
+        """ Watch "directory" and the directories in it, like find_fits_paths() walks them """
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), _IN_WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), directory)
+        self._dirs[wd] = directory
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir() and not entry.name.startswith("."):
+                    self._addDir(entry.path)
+
+    def wait(self, timeout: float) -> List[str]:
+        """ Get the paths of the images that changed, after up to "timeout" seconds """
+        readable, _, _ = select.select([self._fd], [], [], max(0, timeout))
+        if not readable:
+            return []
+
+        paths = set()
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buf):
+                wd, mask, cookie, name_len = _IN_EVENT.unpack_from(buf, offset)
+                offset += _IN_EVENT.size
+                name = os.fsdecode(buf[offset:offset + name_len].rstrip(b"\0"))
+                offset += name_len
+                if mask & _IN_Q_OVERFLOW:
+                    # Events were lost, look at everything again
+                    logger.warning("Missed changes in " + self._directory
+                                   + ", scanning it again")
+                    return arimage.find_fits_paths(self._directory, True)
+                directory = self._dirs.get(wd)
+                if directory is None or name.startswith("."):
+                    continue
+                path = os.path.join(directory, name)
+                if mask & _IN_ISDIR:
+                    if mask & (_IN_CREATE | _IN_MOVED_TO):
+                        # Watch it and pick up whatever was written before that
+                        try:
+                            self._addDir(path)
+                            paths.update(arimage.find_fits_paths(path, True))
+                        except OSError:
+                            logger.warning("Failed to watch directory: " + path)
+                elif name.endswith(arimage.FITS_EXTENSIONS):
+                    paths.add(path)
+        return sorted(paths)
+
+    def close(self):
+        """ Stop watching """
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def get_backend() -> str:
+    """ Get how to watch the lights directory, inotify if it is available """
+    backend = env.get("WATCH_BACKEND")
+    if backend == BACKEND_POLL:
+        return BACKEND_POLL
+    return BACKEND_INOTIFY
+
+
+def get_watcher(directory: str):
+    """ Watch "directory" with inotify, or by scanning it if inotify isn't available """
+    interval = env.get_int("WATCH_POLL_MS", WATCH_POLL_MS_DEFAULT) / 1000
+    if get_backend() == BACKEND_INOTIFY:
+        try:
+            return InotifyWatcher(directory)
+        except (OSError, AttributeError, TypeError) as err:
+            logger.warning("Unable to use inotify, scanning " + directory
+                           + " instead: " + str(err))
+    return PollWatcher(directory, interval)
+
+
+class Debouncer:
+    """ Holds back changed files until they have stopped changing """
+    _settle = 0
+    _pending = None # (size, mtime) and the time it was first seen of each changed file
+    _done = None    # (size, mtime) of each file that was passed on
+
+    def __init__(self, settle: float):
+        self._settle = settle
+        self._pending = {}
+        self._done = {}
+
+    def add(self, paths: List[str]):
+        """ Add files that may have changed """
+        for path in paths:
+            if path not in self._pending:
+                self._pending[path] = (None, 0)
+
+    def ready(self, now: float) -> List[str]:
+        """ Get the files that haven't changed for the settle time """
+        ready = []
+        for path, (signature, since) in list(self._pending.items()):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                del self._pending[path]
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if current == self._done.get(path):
+                del self._pending[path] # Unchanged since it was passed on
+            elif current != signature or stat.st_size == 0:
+                self._pending[path] = (current, now)
+            elif now - since >= self._settle:
+                del self._pending[path]
+                self._done[path] = current
+                ready.append(path)
+        return sorted(ready)
+
+    def nextCheck(self, now: float) -> float:
+        """ Seconds until a pending file may be ready, None if there are none """
+        if not bool(self._pending):
+            return None
+        since = min(since for signature, since in self._pending.values())
+        return max(0, since + self._settle - now)
+
+
+def release_master(master):
+    """ Free a resident master, and its file in share_dir if it has one """
+    if master.shared_path is not None:
+        try:
+            os.remove(master.shared_path)
+        except FileNotFoundError:
+            pass
+    master.unloadData()
+
+
+def load_resident_masters(masters_dic: Dict, share_dir: str=None,
+                          resident: OrderedDict=None) -> Dict:
+    """ Get the built or found masters, loaded to be kept for the whole watch """
+    # resident holds the masters loaded before by path, least recently used
+    # first, those that are still the same aren't loaded again
+    masters = {}
+    for key, values in (masters_dic or {}).items():
+        master = values[0]
+        if isinstance(master, jobs.Job):
+            master = master.return_val
+        if master is None:
+            continue # Failed to build
+        if resident is not None:
+            path = master.getFullPath()
+            loaded = resident.get(path)
+            if (loaded is not None
+                    and ff.master_fingerprint(loaded) == ff.master_fingerprint(master)):
+                master = loaded
+            else:
+                if loaded is not None:
+                    # Rebuilt, nothing uses the old one anymore
+                    release_master(loaded)
+                resident[path] = master
+            resident.move_to_end(path)
+        masters[key] = [ff.load_master(master, share_dir)]
+    return masters
+
+
+def correct_resident(imgs, mdarks_dic, mflats_dic, output_dir, callback=None):
+    """ Correct lights with resident masters, returns (reused, recomputed) """
+    # The resident masters are already loaded or shared, so the jobs don't
+    # need their own share_dir
+    lights_sorted = ff.sort_arimgs_as_kind(imgs, ff.ImageKind.LIGHT)
+    if not bool(lights_sorted):
+        return 0, 0
+    light_jobs, master_jobs, frame_keys = ff.push_corrected_image_jobs(
+        lights_sorted, mdarks_dic, mflats_dic, output_dir, callback=callback)
+    if not bool(light_jobs) and not bool(master_jobs):
+        return 0, 0
+    jobs.start_jobs()
+    jobs.wait_done(show_progress=False)
+    return ff.finish_corrected_images(light_jobs, master_jobs, frame_keys)
+
+
+def correct_new_lights(paths: List[str], mdarks_dic, mflats_dic, output_dir) -> int:
+    """ Correct a batch of new lights with the resident masters, returns the count corrected """
+    imgs = []
+    for path in paths:
+        try:
+            imgs.append(arimage.ARImage(path))
+        except (OSError, ValueError) as err:
+            logger.error("Failed to read new light: " + path + ": " + str(err))
+    if not bool(imgs):
+        return 0
+    reused, recomputed = correct_resident(imgs, mdarks_dic, mflats_dic, output_dir)
+    return recomputed
+
+
+def correct_batch(paths: List[str], mdarks_dic, mflats_dic, output_dir) -> int:
+    """ Correct new lights, one at a time if the batch fails, returns the count corrected """
+    # A bad light only costs itself, the watch keeps going. Its path was
+    # passed on by the Debouncer, so it is only tried again if it changes.
+    try:
+        return correct_new_lights(paths, mdarks_dic, mflats_dic, output_dir)
+    except Exception:
+        if len(paths) < 2:
+            logger.exception("Failed to correct new light, skipping it: " + paths[0])
+            return 0
+        logger.exception("Failed to correct a batch of new lights, trying them one at a time")
+    corrected = 0
+    for path in paths:
+        corrected += correct_batch([path], mdarks_dic, mflats_dic, output_dir)
+    return corrected
+
+
+def watch(
+        darks_dir="./darks",
+        mdarks_dir="./mdarks",
+        flats_dir="./flats",
+        mflats_dir="./mflats",
+        raw_dir="./lights",
+        output_dir="./output",
+        level=0,
+        stop: Event=None):
+    """ Correct the lights in raw_dir as they arrive until "stop" is set, see reduce() """
+    settle = env.get_int("WATCH_SETTLE_MS", WATCH_SETTLE_MS_DEFAULT) / 1000
+    batch_wait = env.get_int("WATCH_BATCH_MS", WATCH_BATCH_MS_DEFAULT) / 1000
+    batch_max = max(1, env.get_int("WATCH_BATCH_MAX", WATCH_BATCH_MAX_DEFAULT))
+
+    share_dir = None
+    if jobs.get_backend() == jobs.BACKEND_PROCESS:
+        share_dir = ff.create_share_dir()
+    watcher = None
+    try:
+        # Build the masters once, they stay in memory until the watch ends
+        mdarks_sorted, mflats_sorted = ff.push_master_jobs(
+            darks_dir, mdarks_dir, flats_dir, mflats_dir, level, share_dir)
+        jobs.start_jobs()
+        jobs.wait_done()
+        mdarks_sorted = load_resident_masters(mdarks_sorted, share_dir)
+        mflats_sorted = load_resident_masters(mflats_sorted, share_dir)
+
+        # Start watching before the first scan so nothing written in
+        # between is missed, the lights already there go first
+        watcher = get_watcher(raw_dir)
+        debouncer = Debouncer(settle)
+        debouncer.add(arimage.find_fits_paths(raw_dir, True))
+        print ("Watching " + raw_dir + " for new light images")
+
+        batch = []
+        batch_start = 0
+        while stop is None or not stop.is_set():
+            now = monotonic()
+            ready = debouncer.ready(now)
+            if bool(ready) and not bool(batch):
+                batch_start = now
+            batch.extend(ready)
+
+            # Wait a little for more lights, unless the batch is full
+            if bool(batch) and (len(batch) >= batch_max or now - batch_start >= batch_wait):
+                start_time = monotonic()
+                corrected = correct_batch(batch[:batch_max], mdarks_sorted,
+                                          mflats_sorted, output_dir)
+                print ("Corrected " + str(corrected) + " new light images in "
+                       + "{:.1f}".format(monotonic() - start_time) + " s")
+                batch = batch[batch_max:]
+                batch_start = now
+                continue
+
+            # Sleep until a file may have settled, the batch is due or
+            # something changes, checking for "stop" every second
+            timeout = 1.0
+            next_check = debouncer.nextCheck(now)
+            if next_check is not None:
+                timeout = min(timeout, next_check)
+            if bool(batch):
+                timeout = min(timeout, batch_start + batch_wait - now)
+            debouncer.add(watcher.wait(timeout))
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if share_dir is not None:
+            shutil.rmtree(share_dir, ignore_errors=True)
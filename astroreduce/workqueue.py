@@ -0,0 +1,538 @@
+# BSD 3-Clause License
+#
+# Copyright (c) 2017, Zackary Parsons
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# * Redistributions of source code must retain the above copyright notice, this
+#   list of conditions and the following disclaimer.
+#
+# * Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+#
+# * Neither the name of the copyright holder nor the names of its
+#   contributors may be used to endorse or promote products derived from
+#   this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+# Share a reduction between workers on several hosts through a directory on
+# shared storage. The first worker plans the whole reduction as tasks: one
+# for each master dark and flat, and one for each batch of lights. Every
+# worker then claims the tasks whose dependencies are done, so each master
+# is built once, by one worker, and read from the shared storage by the
+# others. Each worker runs as many tasks at once as it has job workers.
+#
+#   plan_dir/tasks/<id>.json    What to do, written once when planned
+#   plan_dir/locks/<id>.lock    Claim of the worker running the task
+#   plan_dir/done/<id>.json     Result of a finished or failed task
+#
+# reduce() plans in queue_dir/plan-<key>, where the key identifies the input
+# frames, so a rerun after frames were added or changed gets a new plan and
+# the workers of one run share the same one.
+#
+# A claim is a lock file created with O_EXCL holding a token unique to the
+# claim, and its mtime is the lease: the worker holding it touches it while
+# the task runs. A lock that isn't touched for the lease time belongs to a
+# worker that crashed or stalled, another worker breaks it and runs the task
+# again. A worker only renews, releases, or records the result of a claim
+# whose token is still in the lock, so a stalled worker that resumes drops
+# its result. Tasks only write their outputs with atomic renames and skip
+# outputs that are up to date, so a task that is run twice, after a claim
+# race or a stalled worker, is only done twice.
+# The lease has to be well above the clock difference between the hosts.
+#
+
+import json
+import os
+import socket
+from threading import Event, Thread
+from time import time
+from typing import Dict, List
+import uuid
+
+from . import arimage
+from . import env
+from . import flatfield as ff
+from . import jobs
+from . import log
+from . import mastercache
+
+WORKQUEUE_LEASE_MS_DEFAULT = 60000  # A claim not renewed for this long is broken
+WORKQUEUE_POLL_MS_DEFAULT = 1000    # Time between looks at the queue while waiting
+
+TASK_DARK = "dark"
+TASK_FLAT = "flat"
+TASK_LIGHTS = "lights"
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+logger = log.get_logger()
+
+
+def _write_json(path: str, value):
+    """ Write a JSON file so other workers never see it half written """
+    temp_path = os.path.join(os.path.dirname(path),
+                             "." + os.path.basename(path) + "." + uuid.uuid4().hex + ".tmp")
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(value, f)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _read_json(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _list_ids(directory: str, extension: str) -> List[str]:
+    """ Get the task ids of the files in directory, in order """
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-len(extension)] for name in names
+                  if name.endswith(extension) and not name.startswith("."))
+
+
+def plan_tasks(
+        darks_dir="./darks",
+        mdarks_dir="./mdarks",
+        flats_dir="./flats",
+        mflats_dir="./mflats",
+        raw_dir="./lights",
+        output_dir="./output",
+        level=0) -> List[Dict]:
+    """ Plan a reduction like ff.reduce() as tasks, in an order their dependencies allow """
+    tasks = []
+    def add_task(kind: str, name: str, task: Dict) -> Dict:
+        # Ordered ids, so the masters come first when listed
+        task["id"] = "{:05d}".format(len(tasks)) + "-" + kind + "-" + name
+        task["kind"] = kind
+        tasks.append(task)
+        return task
+
+    # Masters already on disk are used for anything that isn't being built,
+    # each master is the path it is written to and the task building it
+    mdarks = {}
+    for et, imgs in (ff.sort_arimgs_as_kind(arimage.find_arimgs_in_dir(mdarks_dir),
+                                            ff.ImageKind.DARK) or {}).items():
+        mdarks[et] = [(imgs[0].getFullPath(), None)]
+    if level < 1:
+        darks_sorted = ff.sort_arimgs_as_kind(arimage.find_arimgs_in_dir(darks_dir),
+                                              ff.ImageKind.DARK)
+        for et, darks in (darks_sorted or {}).items():
+            task = add_task(TASK_DARK, str(et), {
+                "paths": [dark.getFullPath() for dark in darks],
+                "output_dir": mdarks_dir,
+                "deps": [],
+            })
+            mdarks[et] = [(ff.master_dark_path(darks[0].exp_time, mdarks_dir), task["id"])]
+
+    mflats = {}
+    for fl, imgs in (ff.sort_arimgs_as_kind(arimage.find_arimgs_in_dir(mflats_dir),
+                                            ff.ImageKind.FLAT) or {}).items():
+        mflats[fl] = [(imgs[0].getFullPath(), None)]
+    if level < 2:
+        flats_sorted = ff.sort_arimgs_as_kind(arimage.find_arimgs_in_dir(flats_dir),
+                                              ff.ImageKind.FLAT)
+        for fl, flats in (flats_sorted or {}).items():
+            # Only the master darks these flats need
+            flat_mdarks = {}
+            for flat in flats:
+                et = int(round(flat.exp_time))
+                if et in mdarks:
+                    flat_mdarks[et] = mdarks[et][0]
+            task = add_task(TASK_FLAT, fl, {
+                "paths": [flat.getFullPath() for flat in flats],
+                "mdarks": {str(et): path for et, (path, dep) in flat_mdarks.items()},
+                "output_dir": mflats_dir,
+                "deps": sorted(set(dep for path, dep in flat_mdarks.values()
+                                   if dep is not None)),
+            })
+            mflats[fl] = [(ff.master_flat_path(fl, mflats_dir), task["id"])]
+
+    lights_sorted = ff.sort_arimgs_as_kind(arimage.find_arimgs_in_dir(raw_dir),
+                                           ff.ImageKind.LIGHT)
+    batch_size = max(1, env.get_int("LIGHT_BATCH_SIZE", ff.LIGHT_BATCH_SIZE_DEFAULT))
+    for key, imgs in (lights_sorted or {}).items():
+        masters = ff.find_light_masters(key, imgs, mdarks, mflats)
+        if masters is None:
+            continue
+        mdark, mflat = masters
+        deps = sorted(set(master[1] for master in masters
+                          if master is not None and master[1] is not None))
+        for i in range(0, len(imgs), batch_size):
+            add_task(TASK_LIGHTS, str(i // batch_size), {
+                "paths": [img.getFullPath() for img in imgs[i:i + batch_size]],
+                "key": list(key),
+                "mdark": None if mdark is None else mdark[0],
+                "mflat": None if mflat is None else mflat[0],
+                "output_dir": output_dir,
+                "deps": deps,
+            })
+    return tasks
+
+
+def create_queue(queue_dir: str, tasks: List[Dict]) -> bool:
+    """ Write the tasks to queue_dir, False if another worker already did """
+    # Written to a temporary directory and renamed into place, so only one
+    # plan is ever used and no worker sees part of it
+    os.makedirs(queue_dir, exist_ok=True)
+    tasks_dir = os.path.join(queue_dir, "tasks")
+    if os.path.isdir(tasks_dir):
+        return False
+    os.makedirs(os.path.join(queue_dir, "locks"), exist_ok=True)
+    os.makedirs(os.path.join(queue_dir, "done"), exist_ok=True)
+    temp_dir = os.path.join(queue_dir, ".tasks." + uuid.uuid4().hex)
+    os.makedirs(temp_dir)
+    for task in tasks:
+        _write_json(os.path.join(temp_dir, task["id"] + ".json"), task)
+    # Still empty directories would be replaced by the rename
+    _write_json(os.path.join(temp_dir, ".planned.json"), {"tasks": len(tasks)})
+    try:
+        os.rename(temp_dir, tasks_dir)
+    except OSError:
+        for name in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, name))
+        os.rmdir(temp_dir)
+        return False
+    return True
+
+
+def _read_token(lock_path: str) -> str:
+    """ Get the token of the claim held on a lock, None if it isn't held """
+    try:
+        with open(lock_path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+class _Heartbeat:
+    """ Renews the lease of a claim until stopped """
+    _lock_path = None
+    _token = None
+    _interval = 0
+    _stop = None
+    _thread = None
+    lost = False    # True if the claim was broken by another worker
+
+    def __init__(self, lock_path: str, token: str, interval: float):
+        self._lock_path = lock_path
+        self._token = token
+        self._interval = interval
+        self._stop = Event()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            # Only renew our own claim, not the one of a worker that broke it
+            try:
+                if _read_token(self._lock_path) == self._token:
+                    os.utime(self._lock_path)
+                    continue
+            except FileNotFoundError:
+                pass
+            self.lost = True
+            logger.warning("Lost the claim, another worker took over: " + self._lock_path)
+            return
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class WorkQueue:
+    """ The tasks of one reduction shared through queue_dir, see the top of this file """
+    _queue_dir = None
+    _tasks = None       # Planned tasks by id, they never change
+    _lease = 0
+    _worker = None      # Host and process of this worker
+    _masters = None     # (fingerprint, master) of the masters read by this worker
+    _results = None     # Results read so far by id, a result never changes once written
+
+    def __init__(self, queue_dir: str):
+        self._queue_dir = queue_dir
+        self._lease = env.get_int("WORKQUEUE_LEASE_MS", WORKQUEUE_LEASE_MS_DEFAULT) / 1000
+        self._worker = socket.gethostname() + ":" + str(os.getpid())
+        self._masters = {}
+        self._results = {}
+        self._tasks = {}
+        tasks_dir = self._path("tasks")
+        for task_id in _list_ids(tasks_dir, ".json"):
+            self._tasks[task_id] = _read_json(os.path.join(tasks_dir, task_id + ".json"))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Worker processes load the masters they need themselves
+        state["_masters"] = {}
+        return state
+
+    def _path(self, *names) -> str:
+        return os.path.join(self._queue_dir, *names)
+
+    def _lockPath(self, task_id: str) -> str:
+        return self._path("locks", task_id + ".lock")
+
+    def getResults(self) -> Dict[str, Dict]:
+        """ Get the results of the finished tasks by id """
+        # Only the results that are new since the last call are read
+        for task_id in _list_ids(self._path("done"), ".json"):
+            if task_id not in self._results:
+                self._readResult(task_id)
+        return self._results
+
+    def _readResult(self, task_id: str) -> Dict:
+        """ Get the result of one task, None if it hasn't finished """
+        if task_id not in self._results:
+            try:
+                self._results[task_id] = _read_json(self._path("done", task_id + ".json"))
+            except FileNotFoundError:
+                return None
+        return self._results[task_id]
+
+    def claim(self, task_id: str) -> str:
+        """ Claim a task, returns the claim's token or None if another worker holds it """
+        lock_path = self._lockPath(task_id)
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            self._breakStale(lock_path)
+            return None
+        # Unique to this claim, so a claim broken and taken again is told apart
+        token = self._worker + ":" + uuid.uuid4().hex
+        with os.fdopen(fd, "w") as f:
+            f.write(token)
+        return token
+
+    def holdsClaim(self, task_id: str, token: str) -> bool:
+        """ True if the claim with "token" still holds the task """
+        return _read_token(self._lockPath(task_id)) == token
+
+    def release(self, task_id: str, token: str):
+        """ Remove the lock of a task, if it is still held by the claim with "token" """
+        if self.holdsClaim(task_id, token):
+            try:
+                os.remove(self._lockPath(task_id))
+            except FileNotFoundError:
+                pass
+
+    def _breakStale(self, lock_path: str):
+        """ Remove a claim whose worker stopped renewing its lease """
+        try:
+            age = time() - os.stat(lock_path).st_mtime
+        except FileNotFoundError:
+            return
+        if age < self._lease:
+            return
+        # Renamed first so only one of the workers breaking it removes it
+        stale_path = lock_path + "." + uuid.uuid4().hex + ".stale"
+        try:
+            os.rename(lock_path, stale_path)
+        except FileNotFoundError:
+            return
+        os.remove(stale_path)
+        logger.warning("Broke a claim that wasn't renewed for " + str(int(age))
+                       + " s: " + lock_path)
+
+    def finish(self, task_id: str, token: str, status: str, outputs=None) -> bool:
+        """ Record the result of a claimed task and release it, False if the claim was lost """
+        if not self.holdsClaim(task_id, token):
+            # The worker that took over records its own result
+            logger.warning("Dropping the result of a task whose claim was lost: " + task_id)
+            return False
+        result = {
+            "status": status,
+            "worker": self._worker,
+            "outputs": outputs or [],
+        }
+        _write_json(self._path("done", task_id + ".json"), result)
+        self._results[task_id] = result
+        self.release(task_id, token)
+        return True
+
+    def nextTask(self):
+        """ Claim a task that is ready to run, returns (task, token) or None if none are now """
+        results = self.getResults()
+        for task_id, task in self._tasks.items():
+            if task_id in results:
+                continue
+            deps = [results.get(dep) for dep in task["deps"]]
+            if any(dep is None for dep in deps):
+                continue # Still waiting
+            token = self.claim(task_id)
+            if token is None:
+                continue
+            if self._readResult(task_id) is not None:
+                # Finished by the worker that held it just before
+                self.release(task_id, token)
+                continue
+            if any(dep["status"] != STATUS_DONE for dep in deps):
+                logger.warning("Skipping task, a task it depends on failed: " + task_id)
+                self.finish(task_id, token, STATUS_FAILED)
+                continue
+            return task, token
+        return None
+
+    def isDone(self) -> bool:
+        """ True once every task has finished or failed """
+        return len(self.getResults()) >= len(self._tasks)
+
+    def runTask(self, task: Dict, token: str) -> str:
+        """ Run a claimed task, renewing its lease while it runs, returns the status """
+        # None if the claim was lost, the result is dropped then
+        heartbeat = _Heartbeat(self._lockPath(task["id"]), token, self._lease / 4)
+        try:
+            outputs = self._run(task)
+            status = STATUS_DONE if outputs is not None else STATUS_FAILED
+        except Exception:
+            logger.exception("Task failed: " + task["id"])
+            outputs = None
+            status = STATUS_FAILED
+        finally:
+            heartbeat.stop()
+        if heartbeat.lost or not self.finish(task["id"], token, status, outputs):
+            return None
+        return status
+
+    def _master(self, path: str) -> arimage.ARImage:
+        """ Get a master built by any worker, loaded once while it is unchanged """
+        if path is None:
+            return None
+        fingerprint = mastercache.master_fingerprint(path)
+        fingerprint_master = self._masters.get(path)
+        if fingerprint_master is None or fingerprint_master[0] != fingerprint:
+            master = ff.load_master(arimage.ARImage(path))
+            self._masters[path] = (fingerprint, master)
+        return self._masters[path][1]
+
+    def _run(self, task: Dict) -> List[str]:
+        """ Run a task, returns the paths it wrote or None if it failed """
+        imgs = [arimage.ARImage(path) for path in task["paths"]]
+        if task["kind"] == TASK_DARK:
+            master = ff.create_master_dark(imgs, task["output_dir"])
+            return None if master is None else [master.getFullPath()]
+        if task["kind"] == TASK_FLAT:
+            mdarks_dic = {int(et): [arimage.ARImage(path)]
+                          for et, path in task["mdarks"].items()}
+            master = ff.create_master_flat(imgs, mdarks_dic, task["output_dir"])
+            return None if master is None else [master.getFullPath()]
+        if task["kind"] == TASK_LIGHTS:
+            reused, recomputed, frames = ff.correct_lights(
+                imgs, tuple(task["key"]), self._master(task["mdark"]),
+                self._master(task["mflat"]), task["output_dir"])
+            if any(status == ff.LIGHT_FAILED for raw, output, status in frames):
+                return None
+            return [output for raw, output, status in frames]
+        logger.error("Unknown task kind \"" + str(task["kind"]) + "\": " + task["id"])
+        return None
+
+
+def run_worker(queue_dir: str, stop: Event=None) -> int:
+    """ Run the tasks in queue_dir until all of them are done, returns the count run here """
+    # Claimed tasks run as jobs, up to one for each job worker at a time
+    queue = WorkQueue(queue_dir)
+    poll = env.get_int("WORKQUEUE_POLL_MS", WORKQUEUE_POLL_MS_DEFAULT) / 1000
+    max_running = jobs.get_workers()
+    task_finished = Event()
+    def task_done(job):
+        task_finished.set()
+    task_jobs = []
+    running = []
+    jobs.start_jobs(max_running)
+    while stop is None or not stop.is_set():
+        task_finished.clear()
+        running = [job for job in running if not job.isFinished()]
+        if not bool(running) and queue.isDone():
+            break
+        claimed = None
+        if len(running) < max_running:
+            claimed = queue.nextTask()
+        if claimed is None:
+            # Waiting for a task of this worker, or for other workers to
+            # finish what the rest depends on
+            task_finished.wait(poll)
+            continue
+        task, token = claimed
+        logger.info("Running task: " + task["id"])
+        job = jobs.Job(target=queue.runTask, args=(task, token), frames=len(task["paths"]),
+                       callback=task_done)
+        jobs.push_job(job)
+        task_jobs.append(job)
+        running.append(job)
+    # Stopped, let the tasks already claimed finish
+    jobs.wait_done(show_progress=False)
+    return sum(1 for job in task_jobs if job.return_val is not None)
+
+
+def plan_key(
+        darks_dir="./darks",
+        mdarks_dir="./mdarks",
+        flats_dir="./flats",
+        mflats_dir="./mflats",
+        raw_dir="./lights",
+        output_dir="./output",
+        level=0) -> str:
+    """ Identify the frames a reduction starts from and where it writes """
+    # The masters the plan builds aren't inputs, so a worker joining after
+    # some were written still finds the same plan
+    input_dirs = [raw_dir]
+    input_dirs.append(darks_dir if level < 1 else mdarks_dir)
+    input_dirs.append(flats_dir if level < 2 else mflats_dir)
+    input_paths = []
+    for directory in input_dirs:
+        try:
+            input_paths.extend(arimage.find_fits_paths(directory, True))
+        except OSError:
+            pass # No frames of this kind, the same as when planning
+    return mastercache.master_key("plan", input_paths, {
+        "dirs": [os.path.abspath(directory) for directory in
+                 (darks_dir, mdarks_dir, flats_dir, mflats_dir, raw_dir, output_dir)],
+        "level": level,
+        "batch_size": env.get_int("LIGHT_BATCH_SIZE", ff.LIGHT_BATCH_SIZE_DEFAULT),
+    })
+
+
+def reduce(
+        queue_dir,
+        darks_dir="./darks",
+        mdarks_dir="./mdarks",
+        flats_dir="./flats",
+        mflats_dir="./mflats",
+        raw_dir="./lights",
+        output_dir="./output",
+        level=0) -> int:
+    """ Plan the reduction in queue_dir if no worker has yet, then work on it """
+    # Workers given the same frames share one plan, new or changed frames
+    # get a new one
+    plan_dir = os.path.join(queue_dir, "plan-" + plan_key(
+        darks_dir, mdarks_dir, flats_dir, mflats_dir, raw_dir, output_dir, level)[:16])
+    if not os.path.isdir(os.path.join(plan_dir, "tasks")):
+        tasks = plan_tasks(darks_dir, mdarks_dir, flats_dir, mflats_dir, raw_dir,
+                           output_dir, level)
+        if create_queue(plan_dir, tasks):
+            print ("Planned " + str(len(tasks)) + " tasks in " + plan_dir)
+    count = run_worker(plan_dir)
+    print ("Ran " + str(count) + " tasks from " + plan_dir)
+    return count
@@ -23,8 +23,9 @@ setup(
     description="Astronomy data reduction program",
     packages=[PKG_NAME],
     include_package_data=True,
+    python_requires=">=3.7",
     install_requires=[
-        "astropy>=2.0",
-        "numpy>=1.13.1",
+        "astropy>=2.0.8",
+        "numpy>=1.14.5",
     ],
 )